@@ -97,7 +97,7 @@ class InMemoryUserService(UserService):
                 "username": "admin",
                 "full_name": "Admin User",
                 "email": "admin@example.com",
-                "permissions": [],
+                "permissions": ["admin"],
                 "disabled": False,
             },
             "tester": {
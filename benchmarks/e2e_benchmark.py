@@ -0,0 +1,210 @@
+"""
+End-to-end load benchmark of /ai/chat/ask and /teams/chat/ask.
+
+Runs the real routers, graphs and auth in process against the deterministic fake models
+(LLM_PROVIDER_MODE=fake, see comm/fake_models.py), so results are reproducible and need no network.
+Reports latency and time-to-first-answer-token percentiles, throughput and LLM calls per answer.
+
+Usage:
+    python benchmarks/e2e_benchmark.py --endpoint ai --requests 100 --concurrency 10
+    python benchmarks/e2e_benchmark.py --endpoint teams --requests 20 --concurrency 5 --llm-latency 0.5
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ENDPOINTS = {
+    "ai": {"path": "/ai/chat/ask", "first_token_marker": "[Answer]\n"},
+    "teams": {"path": "/teams/chat/ask", "first_token_marker": None},
+}
+USERS = ["admin", "tester"]
+
+
+def setup_env(args):
+    """must run before anything of the app is imported, module level config is read from the environment"""
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="e2e_benchmark_")
+    os.environ["LLM_PROVIDER_MODE"] = "fake"
+    os.environ["FAKE_LLM_LATENCY"] = str(args.llm_latency)
+    os.environ["FAKE_LLM_TOKENS_PER_SECOND"] = str(args.tokens_per_second)
+    os.environ["FAKE_LLM_ANSWER_TOKENS"] = str(args.answer_tokens)
+    os.environ["FAKE_ROUTE"] = args.route
+    os.environ.setdefault("MODEL_URL", "http://localhost:0/v1")
+    os.environ.setdefault("MODEL_API_KEY", "fake")
+    os.environ["CHROMA_PERSIST_DIRECTORY"] = os.path.join(work_dir, "chroma_db")
+    os.environ["CHECKPOINT_DIR"] = os.path.join(work_dir, "checkpoints")
+    os.environ["CONVERSATION_HISTORY_DIR"] = os.path.join(work_dir, "conversation_history")
+    os.environ["WORKSPACE_ROOT"] = os.path.join(work_dir, "workspaces")
+    os.environ["ROUTER_DATA_DIR"] = os.path.join(work_dir, "router")
+    os.environ["GRADER_DATA_DIR"] = os.path.join(work_dir, "grader")
+    os.environ["LLM_CACHE_DIR"] = os.path.join(work_dir, "llm_cache")
+    sys.path[:0] = [ROOT, os.path.join(ROOT, "langgraph_adaptive_rag"),
+                    os.path.join(ROOT, "langgraph_hierarchical_agent_teams")]
+    return work_dir
+
+
+def build_app(endpoint: str):
+    # main.py also needs sql server, mongodb and the built frontends, only the chat routers are benchmarked
+    from fastapi import FastAPI
+    app = FastAPI()
+    if endpoint == "ai":
+        from langgraph_adaptive_rag.api_router import router
+        app.include_router(router, prefix="/ai")
+    else:
+        from langgraph_hierarchical_agent_teams.api_router import teams_router
+        app.include_router(teams_router, prefix="/teams")
+    return app
+
+
+async def asgi_post(app, path: str, payload: dict, token: str, first_token_marker: str = None) -> dict:
+    """
+    POST to the app through the ASGI interface and time the streamed response.
+
+    Returns:
+        status, total seconds, seconds to the first answer token (None if none arrived) and the body size
+    """
+    body = json.dumps(payload).encode("utf-8")
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "POST",
+        "scheme": "http", "path": path, "raw_path": path.encode(), "root_path": "", "query_string": b"",
+        "headers": [(b"host", b"benchmark"), (b"content-type", b"application/json"),
+                    (b"authorization", f"Bearer {token}".encode())],
+        "client": ("127.0.0.1", 50000), "server": ("benchmark", 80),
+    }
+    request_sent = False
+    finished = asyncio.Event()
+    result = {"status": None, "ttft": None, "bytes": 0}
+    text = []
+    began = time.perf_counter()
+
+    async def receive():
+        nonlocal request_sent
+        if not request_sent:
+            request_sent = True
+            return {"type": "http.request", "body": body, "more_body": False}
+        # the client stays connected until the response is complete
+        await finished.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            result["status"] = message["status"]
+        elif message["type"] == "http.response.body":
+            chunk = message.get("body", b"")
+            if chunk:
+                result["bytes"] += len(chunk)
+                text.append(chunk.decode("utf-8", errors="ignore"))
+                if result["ttft"] is None:
+                    seen = "".join(text)
+                    if first_token_marker is None or \
+                            (first_token_marker in seen
+                             and len(seen) > seen.index(first_token_marker) + len(first_token_marker)):
+                        result["ttft"] = time.perf_counter() - began
+            if not message.get("more_body", False):
+                finished.set()
+
+    await app(scope, receive, send)
+    finished.set()
+    result["latency"] = time.perf_counter() - began
+    return result
+
+
+def percentile(values, p):
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    k = (len(values) - 1) * p / 100
+    low, high = int(k), min(int(k) + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (k - low)
+
+
+def count_llm_calls() -> int:
+    from comm.fake_models import get_call_count
+    return get_call_count()
+
+
+async def run_benchmark(args) -> dict:
+    from auth.security import create_access_token
+
+    app = build_app(args.endpoint)
+    endpoint = ENDPOINTS[args.endpoint]
+    tokens = {user: create_access_token({"sub": user}) for user in USERS}
+    semaphore = asyncio.Semaphore(args.concurrency)
+    questions = [q.strip() for q in args.questions.split("|") if q.strip()]
+
+    async def one(i):
+        user = USERS[i % len(USERS)]
+        payload = {"question": questions[i % len(questions)], "stream": True,
+                   "conversation_id": f"bench-{i}"}
+        async with semaphore:
+            try:
+                return await asgi_post(app, endpoint["path"], payload, tokens[user], endpoint["first_token_marker"])
+            except Exception as e:
+                return {"status": None, "error": repr(e)}
+
+    # warm up imports, the vector index and the models
+    await one(-1)
+    calls_before = count_llm_calls()
+    began = time.perf_counter()
+    results = await asyncio.gather(*(one(i) for i in range(args.requests)))
+    elapsed = time.perf_counter() - began
+    calls = count_llm_calls() - calls_before
+    from comm import checkpoint, http_client, persistence
+    persistence.close_all()
+    await checkpoint.close_async_savers()
+    await http_client.close_http_clients()
+
+    ok = [r for r in results if r.get("status") == 200]
+    latencies = [r["latency"] for r in ok]
+    ttfts = [r["ttft"] for r in ok if r["ttft"] is not None]
+    report = {
+        "endpoint": args.endpoint,
+        "requests": args.requests,
+        "concurrency": args.concurrency,
+        "succeeded": len(ok),
+        "failed": len(results) - len(ok),
+        "elapsed_seconds": round(elapsed, 3),
+        "requests_per_second": round(len(ok) / elapsed, 3) if elapsed else 0,
+        "llm_calls_per_answer": round(calls / len(ok), 2) if ok else 0,
+    }
+    for name, values in (("latency", latencies), ("ttft", ttfts)):
+        for p in (50, 95, 99):
+            report[f"{name}_p{p}_ms"] = round(percentile(values, p) * 1000, 1)
+    errors = sorted({r.get("error") or f"HTTP {r.get('status')}" for r in results if r.get("status") != 200})
+    if errors:
+        report["errors"] = errors[:5]
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--endpoint", choices=list(ENDPOINTS), default="ai")
+    parser.add_argument("--requests", type=int, default=50)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--questions", default="What is task decomposition for LLM agents?|"
+                                                "What are adversarial attacks on LLMs?|"
+                                                "How does chain of thought prompting work?",
+                        help="questions separated by |, used round robin")
+    parser.add_argument("--llm-latency", type=float, default=0.2, help="fake model seconds to first token")
+    parser.add_argument("--tokens-per-second", type=float, default=100, help="fake model streaming speed")
+    parser.add_argument("--answer-tokens", type=int, default=40, help="fake model answer length")
+    parser.add_argument("--route", default="vectorstore", help="fake router decision: vectorstore / web_search")
+    parser.add_argument("--work-dir", help="directory of the index, checkpoints and history, default a temp dir")
+    parser.add_argument("--json", action="store_true", help="print the report as json")
+    args = parser.parse_args()
+
+    setup_env(args)
+    report = asyncio.run(run_benchmark(args))
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        for key, value in report.items():
+            print(f"{key:>24}: {value}")
+
+
+if __name__ == "__main__":
+    main()
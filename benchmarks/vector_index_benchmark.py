@@ -0,0 +1,182 @@
+"""
+Benchmark of the vector store backends: Chroma (HNSW) against the quantized index (quantized_store.py).
+
+Builds both indexes from the same synthetic clustered embeddings, then queries each backend in a fresh
+process, so the resident memory of one doesn't count for the other. Reports recall@k against exact
+float32 search, query latency percentiles and the resident memory the index added to the process.
+
+Usage:
+    python benchmarks/vector_index_benchmark.py --vectors 100000 --dimension 384 --queries 200
+    python benchmarks/vector_index_benchmark.py --vectors 1000000 --nprobe 16 --backends quantized-ivf
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ROOT, os.path.join(ROOT, "langgraph_adaptive_rag")]
+BACKENDS = ("chroma", "quantized", "quantized-ivf")
+COLLECTION_NAME = "benchmark"
+BATCH_SIZE = 5000
+
+
+def rss_bytes() -> int:
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    # peak instead of current outside linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def make_data(args):
+    """clustered unit vectors, queries are noisy copies of random vectors"""
+    rng = np.random.default_rng(args.seed)
+    centers = rng.standard_normal((args.clusters, args.dimension)).astype(np.float32)
+    vectors = centers[rng.integers(0, args.clusters, args.vectors)] \
+        + 0.5 * rng.standard_normal((args.vectors, args.dimension)).astype(np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    queries = vectors[rng.integers(0, args.vectors, args.queries)] \
+        + 0.1 * rng.standard_normal((args.queries, args.dimension)).astype(np.float32)
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+    return vectors, queries
+
+
+def exact_neighbors(vectors, queries, k):
+    neighbors = []
+    for i in range(0, len(queries), 16):
+        scores = queries[i:i + 16] @ vectors.T
+        best = np.argpartition(-scores, k, axis=1)[:, :k]
+        order = np.argsort(-np.take_along_axis(scores, best, axis=1), axis=1)
+        neighbors.append(np.take_along_axis(best, order, axis=1))
+    return np.concatenate(neighbors)
+
+
+def build(args, work_dir, vectors):
+    import chromadb
+    from quantized_store import QuantizedVectorStore
+
+    timings = {}
+    ids = [str(i) for i in range(len(vectors))]
+    if "chroma" in args.backends:
+        began = time.perf_counter()
+        client = chromadb.PersistentClient(path=os.path.join(work_dir, "chroma"))
+        collection = client.get_or_create_collection(COLLECTION_NAME, metadata={"hnsw:space": "cosine"})
+        for i in range(0, len(vectors), BATCH_SIZE):
+            collection.add(ids=ids[i:i + BATCH_SIZE], embeddings=vectors[i:i + BATCH_SIZE],
+                           documents=ids[i:i + BATCH_SIZE])
+        timings["chroma"] = time.perf_counter() - began
+    if "quantized" in args.backends or "quantized-ivf" in args.backends:
+        began = time.perf_counter()
+        store = QuantizedVectorStore(os.path.join(work_dir, "quantized"), None)
+        for i in range(0, len(vectors), BATCH_SIZE):
+            store.add_embeddings(ids[i:i + BATCH_SIZE], vectors[i:i + BATCH_SIZE], ids=ids[i:i + BATCH_SIZE])
+        timings["quantized"] = time.perf_counter() - began
+        if "quantized-ivf" in args.backends:
+            began = time.perf_counter()
+            # same vectors, copied so the flat index stays without IVF
+            ivf_store = QuantizedVectorStore(os.path.join(work_dir, "quantized-ivf"), None)
+            for i in range(0, len(vectors), BATCH_SIZE):
+                ivf_store.add_embeddings(ids[i:i + BATCH_SIZE], vectors[i:i + BATCH_SIZE], ids=ids[i:i + BATCH_SIZE])
+            ivf_store.build_index(args.nlist)
+            timings["quantized-ivf"] = time.perf_counter() - began
+    return timings
+
+
+def query(args):
+    """runs in the child process, prints the results as json"""
+    import chromadb
+    from quantized_store import QuantizedVectorStore
+
+    queries = np.load(os.path.join(args.work_dir, "queries.npy"))
+    # only the index counts, not the imported libraries
+    baseline = rss_bytes()
+    if args.query_backend == "chroma":
+        collection = chromadb.PersistentClient(path=os.path.join(args.work_dir, "chroma")) \
+            .get_collection(COLLECTION_NAME)
+
+        def search(q):
+            return [int(i) for i in collection.query(query_embeddings=[q], n_results=args.k,
+                                                     include=[])["ids"][0]]
+    else:
+        store = QuantizedVectorStore(os.path.join(args.work_dir, args.query_backend), None)
+
+        def search(q):
+            return [p for p, _ in store.search_vector(q, args.k, nprobe=args.nprobe,
+                                                      rescore_factor=args.rescore_factor)]
+    search(queries[0])
+    latencies = []
+    results = []
+    for q in queries:
+        began = time.perf_counter()
+        results.append(search(q))
+        latencies.append(time.perf_counter() - began)
+    print(json.dumps({"latencies": latencies, "results": results, "rss": rss_bytes() - baseline}))
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def dir_size(path) -> int:
+    return sum(os.path.getsize(os.path.join(d, f)) for d, _, files in os.walk(path) for f in files)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--vectors", type=int, default=100000)
+    parser.add_argument("--dimension", type=int, default=384)
+    parser.add_argument("--clusters", type=int, default=200)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--nlist", type=int, default=None, help="IVF lists, sqrt of the vectors by default")
+    parser.add_argument("--nprobe", type=int, default=8)
+    parser.add_argument("--rescore-factor", type=int, default=4)
+    parser.add_argument("--backends", default=",".join(BACKENDS), help="comma separated, of " + ", ".join(BACKENDS))
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--work-dir", default=None, help="keep the indexes here, a temp folder by default")
+    parser.add_argument("--query-backend", default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.query_backend:
+        query(args)
+        return
+
+    args.backends = [b for b in args.backends.split(",") if b]
+    args.work_dir = args.work_dir or tempfile.mkdtemp(prefix="vector_index_benchmark_")
+    vectors, queries = make_data(args)
+    np.save(os.path.join(args.work_dir, "queries.npy"), queries)
+    truth = exact_neighbors(vectors, queries, args.k)
+    build_seconds = build(args, args.work_dir, vectors)
+    del vectors
+
+    print(f"{args.vectors} vectors of dimension {args.dimension}, {args.queries} queries, k={args.k}, "
+          f"work dir {args.work_dir}")
+    print(f"{'backend':<15}{'recall@k':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'rss MB':>10}"
+          f"{'disk MB':>10}{'build s':>10}")
+    for backend in args.backends:
+        child = subprocess.run([sys.executable, os.path.abspath(__file__), "--query-backend", backend,
+                                "--work-dir", args.work_dir, "--k", str(args.k), "--nprobe", str(args.nprobe),
+                                "--rescore-factor", str(args.rescore_factor)],
+                               capture_output=True, text=True, check=True)
+        result = json.loads(child.stdout.strip().splitlines()[-1])
+        recall = np.mean([len(set(found) & set(expected)) / args.k
+                          for found, expected in zip(result["results"], truth.tolist())])
+        latencies = [s * 1000 for s in result["latencies"]]
+        print(f"{backend:<15}{recall:>10.3f}{percentile(latencies, 50):>10.2f}{percentile(latencies, 95):>10.2f}"
+              f"{percentile(latencies, 99):>10.2f}{result['rss'] / 2 ** 20:>10.1f}"
+              f"{dir_size(os.path.join(args.work_dir, backend)) / 2 ** 20:>10.1f}{build_seconds[backend]:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
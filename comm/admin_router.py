@@ -0,0 +1,69 @@
+import asyncio
+
+from fastapi import APIRouter, HTTPException, Request
+from fastapi.responses import PlainTextResponse
+from pydantic import BaseModel
+
+from auth.security import require_permissions
+from comm.profiler import profiler
+
+admin_router = APIRouter()
+
+MAX_SAMPLE_SECONDS = 60
+
+
+class ArmRequest(BaseModel):
+    path_prefix: str = "/"
+    min_seconds: float = 1.0
+    count: int = 5
+
+
+@admin_router.post("/profiler/sample")
+@require_permissions(["admin"])
+async def sample(request: Request, seconds: float = 5, limit: int = 30):
+    """profile the whole process for some seconds"""
+    session = profiler.start("process")
+    try:
+        await asyncio.sleep(min(max(seconds, 0.1), MAX_SAMPLE_SECONDS))
+    finally:
+        profiler.stop(session)
+    return {**session.summary(), "top": session.top(limit)}
+
+
+@admin_router.get("/profiler/arm")
+@require_permissions(["admin"])
+async def get_armed(request: Request):
+    return profiler.armed_state()
+
+
+@admin_router.post("/profiler/arm")
+@require_permissions(["admin"])
+async def arm(request: Request, arm_request: ArmRequest):
+    """profile the next requests under path_prefix, keep the ones slower than min_seconds"""
+    profiler.arm(arm_request.path_prefix, arm_request.min_seconds, arm_request.count)
+    return profiler.armed_state()
+
+
+@admin_router.delete("/profiler/arm")
+@require_permissions(["admin"])
+async def disarm(request: Request):
+    profiler.disarm()
+    return profiler.armed_state()
+
+
+@admin_router.get("/profiler/profiles")
+@require_permissions(["admin"])
+async def list_profiles(request: Request):
+    return [session.summary() for session in reversed(profiler.profiles.values())]
+
+
+@admin_router.get("/profiler/profiles/{profile_id}")
+@require_permissions(["admin"])
+async def get_profile(request: Request, profile_id: int, format: str = "top", limit: int = 30):
+    """format "top" for the hottest functions, "collapsed" for folded stacks to render as flame graph"""
+    session = profiler.profiles.get(profile_id)
+    if session is None:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    if format == "collapsed":
+        return PlainTextResponse(session.collapsed())
+    return {**session.summary(), "top": session.top(limit)}
@@ -0,0 +1,113 @@
+"""
+Per-request execution budget: wall-clock deadline, LLM calls and tokens.
+
+A budget is created per request from the defaults of the endpoint, overridden per user, and travels in
+the graph config: its callback handler counts the LLM calls of the run (answers of the LLM cache are
+free) and the graph edges ask exhausted() before looping again. REQUEST_BUDGETS overrides the defaults
+as JSON, keyed by endpoint or "endpoint:user_id",
+e.g. {"adaptive_rag": {"seconds": 60}, "adaptive_rag:admin": {"llm_calls": 100}}.
+"""
+import json
+import logging
+import os
+import threading
+import time
+from typing import Optional
+
+from langchain_core.callbacks import BaseCallbackHandler
+
+from comm import llm_cache, metrics, tracing
+
+REQUEST_BUDGET_SECONDS = float(os.environ.get("REQUEST_BUDGET_SECONDS", 120))
+REQUEST_BUDGET_LLM_CALLS = int(os.environ.get("REQUEST_BUDGET_LLM_CALLS", 40))
+REQUEST_BUDGET_TOKENS = int(os.environ.get("REQUEST_BUDGET_TOKENS", 200000))
+REQUEST_BUDGET_GENERATIONS = int(os.environ.get("REQUEST_BUDGET_GENERATIONS", 15))
+REQUEST_BUDGETS = json.loads(os.environ.get("REQUEST_BUDGETS", "{}"))
+# "__" keeps it out of the checkpoint metadata
+CONFIG_KEY = "__request_budget"
+
+_exhausted = metrics.counter("request_budget_exhausted", "Requests that ran out of budget", ["endpoint", "reason"])
+_used = metrics.histogram("request_budget_llm_calls", "LLM calls per request", ["endpoint"],
+                          buckets=(1, 2, 4, 8, 16, 32, 64, 128))
+
+logger = tracing.get_logger("budget")
+
+
+class RequestBudget:
+    def __init__(self, endpoint: str, seconds: float = REQUEST_BUDGET_SECONDS,
+                 llm_calls: int = REQUEST_BUDGET_LLM_CALLS, tokens: int = REQUEST_BUDGET_TOKENS,
+                 generations: int = REQUEST_BUDGET_GENERATIONS):
+        self.endpoint = endpoint
+        self.deadline = time.monotonic() + seconds
+        self.max_llm_calls = llm_calls
+        self.max_tokens = tokens
+        self.max_generations = generations
+        self.llm_calls = 0
+        self.tokens = 0
+        self.reason: Optional[str] = None
+        self._lock = threading.Lock()
+        self.callback = _BudgetCallbackHandler(self)
+
+    def exhausted(self) -> Optional[str]:
+        """the reason the budget is used up, None if there is some left"""
+        if self.reason is None:
+            if time.monotonic() >= self.deadline:
+                reason = "deadline"
+            elif self.llm_calls >= self.max_llm_calls:
+                reason = "llm_calls"
+            elif self.tokens >= self.max_tokens:
+                reason = "tokens"
+            else:
+                return None
+            self.reason = reason
+            _exhausted.labels(self.endpoint, reason).inc()
+            tracing.log_event(logger, "budget_exhausted", endpoint=self.endpoint, reason=reason,
+                              llm_calls=self.llm_calls, tokens=self.tokens)
+        return self.reason
+
+    def remaining_seconds(self) -> float:
+        return max(0.0, self.deadline - time.monotonic())
+
+    def finish(self):
+        _used.labels(self.endpoint).observe(self.llm_calls)
+        tracing.log_event(logger, "budget_used", logging.DEBUG, endpoint=self.endpoint, **self.summary())
+
+    def summary(self) -> dict:
+        return {"llm_calls": self.llm_calls, "tokens": self.tokens, "exhausted": self.reason,
+                "remaining_seconds": round(self.remaining_seconds(), 3)}
+
+
+class _BudgetCallbackHandler(BaseCallbackHandler):
+    run_inline = True
+
+    def __init__(self, budget: RequestBudget):
+        self.budget = budget
+
+    # counted at the end, the start callbacks fire before the LLM cache lookup
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        if llm_cache.is_cache_hit(response):
+            return
+        input_tokens, output_tokens = tracing.get_token_usage(response)
+        with self.budget._lock:
+            self.budget.llm_calls += 1
+            self.budget.tokens += input_tokens + output_tokens
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        with self.budget._lock:
+            self.budget.llm_calls += 1
+
+
+def get_budget(endpoint: str, user_id: str = None) -> RequestBudget:
+    """a new budget of a request, REQUEST_BUDGETS overrides the defaults per endpoint and per user"""
+    conf = {**REQUEST_BUDGETS.get(endpoint, {}), **REQUEST_BUDGETS.get(f"{endpoint}:{user_id}", {})}
+    return RequestBudget(endpoint, **conf)
+
+
+def attach(config: dict, budget: RequestBudget) -> dict:
+    """the graph config with the budget, its LLM calls are counted by the budget's callback"""
+    return {**config, "callbacks": [*(config.get("callbacks") or []), budget.callback],
+            "configurable": {**config.get("configurable", {}), CONFIG_KEY: budget}}
+
+
+def from_config(config: dict) -> Optional[RequestBudget]:
+    return (config or {}).get("configurable", {}).get(CONFIG_KEY)
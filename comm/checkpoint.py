@@ -0,0 +1,61 @@
+import asyncio
+import os
+import sqlite3
+
+import aiosqlite
+from langgraph.checkpoint.sqlite import SqliteSaver
+from langgraph.checkpoint.sqlite.aio import AsyncSqliteSaver
+
+from comm.util import singleton
+
+CHECKPOINT_DIR = os.environ["CHECKPOINT_DIR"] if "CHECKPOINT_DIR" in os.environ else "./_checkpoints"
+
+_async_savers = {}
+_async_savers_lock = asyncio.Lock()
+
+
+def make_thread_id(user_id: str = None, conversation_id: str = None) -> str:
+    """thread id of a graph run, every conversation of a user has its own checkpoints"""
+    return f"{user_id or 'default'}:{conversation_id or 'default'}"
+
+
+def make_config(user_id: str = None, conversation_id: str = None) -> dict:
+    thread_id = make_thread_id(user_id, conversation_id)
+    # metadata is inherited by every run of the graph, the LLM rate limiter queues fairly per user_id
+    return {"configurable": {"thread_id": thread_id, "session_id": thread_id},
+            "metadata": {"user_id": user_id or "default"}}
+
+
+def _get_db_path(db_name: str) -> str:
+    os.makedirs(CHECKPOINT_DIR, exist_ok=True)
+    return os.path.join(CHECKPOINT_DIR, f"{db_name}.sqlite")
+
+
+@singleton
+def get_sqlite_saver(db_name: str) -> SqliteSaver:
+    """checkpointer for graphs running with the sync api (invoke / stream)"""
+    conn = sqlite3.connect(_get_db_path(db_name), check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    return SqliteSaver(conn)
+
+
+async def get_async_sqlite_saver(db_name: str) -> AsyncSqliteSaver:
+    """checkpointer for graphs running with the async api (ainvoke / astream), bound to the running event loop"""
+    if db_name not in _async_savers:
+        async with _async_savers_lock:
+            if db_name not in _async_savers:
+                conn = await aiosqlite.connect(_get_db_path(db_name))
+                await conn.execute("PRAGMA journal_mode=WAL")
+                saver = AsyncSqliteSaver(conn)
+                await saver.setup()
+                _async_savers[db_name] = saver
+    return _async_savers[db_name]
+
+
+async def close_async_savers():
+    """close the aiosqlite connections, their worker threads would otherwise keep the process alive"""
+    async with _async_savers_lock:
+        savers = list(_async_savers.values())
+        _async_savers.clear()
+    for saver in savers:
+        await saver.conn.close()
@@ -0,0 +1,288 @@
+"""
+Deterministic local stand-ins for the chat model, embedding model, web search and web page loader.
+
+Selected by LLM_PROVIDER_MODE=fake, they need no network access and make runs reproducible, so
+the graphs can be load tested and benchmarked. Latency and streaming speed are configurable to
+mimic a real endpoint.
+"""
+import asyncio
+import hashlib
+import json
+import math
+import os
+import re
+import threading
+import time
+import uuid
+from typing import Any, List, Optional
+
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from langchain_core.tools import StructuredTool
+from langchain_core.utils.function_calling import convert_to_openai_tool
+
+from comm import metrics
+
+FAKE_LLM_LATENCY = float(os.environ.get("FAKE_LLM_LATENCY", 0.2))  # seconds until the first token
+FAKE_LLM_TOKENS_PER_SECOND = float(os.environ.get("FAKE_LLM_TOKENS_PER_SECOND", 100))
+FAKE_LLM_ANSWER_TOKENS = int(os.environ.get("FAKE_LLM_ANSWER_TOKENS", 40))
+FAKE_ROUTE = os.environ.get("FAKE_ROUTE", "vectorstore")
+FAKE_EMBED_LATENCY = float(os.environ.get("FAKE_EMBED_LATENCY", 0.02))
+FAKE_EMBED_DIMENSION = int(os.environ.get("FAKE_EMBED_DIMENSION", 256))
+FAKE_SEARCH_LATENCY = float(os.environ.get("FAKE_SEARCH_LATENCY", 0.3))
+
+fake_llm_calls = metrics.counter("fake_llm_calls", "Calls answered by the fake chat model", ["role"])
+_call_count = 0
+_call_count_lock = threading.Lock()
+
+_WORDS = ("agent memory planning tool use reflection prompt chain thought few shot attack jailbreak "
+          "adversarial robustness retrieval embedding vector index model context answer question").split()
+
+
+def get_call_count() -> int:
+    """number of fake chat model calls so far, the benchmark derives LLM calls per answer from it"""
+    return _call_count
+
+
+def _count_call(role: str):
+    global _call_count
+    with _call_count_lock:
+        _call_count += 1
+    fake_llm_calls.labels(role).inc()
+
+
+def _stable_hash(text: str) -> int:
+    return int.from_bytes(hashlib.blake2b(text.encode("utf-8"), digest_size=8).digest(), "big")
+
+
+def _message_text(message) -> str:
+    return message.content if isinstance(message.content, str) else str(message.content)
+
+
+def _last_user_text(messages) -> str:
+    for message in reversed(messages):
+        if message.type == "human":
+            return _message_text(message)
+    return _message_text(messages[-1]) if messages else ""
+
+
+def _fake_answer(messages) -> List[str]:
+    """answer tokens derived from the last human message, same input gives the same answer"""
+    question = _last_user_text(messages)
+    seed = _stable_hash(question)
+    topic = " ".join(re.findall(r"\w+", question)[:6]) or "the question"
+    words = f"This is a deterministic answer about {topic} .".split()
+    while len(words) < FAKE_LLM_ANSWER_TOKENS:
+        seed = _stable_hash(str(seed))
+        words.append(_WORDS[seed % len(_WORDS)])
+    return [w + " " for w in words[:FAKE_LLM_ANSWER_TOKENS]]
+
+
+def _fake_value(name: str, prop: dict, messages) -> Any:
+    if name == "binary_score":
+        return "yes"
+    if name == "datasource":
+        options = prop.get("enum", [FAKE_ROUTE])
+        return FAKE_ROUTE if FAKE_ROUTE in options else options[0]
+    if name == "next":
+        # supervisor: send the user request to the first worker, finish once a worker reported back
+        system = _message_text(messages[0]) if messages else ""
+        members = re.findall(r"'([^']+)'", (re.search(r"workers: \[([^\]]*)\]", system) or [None, ""])[1])
+        last = messages[-1] if messages else None
+        if members and last is not None and last.type == "human" and not last.name:
+            return members[0]
+        return "FINISH"
+    if "enum" in prop:
+        return prop["enum"][0]
+    kind = prop.get("type")
+    if kind == "array":
+        question = _last_user_text(messages)
+        return [f"{question} ({i + 1})" for i in range(3)]
+    if kind in ("integer", "number"):
+        return 0
+    if kind == "boolean":
+        return True
+    return "".join(_fake_answer(messages)).strip()
+
+
+class FakeChatModel(BaseChatModel):
+    """Chat model answering deterministically after FAKE_LLM_LATENCY, streaming FAKE_LLM_TOKENS_PER_SECOND"""
+
+    role: str = "generator"
+    latency: float = FAKE_LLM_LATENCY
+    tokens_per_second: float = FAKE_LLM_TOKENS_PER_SECOND
+    max_tokens: Optional[int] = None
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-chat"
+
+    @property
+    def _identifying_params(self):
+        return {"role": self.role, "max_tokens": self.max_tokens}
+
+    def bind_tools(self, tools, tool_choice=None, **kwargs):
+        formatted = [convert_to_openai_tool(t) for t in tools]
+        return self.bind(tools=formatted, tool_choice=tool_choice, **kwargs)
+
+    def _tool_message(self, messages, tools, tool_choice) -> Optional[AIMessage]:
+        # only forced tool calls (structured output) are answered with a tool call, agents get a direct answer
+        if not tools or not tool_choice or tool_choice == "none":
+            return None
+        function = tools[0]["function"]
+        if isinstance(tool_choice, str):
+            function = next((t["function"] for t in tools if t["function"]["name"] == tool_choice), function)
+        properties = function.get("parameters", {}).get("properties", {})
+        args = {name: _fake_value(name, prop, messages) for name, prop in properties.items()}
+        return AIMessage(content="", tool_calls=[{"name": function["name"], "args": args,
+                                                  "id": f"call_{uuid.uuid4().hex[:12]}"}])
+
+    def _usage(self, messages, output_tokens: int) -> dict:
+        input_tokens = sum(len(_message_text(m)) for m in messages) // 4
+        return {"input_tokens": input_tokens, "output_tokens": output_tokens,
+                "total_tokens": input_tokens + output_tokens}
+
+    def _result(self, messages, tools, tool_choice) -> ChatResult:
+        message = self._tool_message(messages, tools, tool_choice)
+        if message is None:
+            message = AIMessage(content="".join(_fake_answer(messages)))
+        message.usage_metadata = self._usage(messages, FAKE_LLM_ANSWER_TOKENS)
+        return ChatResult(generations=[ChatGeneration(message=message)],
+                          llm_output={"token_usage": message.usage_metadata})
+
+    def _generate(self, messages, stop=None, run_manager=None, tools=None, tool_choice=None, **kwargs):
+        _count_call(self.role)
+        result = self._result(messages, tools, tool_choice)
+        output_tokens = 0 if result.generations[0].message.tool_calls else FAKE_LLM_ANSWER_TOKENS
+        time.sleep(self.latency + output_tokens / self.tokens_per_second)
+        return result
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, tools=None, tool_choice=None, **kwargs):
+        _count_call(self.role)
+        result = self._result(messages, tools, tool_choice)
+        output_tokens = 0 if result.generations[0].message.tool_calls else FAKE_LLM_ANSWER_TOKENS
+        await asyncio.sleep(self.latency + output_tokens / self.tokens_per_second)
+        return result
+
+    def _stream_chunks(self, messages, tools, tool_choice):
+        message = self._tool_message(messages, tools, tool_choice)
+        if message is not None:
+            yield ChatGenerationChunk(message=AIMessageChunk(content="", tool_call_chunks=[
+                {"name": c["name"], "args": json.dumps(c["args"]), "id": c["id"], "index": 0}
+                for c in message.tool_calls]))
+            return
+        for token in _fake_answer(messages):
+            chunk = AIMessageChunk(content=token, usage_metadata=self._usage(messages, 1))
+            yield ChatGenerationChunk(message=chunk)
+
+    def _stream(self, messages, stop=None, run_manager=None, tools=None, tool_choice=None, **kwargs):
+        _count_call(self.role)
+        time.sleep(self.latency)
+        for chunk in self._stream_chunks(messages, tools, tool_choice):
+            time.sleep(1 / self.tokens_per_second)
+            if run_manager:
+                run_manager.on_llm_new_token(chunk.message.content, chunk=chunk)
+            yield chunk
+
+    async def _astream(self, messages, stop=None, run_manager=None, tools=None, tool_choice=None, **kwargs):
+        _count_call(self.role)
+        await asyncio.sleep(self.latency)
+        for chunk in self._stream_chunks(messages, tools, tool_choice):
+            await asyncio.sleep(1 / self.tokens_per_second)
+            if run_manager:
+                await run_manager.on_llm_new_token(chunk.message.content, chunk=chunk)
+            yield chunk
+
+
+class FakeHashEmbeddings(Embeddings):
+    """Hashed bag-of-words embeddings, texts sharing words get similar vectors"""
+
+    def __init__(self, dimension: int = FAKE_EMBED_DIMENSION, latency: float = FAKE_EMBED_LATENCY):
+        self.dimension = dimension
+        self.latency = latency
+
+    def _embed(self, text: str) -> List[float]:
+        vector = [0.0] * self.dimension
+        for word in re.findall(r"\w+", text.lower()):
+            h = _stable_hash(word)
+            vector[h % self.dimension] += 1.0 if (h >> 32) & 1 else -1.0
+        norm = math.sqrt(sum(v * v for v in vector)) or 1.0
+        return [v / norm for v in vector]
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        time.sleep(self.latency)
+        return [self._embed(t) for t in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        await asyncio.sleep(self.latency)
+        return [self._embed(t) for t in texts]
+
+    async def aembed_query(self, text: str) -> List[float]:
+        return (await self.aembed_documents([text]))[0]
+
+
+def _fake_page_text(url: str, paragraphs: int = 12) -> str:
+    seed = _stable_hash(url)
+    ret = []
+    for i in range(paragraphs):
+        words = []
+        for _ in range(60):
+            seed = _stable_hash(str(seed))
+            words.append(_WORDS[seed % len(_WORDS)])
+        ret.append(f"Section {i + 1}. " + " ".join(words) + ".")
+    return "\n\n".join(ret)
+
+
+def fake_load_web_pages(urls: List[str]) -> List[Document]:
+    return [Document(page_content=_fake_page_text(url), metadata={"source": url, "title": f"Fake page {url}"})
+            for url in urls]
+
+
+def fake_load_web_html(urls: List[str]) -> List[tuple]:
+    """(url, html) pages with headings, paragraphs, a code block and navigation to skip"""
+    ret = []
+    for url in urls:
+        paragraphs = _fake_page_text(url).split("\n\n")
+        body = []
+        for i, paragraph in enumerate(paragraphs):
+            if i % 4 == 0:
+                body.append(f"<h2>Part {i // 4 + 1}</h2>")
+            if i % 2 == 0:
+                body.append(f"<h3>Topic {i + 1}</h3>")
+            body.append(f"<p>{paragraph}</p>")
+            if i % 4 == 3:
+                body.append(f"<pre><code>def step_{i}(state):\n    return retrieve(state, k={i})\n</code></pre>")
+        ret.append((url, f"<html><head><title>Fake page {url}</title><script>track()</script></head><body>"
+                         f"<nav><a href='/'>Home</a></nav><h1>Fake page</h1>{''.join(body)}"
+                         f"<footer>Copyright</footer></body></html>"))
+    return ret
+
+
+def _fake_search(query: str, max_results: int) -> List[dict]:
+    return [{"url": f"https://example.com/search/{_stable_hash(query) % 10000}/{i}",
+             "content": f"Result {i + 1} for {query}: " + _fake_page_text(f"{query}-{i}", 1)}
+            for i in range(max_results)]
+
+
+def get_fake_search_tool(max_results: int = 5) -> StructuredTool:
+    def search(query: str) -> List[dict]:
+        time.sleep(FAKE_SEARCH_LATENCY)
+        return _fake_search(query, max_results)
+
+    async def asearch(query: str) -> List[dict]:
+        await asyncio.sleep(FAKE_SEARCH_LATENCY)
+        return _fake_search(query, max_results)
+
+    return StructuredTool.from_function(
+        func=search,
+        coroutine=asearch,
+        name="tavily_search_results_json",
+        description="A search engine optimized for comprehensive, accurate, and trusted results. "
+                    "Input should be a search query.",
+    )
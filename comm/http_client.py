@@ -0,0 +1,165 @@
+"""
+Process-wide HTTP clients for the LLM and embedding endpoints.
+
+All models share one sync and one async connection pool (keep-alive, HTTP/2 when h2 is installed),
+so concurrent calls reuse connections instead of paying a TLS handshake each. Connection errors and
+retryable status codes are retried here with jittered exponential backoff, honoring Retry-After. The
+model calls are POSTs, so only failures where the server did not process the request are retried.
+Every model role has its own client over the shared pool, so the retries are counted per role.
+"""
+import asyncio
+import os
+import random
+import threading
+import time
+from typing import Optional
+
+import httpx
+
+from comm import metrics
+
+HTTP_MAX_CONNECTIONS = int(os.environ.get("HTTP_MAX_CONNECTIONS", 100))
+HTTP_MAX_KEEPALIVE_CONNECTIONS = int(os.environ.get("HTTP_MAX_KEEPALIVE_CONNECTIONS", 20))
+HTTP_KEEPALIVE_EXPIRY = float(os.environ.get("HTTP_KEEPALIVE_EXPIRY", 60))
+HTTP_CONNECT_TIMEOUT = float(os.environ.get("HTTP_CONNECT_TIMEOUT", 5))
+HTTP_ENABLE_HTTP2 = os.environ.get("HTTP_ENABLE_HTTP2", "true").lower() == "true"
+HTTP_MAX_RETRIES = int(os.environ.get("HTTP_MAX_RETRIES", 3))
+HTTP_RETRY_BACKOFF_BASE = float(os.environ.get("HTTP_RETRY_BACKOFF_BASE", 0.5))
+HTTP_RETRY_BACKOFF_MAX = float(os.environ.get("HTTP_RETRY_BACKOFF_MAX", 8))
+# the server did not process the request (or asks to come back later), safe to retry a POST too
+RETRY_STATUS_CODES = {408, 429, 502, 503, 504}
+# errors raised before the request reached the server, safe to retry for any method
+RETRY_EXCEPTIONS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+# a dropped connection can happen after the request was sent, only idempotent requests are repeated then
+IDEMPOTENT_RETRY_EXCEPTIONS = (httpx.RemoteProtocolError,)
+IDEMPOTENT_METHODS = {"GET", "HEAD", "OPTIONS", "PUT", "DELETE"}
+
+_pools = {}  # "sync" / "async" -> the pooled transport
+_clients = {}  # ("sync" / "async", role) -> client
+_clients_lock = threading.Lock()
+_retries = metrics.counter("http_client_retries", "Retried requests to the model endpoint", ["role", "reason"])
+
+
+def _http2_enabled() -> bool:
+    if not HTTP_ENABLE_HTTP2:
+        return False
+    try:
+        import h2  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+def _is_retryable(request: httpx.Request, error: Exception) -> bool:
+    return isinstance(error, RETRY_EXCEPTIONS) or \
+        (request.method in IDEMPOTENT_METHODS and isinstance(error, IDEMPOTENT_RETRY_EXCEPTIONS))
+
+
+def _get_retry_delay(role: str, attempt: int, response: Optional[httpx.Response] = None) -> float:
+    _retries.labels(role, str(response.status_code) if response is not None else "connection").inc()
+    if response is not None:
+        retry_after = response.headers.get("retry-after")
+        if retry_after:
+            try:
+                return min(float(retry_after), HTTP_RETRY_BACKOFF_MAX)
+            except ValueError:
+                pass
+    # full jitter, spreads the retries of concurrent callers
+    return random.uniform(0, min(HTTP_RETRY_BACKOFF_MAX, HTTP_RETRY_BACKOFF_BASE * 2 ** attempt))
+
+
+class RetryTransport(httpx.BaseTransport):
+    def __init__(self, transport: httpx.BaseTransport, max_retries: int = HTTP_MAX_RETRIES, role: str = ""):
+        self._transport = transport
+        self._max_retries = max_retries
+        self._role = role
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        attempt = 0
+        while True:
+            try:
+                response = self._transport.handle_request(request)
+            except (RETRY_EXCEPTIONS + IDEMPOTENT_RETRY_EXCEPTIONS) as e:
+                if attempt >= self._max_retries or not _is_retryable(request, e):
+                    raise
+                response = None
+            else:
+                if response.status_code not in RETRY_STATUS_CODES or attempt >= self._max_retries:
+                    return response
+                response.close()
+            time.sleep(_get_retry_delay(self._role, attempt, response))
+            attempt += 1
+
+    def close(self):
+        self._transport.close()
+
+
+class AsyncRetryTransport(httpx.AsyncBaseTransport):
+    def __init__(self, transport: httpx.AsyncBaseTransport, max_retries: int = HTTP_MAX_RETRIES, role: str = ""):
+        self._transport = transport
+        self._max_retries = max_retries
+        self._role = role
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        attempt = 0
+        while True:
+            try:
+                response = await self._transport.handle_async_request(request)
+            except (RETRY_EXCEPTIONS + IDEMPOTENT_RETRY_EXCEPTIONS) as e:
+                if attempt >= self._max_retries or not _is_retryable(request, e):
+                    raise
+                response = None
+            else:
+                if response.status_code not in RETRY_STATUS_CODES or attempt >= self._max_retries:
+                    return response
+                await response.aclose()
+            await asyncio.sleep(_get_retry_delay(self._role, attempt, response))
+            attempt += 1
+
+    async def aclose(self):
+        await self._transport.aclose()
+
+
+def _get_limits() -> httpx.Limits:
+    return httpx.Limits(max_connections=HTTP_MAX_CONNECTIONS,
+                        max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+                        keepalive_expiry=HTTP_KEEPALIVE_EXPIRY)
+
+
+def get_timeout(timeout: float) -> httpx.Timeout:
+    return httpx.Timeout(timeout, connect=HTTP_CONNECT_TIMEOUT)
+
+
+def get_http_client(role: str = "embedding") -> httpx.Client:
+    """the client of a model role, all share one connection pool"""
+    if ("sync", role) not in _clients:
+        with _clients_lock:
+            if "sync" not in _pools:
+                _pools["sync"] = httpx.HTTPTransport(http2=_http2_enabled(), limits=_get_limits())
+            if ("sync", role) not in _clients:
+                _clients[("sync", role)] = httpx.Client(transport=RetryTransport(_pools["sync"], role=role))
+    return _clients[("sync", role)]
+
+
+def get_async_http_client(role: str = "embedding") -> httpx.AsyncClient:
+    """the async client of a model role, the pool belongs to the serving event loop"""
+    if ("async", role) not in _clients:
+        with _clients_lock:
+            if "async" not in _pools:
+                _pools["async"] = httpx.AsyncHTTPTransport(http2=_http2_enabled(), limits=_get_limits())
+            if ("async", role) not in _clients:
+                _clients[("async", role)] = httpx.AsyncClient(transport=AsyncRetryTransport(_pools["async"],
+                                                                                            role=role))
+    return _clients[("async", role)]
+
+
+async def close_http_clients():
+    # the clients of the roles only wrap the pools, closing a pool closes its connections
+    with _clients_lock:
+        _clients.clear()
+        sync_pool = _pools.pop("sync", None)
+        async_pool = _pools.pop("async", None)
+    if sync_pool is not None:
+        sync_pool.close()
+    if async_pool is not None:
+        await async_pool.aclose()
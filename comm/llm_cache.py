@@ -0,0 +1,144 @@
+"""
+Exact-match cache of LLM responses for deterministic (temperature 0) calls.
+
+Keyed on a hash of the model with its parameters (bound tools / structured output included) and the
+serialized messages, as given by LangChain to BaseCache. Lookups go to an in-memory LRU first, then to
+a SQLite table with TTL and a row cap, which survives restarts and is shared by the workers of a host.
+SQLite writes run on a background persistence scheduler, a cache update never delays the response.
+Chat models opt in per chain, see llm_provider.get_chat_model(cache=True).
+"""
+import collections
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Optional
+
+from langchain_core.caches import RETURN_VAL_TYPE, BaseCache
+from langchain_core.load import dumps, loads
+
+from comm import metrics, persistence, tracing
+from comm.util import singleton
+
+LLM_CACHE_ENABLED = os.environ.get("LLM_CACHE_ENABLED", "true").lower() == "true"
+LLM_CACHE_DIR = os.environ["LLM_CACHE_DIR"] if "LLM_CACHE_DIR" in os.environ else "_llm_cache"
+LLM_CACHE_MEMORY_SIZE = int(os.environ.get("LLM_CACHE_MEMORY_SIZE", 2048))
+LLM_CACHE_TTL = float(os.environ.get("LLM_CACHE_TTL", 86400))
+LLM_CACHE_MAX_ROWS = int(os.environ.get("LLM_CACHE_MAX_ROWS", 100000))
+# expired and surplus rows are deleted every this many writes
+LLM_CACHE_TRIM_INTERVAL = int(os.environ.get("LLM_CACHE_TRIM_INTERVAL", 500))
+# generation_info key of the generations served from the cache
+CACHE_HIT_KEY = "llm_cache_hit"
+
+logger = tracing.get_logger("llm_cache")
+_lookups = metrics.counter("llm_cache_lookups", "LLM cache lookups by the tier that answered", ["tier"])
+
+
+def _mark_hit(value: RETURN_VAL_TYPE) -> RETURN_VAL_TYPE:
+    """copies of the cached generations marked as served from the cache, the stored ones stay unmarked"""
+    return [g.model_copy(update={"generation_info": {**(g.generation_info or {}), CACHE_HIT_KEY: True}}) for g in value]
+
+
+def is_cache_hit(response) -> bool:
+    """whether all generations of an LLMResult were served from the cache, no model call was made"""
+    generations = [generation for generations in response.generations or [] for generation in generations]
+    return bool(generations) and all((g.generation_info or {}).get(CACHE_HIT_KEY) for g in generations)
+
+
+class TwoTierLLMCache(BaseCache):
+    def __init__(self, db_path: str, memory_size: int = LLM_CACHE_MEMORY_SIZE, ttl: float = LLM_CACHE_TTL,
+                 max_rows: int = LLM_CACHE_MAX_ROWS):
+        self.db_path = db_path
+        self.memory_size = memory_size
+        self.ttl = ttl
+        self.max_rows = max_rows
+        self._lock = threading.Lock()
+        self._memory = collections.OrderedDict()  # key -> (return value, expires)
+        self._writes = 0
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS llm_cache (key TEXT PRIMARY KEY, value TEXT NOT NULL, "
+                           "expires REAL NOT NULL)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS llm_cache_expires ON llm_cache (expires)")
+        self._conn.commit()
+        self._writer = persistence.PersistenceScheduler("llm_cache", workers=1, policy="drop")
+
+    @staticmethod
+    def _key(prompt: str, llm_string: str) -> str:
+        return hashlib.sha256(f"{llm_string}\x00{prompt}".encode("utf-8")).hexdigest()
+
+    def _remember(self, key: str, value: RETURN_VAL_TYPE, expires: float):
+        """called with the lock held"""
+        self._memory[key] = (value, expires)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_size:
+            self._memory.popitem(last=False)
+
+    def lookup(self, prompt: str, llm_string: str) -> Optional[RETURN_VAL_TYPE]:
+        key = self._key(prompt, llm_string)
+        now = time.time()
+        with self._lock:
+            item = self._memory.get(key)
+            if item is not None and item[1] > now:
+                self._memory.move_to_end(key)
+                _lookups.labels("memory").inc()
+                return _mark_hit(item[0])
+            row = self._conn.execute("SELECT value, expires FROM llm_cache WHERE key = ? AND expires > ?",
+                                     (key, now)).fetchone()
+        if row is None:
+            _lookups.labels("miss").inc()
+            return None
+        try:
+            value = loads(row[0])
+        except Exception as e:
+            # e.g. written by another langchain version
+            tracing.log_event(logger, "load_failed", logging.WARNING, error=repr(e))
+            _lookups.labels("miss").inc()
+            return None
+        with self._lock:
+            self._remember(key, value, row[1])
+        _lookups.labels("sqlite").inc()
+        return _mark_hit(value)
+
+    def update(self, prompt: str, llm_string: str, return_val: RETURN_VAL_TYPE) -> None:
+        key = self._key(prompt, llm_string)
+        expires = time.time() + self.ttl
+        with self._lock:
+            self._remember(key, return_val, expires)
+        value = dumps(return_val)
+
+        def write():
+            with self._lock:
+                self._conn.execute("INSERT OR REPLACE INTO llm_cache (key, value, expires) VALUES (?, ?, ?)",
+                                   (key, value, expires))
+                self._writes += 1
+                if self._writes % LLM_CACHE_TRIM_INTERVAL == 0:
+                    self._trim()
+                self._conn.commit()
+        self._writer.submit(key, write)
+
+    def _trim(self):
+        """delete expired rows and the ones over max_rows expiring first, called with the lock held"""
+        self._conn.execute("DELETE FROM llm_cache WHERE expires <= ?", (time.time(),))
+        count = self._conn.execute("SELECT COUNT(*) FROM llm_cache").fetchone()[0]
+        if count > self.max_rows:
+            self._conn.execute("DELETE FROM llm_cache WHERE key IN (SELECT key FROM llm_cache ORDER BY expires "
+                               "LIMIT ?)", (count - self.max_rows,))
+
+    def clear(self, **kwargs: Any) -> None:
+        self._writer.flush()
+        with self._lock:
+            self._memory.clear()
+            self._conn.execute("DELETE FROM llm_cache")
+            self._conn.commit()
+
+
+@singleton
+def get_llm_cache() -> Optional[TwoTierLLMCache]:
+    """the process-wide cache, None if disabled"""
+    if not LLM_CACHE_ENABLED:
+        return None
+    return TwoTierLLMCache(os.path.join(LLM_CACHE_DIR, "llm_cache.sqlite3"))
@@ -1,39 +1,249 @@
 import os
+from typing import Optional
 
 from langchain_openai import OpenAIEmbeddings, ChatOpenAI
 
+from comm import http_client, llm_cache, tracing
+from comm.rate_limiter import ConcurrencyLimiter, RateGovernor
 from comm.util import singleton
 
-EMBED_MODEL_BATCH_SIZE = os.environ["EMBED_MODEL_BATCH_SIZE"] if "EMBED_MODEL_BATCH_SIZE" in os.environ else 32
+EMBED_MODEL_BATCH_SIZE = int(os.environ["EMBED_MODEL_BATCH_SIZE"]) if "EMBED_MODEL_BATCH_SIZE" in os.environ else 32
 MAX_CHAT_MODEL_INPUT_LENGTH = os.environ["MAX_CHAT_MODEL_INPUT_LENGTH"] \
     if "MAX_CHAT_MODEL_INPUT_LENGTH" in os.environ else 40960
+CHAT_MODEL_NAME = os.environ["CHAT_MODEL_NAME"] if "CHAT_MODEL_NAME" in os.environ else "gpt-4o-mini"
+# cheap, low latency model for the many yes/no classification calls
+FAST_CHAT_MODEL_NAME = os.environ["FAST_CHAT_MODEL_NAME"] if "FAST_CHAT_MODEL_NAME" in os.environ \
+    else CHAT_MODEL_NAME
+EMBED_TIMEOUT = float(os.environ.get("EMBED_TIMEOUT", 30))
+# process-wide limits of the model endpoint, 0 is unlimited
+LLM_REQUESTS_PER_MINUTE = float(os.environ.get("LLM_REQUESTS_PER_MINUTE", 0))
+LLM_TOKENS_PER_MINUTE = float(os.environ.get("LLM_TOKENS_PER_MINUTE", 0))
+# "openai" or "fake", fake serves deterministic local models / search / pages (see comm.fake_models)
+LLM_PROVIDER_MODE = os.environ.get("LLM_PROVIDER_MODE", "openai").lower()
+
+rate_governor = RateGovernor(LLM_REQUESTS_PER_MINUTE, LLM_TOKENS_PER_MINUTE)
+_encoding = None
+
+
+def _get_role_conf(role: str, model_name: str, timeout: float, max_tokens: Optional[int], max_concurrency: int,
+                   priority: str):
+    prefix = f"LLM_{role.upper()}_"
+    max_tokens = int(os.environ.get(prefix + "MAX_TOKENS", max_tokens or 0))
+    return {
+        "model_name": os.environ.get(prefix + "MODEL_NAME", model_name),
+        "timeout": float(os.environ.get(prefix + "TIMEOUT", timeout)),
+        "max_tokens": max_tokens or None,
+        "max_concurrency": int(os.environ.get(prefix + "MAX_CONCURRENCY", max_concurrency)),
+        "priority": os.environ.get(prefix + "PRIORITY", priority),
+    }
+
+
+# model role -> model name, request timeout (seconds), max output tokens, max concurrent calls (0 is unlimited),
+# rate limiter priority class. Each can be overridden by LLM_<ROLE>_MODEL_NAME / _TIMEOUT / _MAX_TOKENS /
+# _MAX_CONCURRENCY / _PRIORITY
+MODEL_ROLES = {
+    "router": _get_role_conf("router", FAST_CHAT_MODEL_NAME, 15, 100, 32, "interactive"),
+    "grader": _get_role_conf("grader", FAST_CHAT_MODEL_NAME, 15, 100, 32, "normal"),
+    "rewriter": _get_role_conf("rewriter", FAST_CHAT_MODEL_NAME, 20, 300, 16, "normal"),
+    "generator": _get_role_conf("generator", CHAT_MODEL_NAME, 120, 1024, 16, "interactive"),
+    "agent": _get_role_conf("agent", CHAT_MODEL_NAME, 120, 4096, 16, "interactive"),
+}
+_role_limiters = {role: ConcurrencyLimiter(conf["max_concurrency"]) for role, conf in MODEL_ROLES.items()}
+
+
+def _estimate_tokens(texts, max_output_tokens: Optional[int]) -> int:
+    # ~4 characters per token is close enough for rate limiting, settle() corrects it afterwards
+    return sum(len(t) if isinstance(t, str) else len(str(t)) for t in texts) // 4 + (max_output_tokens or 256)
+
+
+def _get_total_tokens(result) -> int:
+    return ((result.llm_output or {}).get("token_usage") or {}).get("total_tokens", 0)
+
+
+class RoleChatOpenAI(ChatOpenAI):
+    """
+    ChatOpenAI serving a model role.
+
+    A call first waits for the process-wide rate governor (priority of the role, fair per user_id taken
+    from the run metadata), then for a free concurrency slot of the role.
+    """
+
+    role: str = "generator"
+
+    def _get_rate_args(self, messages, run_manager):
+        metadata = (run_manager.metadata if run_manager else None) or {}
+        priority = metadata.get("llm_priority", MODEL_ROLES[self.role]["priority"])
+        tokens = _estimate_tokens([m.content for m in messages], self.max_tokens)
+        return priority, metadata.get("user_id", "default"), tokens
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        if self.streaming:
+            # delegates to _stream, which takes the slot
+            return super()._generate(messages, stop, run_manager, **kwargs)
+        priority, user, tokens = self._get_rate_args(messages, run_manager)
+        rate_governor.acquire(priority, user, tokens)
+        with _role_limiters[self.role]:
+            result = super()._generate(messages, stop, run_manager, **kwargs)
+        rate_governor.settle(tokens, _get_total_tokens(result))
+        return result
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        if self.streaming:
+            return await super()._agenerate(messages, stop, run_manager, **kwargs)
+        priority, user, tokens = self._get_rate_args(messages, run_manager)
+        await rate_governor.aacquire(priority, user, tokens)
+        async with _role_limiters[self.role]:
+            result = await super()._agenerate(messages, stop, run_manager, **kwargs)
+        rate_governor.settle(tokens, _get_total_tokens(result))
+        return result
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        priority, user, tokens = self._get_rate_args(messages, run_manager)
+        rate_governor.acquire(priority, user, tokens)
+        used = 0
+        with _role_limiters[self.role]:
+            for chunk in super()._stream(messages, stop, run_manager, **kwargs):
+                used = (getattr(chunk.message, "usage_metadata", None) or {}).get("total_tokens", used)
+                yield chunk
+        rate_governor.settle(tokens, used)
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs):
+        priority, user, tokens = self._get_rate_args(messages, run_manager)
+        await rate_governor.aacquire(priority, user, tokens)
+        used = 0
+        async with _role_limiters[self.role]:
+            async for chunk in super()._astream(messages, stop, run_manager, **kwargs):
+                used = (getattr(chunk.message, "usage_metadata", None) or {}).get("total_tokens", used)
+                yield chunk
+        rate_governor.settle(tokens, used)
+
+
+class RateLimitedOpenAIEmbeddings(OpenAIEmbeddings):
+    """OpenAIEmbeddings going through the rate governor, embed_query delegates to embed_documents"""
+
+    priority: str = "interactive"
+
+    def embed_documents(self, texts, *args, **kwargs):
+        rate_governor.acquire(self.priority, "default", _estimate_tokens(texts, 1))
+        return super().embed_documents(texts, *args, **kwargs)
+
+    async def aembed_documents(self, texts, *args, **kwargs):
+        await rate_governor.aacquire(self.priority, "default", _estimate_tokens(texts, 1))
+        return await super().aembed_documents(texts, *args, **kwargs)
+
+
+def _get_http_kwargs(timeout: float, role: str = "embedding") -> dict:
+    return {
+        "http_client": http_client.get_http_client(role),
+        "http_async_client": http_client.get_async_http_client(role),
+        "timeout": http_client.get_timeout(timeout),
+        # retries with jittered backoff are done by the shared transport
+        "max_retries": 0,
+    }
 
 
 @singleton
-def get_chat_model():
+def get_chat_model(role: str = "generator", cache: bool = False):
+    """
+    Get the chat model of a role.
+
+    Args:
+        role: one of MODEL_ROLES, router / grader / rewriter use the fast model, generator / agent the strong one
+        cache: answer repeated calls from the LLM response cache (comm.llm_cache), for deterministic chains
+
+    Returns:
+        the shared chat model instance of the role
+    """
+    role_conf = MODEL_ROLES[role]
+    response_cache = llm_cache.get_llm_cache() if cache else None
+    if is_fake_mode():
+        from comm.fake_models import FakeChatModel
+        return FakeChatModel(role=role, max_tokens=role_conf["max_tokens"], cache=response_cache,
+                             callbacks=[tracing.LLMCallbackHandler(role)])
     conf = _get_model_conf()
-    return ChatOpenAI(
-        model=conf["chat_model_name"],
+    return RoleChatOpenAI(
+        role=role,
+        model=role_conf["model_name"],
         base_url=conf["base_url"],
         api_key=conf["api_key"],
-        temperature=0
+        temperature=0,
+        max_tokens=role_conf["max_tokens"],
+        cache=response_cache,
+        callbacks=[tracing.LLMCallbackHandler(role)],
+        **_get_http_kwargs(role_conf["timeout"], role)
     )
 
 
 @singleton
-def get_embedding_model():
+def get_embedding_model(priority: str = "interactive"):
+    """
+    Get the embedding model.
+
+    Args:
+        priority: rate limiter priority class, "interactive" for queries, "background" for ingestion
+
+    Returns:
+        the shared embedding model instance of the priority
+    """
+    if is_fake_mode():
+        from comm.fake_models import FakeHashEmbeddings
+        return FakeHashEmbeddings()
     conf = _get_model_conf()
-    return OpenAIEmbeddings(
+    return RateLimitedOpenAIEmbeddings(
+        priority=priority,
         model=conf["embed_model_name"],
         base_url=conf["base_url"],
-        api_key=conf["api_key"]
+        api_key=conf["api_key"],
+        **_get_http_kwargs(EMBED_TIMEOUT)
     )
 
 
+def is_fake_mode() -> bool:
+    return LLM_PROVIDER_MODE == "fake"
+
+
+def count_tokens(text: str) -> int:
+    global _encoding
+    if is_fake_mode():
+        # offline runs can't download the tiktoken vocabulary, ~4 characters per token
+        return (len(text) + 3) // 4
+    if _encoding is None:
+        import tiktoken
+        _encoding = tiktoken.get_encoding("cl100k_base")
+    return len(_encoding.encode(text, disallowed_special=()))
+
+
+def get_search_tool(max_results: int = 5):
+    """web search tool, Tavily or the fake one"""
+    if is_fake_mode():
+        from comm.fake_models import get_fake_search_tool
+        return get_fake_search_tool(max_results)
+    from langchain_community.tools.tavily_search import TavilySearchResults
+    return TavilySearchResults(max_results=max_results)
+
+
+def load_web_pages(urls):
+    """load web pages as documents, fetched by WebBaseLoader or generated by the fake loader"""
+    if is_fake_mode():
+        from comm.fake_models import fake_load_web_pages
+        return fake_load_web_pages(urls)
+    from langchain_community.document_loaders import WebBaseLoader
+    return WebBaseLoader(urls).load()
+
+
+def load_web_html(urls) -> list:
+    """fetch web pages as (url, html) pairs, for the structure-aware chunking"""
+    if is_fake_mode():
+        from comm.fake_models import fake_load_web_html
+        return fake_load_web_html(urls)
+    from langchain_community.document_loaders import WebBaseLoader
+    return [(url, str(soup)) for url, soup in zip(urls, WebBaseLoader(urls).scrape_all(urls))]
+
+
 def _get_model_conf():
     return {
         "base_url": os.environ["MODEL_URL"],
         "api_key": os.environ["MODEL_API_KEY"],
         "embed_model_name": os.environ["EMBED_MODEL_NAME"] if "EMBED_MODEL_NAME" in os.environ else "text-embedding-ada-002",
-        "chat_model_name": os.environ["CHAT_MODEL_NAME"] if "CHAT_MODEL_NAME" in os.environ else "gpt-4o-mini"
+        "chat_model_name": CHAT_MODEL_NAME
     }
@@ -0,0 +1,152 @@
+"""
+Process metrics in the Prometheus data model.
+
+prometheus_client is used when installed, otherwise a small in-process implementation with the same
+counter / gauge / histogram api keeps the metrics, so the instrumented code never needs to check.
+"""
+import bisect
+import threading
+from typing import Dict, Optional, Sequence, Tuple
+
+try:
+    import prometheus_client
+except ImportError:
+    prometheus_client = None
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+CONTENT_TYPE = prometheus_client.CONTENT_TYPE_LATEST if prometheus_client else "text/plain; version=0.0.4; charset=utf-8"
+
+_metrics = {}
+_metrics_lock = threading.Lock()
+
+
+class _Child:
+    def __init__(self, metric):
+        self._metric = metric
+        self._lock = threading.Lock()
+        self.value = 0.0
+        self.sum = 0.0
+        self.bucket_counts = [0] * (len(metric.buckets) + 1) if metric.buckets else None
+
+    def inc(self, amount: float = 1):
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount: float = 1):
+        with self._lock:
+            self.value -= amount
+
+    def set(self, value: float):
+        with self._lock:
+            self.value = value
+
+    def observe(self, value: float):
+        with self._lock:
+            self.bucket_counts[bisect.bisect_left(self._metric.buckets, value)] += 1
+            self.sum += value
+            self.value += 1
+
+
+class _Metric:
+    def __init__(self, kind: str, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Optional[Sequence[float]] = None):
+        self.kind = kind
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets) if kind == "histogram" else None
+        self._children: Dict[Tuple[str, ...], _Child] = {}
+        self._lock = threading.Lock()
+
+    def labels(self, *values, **kwargs) -> _Child:
+        key = tuple(str(v) for v in values) or tuple(str(kwargs[n]) for n in self.labelnames)
+        child = self._children.get(key)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(key, _Child(self))
+        return child
+
+    def inc(self, amount: float = 1):
+        self.labels().inc(amount)
+
+    def dec(self, amount: float = 1):
+        self.labels().dec(amount)
+
+    def set(self, value: float):
+        self.labels().set(value)
+
+    def observe(self, value: float):
+        self.labels().observe(value)
+
+    def samples(self):
+        for key, child in list(self._children.items()):
+            labels = dict(zip(self.labelnames, key))
+            if self.kind == "counter":
+                yield f"{self.name}_total", labels, child.value
+            elif self.kind == "gauge":
+                yield self.name, labels, child.value
+            else:
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float("inf"),), child.bucket_counts):
+                    cumulative += count
+                    yield f"{self.name}_bucket", {**labels, "le": "+Inf" if bound == float("inf") else str(bound)}, \
+                        cumulative
+                yield f"{self.name}_sum", labels, child.sum
+                yield f"{self.name}_count", labels, child.value
+
+
+def _get_or_create(kind, name, documentation, labelnames, buckets=None):
+    with _metrics_lock:
+        if name not in _metrics:
+            if prometheus_client is None:
+                _metrics[name] = _Metric(kind, name, documentation, labelnames, buckets or DEFAULT_BUCKETS)
+            elif kind == "histogram":
+                _metrics[name] = prometheus_client.Histogram(name, documentation, labelnames,
+                                                             buckets=buckets or DEFAULT_BUCKETS)
+            else:
+                cls = prometheus_client.Counter if kind == "counter" else prometheus_client.Gauge
+                _metrics[name] = cls(name, documentation, labelnames)
+        return _metrics[name]
+
+
+def counter(name: str, documentation: str, labelnames: Sequence[str] = ()):
+    return _get_or_create("counter", name, documentation, labelnames)
+
+
+def gauge(name: str, documentation: str, labelnames: Sequence[str] = ()):
+    return _get_or_create("gauge", name, documentation, labelnames)
+
+
+def histogram(name: str, documentation: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = None):
+    return _get_or_create("histogram", name, documentation, labelnames, buckets)
+
+
+def _format_labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    values = {k: str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for k, v in labels.items()}
+    return "{" + ",".join(f'{k}="{v}"' for k, v in values.items()) + "}"
+
+
+def render() -> bytes:
+    """all metrics in the Prometheus text exposition format"""
+    if prometheus_client is not None:
+        return prometheus_client.generate_latest()
+    lines = []
+    for metric in list(_metrics.values()):
+        lines.append(f"# HELP {metric.name} {metric.documentation}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        for sample_name, labels, value in metric.samples():
+            lines.append(f"{sample_name}{_format_labels(labels)} {value}")
+    return ("\n".join(lines) + "\n").encode("utf-8")
+
+
+def get_sample_value(sample_name: str, labels: dict = None) -> Optional[float]:
+    """value of one sample, e.g. get_sample_value("llm_calls_total", {"role": "grader"})"""
+    if prometheus_client is not None:
+        return prometheus_client.REGISTRY.get_sample_value(sample_name, labels or {})
+    for metric in list(_metrics.values()):
+        for name, sample_labels, value in metric.samples():
+            if name == sample_name and sample_labels == (labels or {}):
+                return value
+    return None
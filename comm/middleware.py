@@ -0,0 +1,80 @@
+"""
+ASGI middleware recording per-route request metrics and profiling slow requests.
+
+Pure ASGI instead of BaseHTTPMiddleware, so streamed responses pass through untouched and the
+latency covers the whole stream.
+"""
+import logging
+import os
+import time
+
+from comm import metrics, tracing
+from comm.profiler import profiler
+
+SLOW_REQUEST_SECONDS = float(os.environ.get("SLOW_REQUEST_SECONDS", 10))
+STREAMING_PATHS = ("/ai/chat/ask", "/teams/chat/ask")
+
+_duration = metrics.histogram("http_request_duration_seconds", "HTTP request latency, streamed body included",
+                              ["method", "route", "status"])
+_response_size = metrics.histogram("http_response_size_bytes", "HTTP response body size", ["method", "route"],
+                                   buckets=(100, 1000, 10000, 100000, 1000000, 10000000))
+_active_streams = metrics.gauge("http_active_streams", "Streaming responses in progress", ["route"])
+_slow_requests = metrics.counter("http_slow_requests", "Requests slower than SLOW_REQUEST_SECONDS", ["route"])
+
+logger = tracing.get_logger("http")
+
+
+def _get_route(scope) -> str:
+    """route template of a matched request, parameters as {name} keep the label cardinality bounded"""
+    if scope.get("route") is None:
+        return "other"
+    # the route object lacks the prefix of included routers, so put the parameter names back into the path
+    params = {str(value): name for name, value in (scope.get("path_params") or {}).items()}
+    if not params:
+        return scope["path"]
+    return "/".join(f"{{{params[s]}}}" if s in params else s for s in scope["path"].split("/"))
+
+
+class MetricsMiddleware:
+    def __init__(self, app, streaming_paths=STREAMING_PATHS, slow_request_seconds: float = SLOW_REQUEST_SECONDS):
+        self.app = app
+        self.streaming_paths = set(streaming_paths)
+        self.slow_request_seconds = slow_request_seconds
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        method = scope["method"]
+        path = scope["path"]
+        streaming = path in self.streaming_paths
+        status = 500
+        size = 0
+        began = time.perf_counter()
+        session = profiler.start_request(method, path)
+        if streaming:
+            _active_streams.labels(path).inc()
+
+        async def send_wrapper(message):
+            nonlocal status, size
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            elif message["type"] == "http.response.body":
+                size += len(message.get("body", b""))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            elapsed = time.perf_counter() - began
+            if streaming:
+                _active_streams.labels(path).dec()
+            if session is not None:
+                profiler.finish_request(session, elapsed)
+            route = _get_route(scope)
+            _duration.labels(method, route, str(status)).observe(elapsed)
+            _response_size.labels(method, route).observe(size)
+            if elapsed >= self.slow_request_seconds:
+                _slow_requests.labels(route).inc()
+                tracing.log_event(logger, "slow_request", logging.WARNING, method=method, route=route,
+                                  status=status, seconds=round(elapsed, 3))
@@ -0,0 +1,139 @@
+"""
+Bounded background writer for fire-and-forget persistence.
+
+Writes are keyed (e.g. by user): a key is never written by two threads at once, so its writes land
+in order, and a write submitted while an older one of the same key is still queued replaces it, only
+the latest state is written. The number of queued keys is bounded, when full submit() blocks the
+caller up to PERSISTENCE_SUBMIT_TIMEOUT (policy "block") or drops the write (policy "drop").
+flush_all() is called from the app lifespan, so queued writes survive a graceful shutdown.
+"""
+import collections
+import logging
+import os
+import threading
+import time
+from typing import Callable, Hashable, List
+
+from comm import metrics, tracing
+
+PERSISTENCE_MAX_PENDING = int(os.environ.get("PERSISTENCE_MAX_PENDING", 1000))
+PERSISTENCE_SUBMIT_TIMEOUT = float(os.environ.get("PERSISTENCE_SUBMIT_TIMEOUT", 5))
+PERSISTENCE_FLUSH_TIMEOUT = float(os.environ.get("PERSISTENCE_FLUSH_TIMEOUT", 30))
+
+_queue_depth = metrics.gauge("persistence_queue_depth", "Writes waiting to be persisted", ["scheduler"])
+_write_seconds = metrics.histogram("persistence_write_seconds", "Duration of background writes", ["scheduler"])
+_write_errors = metrics.counter("persistence_write_errors", "Background writes that failed", ["scheduler"])
+_coalesced = metrics.counter("persistence_coalesced_writes", "Writes replaced by a newer one of the same key",
+                             ["scheduler"])
+_dropped = metrics.counter("persistence_dropped_writes", "Writes dropped because the queue was full",
+                           ["scheduler"])
+
+logger = tracing.get_logger("persistence")
+_schedulers: List["PersistenceScheduler"] = []
+
+
+class PersistenceScheduler:
+    def __init__(self, name: str, workers: int = 2, max_pending: int = PERSISTENCE_MAX_PENDING,
+                 policy: str = "block"):
+        self.name = name
+        self.max_pending = max_pending
+        self.policy = policy
+        self._cond = threading.Condition()
+        self._pending = collections.OrderedDict()  # key -> latest write, in submit order
+        self._running = set()
+        self._closed = False
+        self._threads = [threading.Thread(target=self._work, name=f"persistence-{name}-{i}", daemon=True)
+                         for i in range(workers)]
+        for thread in self._threads:
+            thread.start()
+        _schedulers.append(self)
+
+    def submit(self, key: Hashable, write: Callable[[], None]) -> bool:
+        """
+        Queue a write.
+
+        Args:
+            key: writes of the same key run in order, a queued one is replaced by the newer
+            write: the function doing the write
+
+        Returns:
+            False if the write was dropped, because the queue was full or the scheduler is closed
+        """
+        with self._cond:
+            if self._closed:
+                # a write of a scheduler closing later may still queue follow-up work, e.g. a summarization
+                tracing.log_event(logger, "write_after_close", logging.WARNING, scheduler=self.name, key=key)
+                return False
+            if key in self._pending:
+                self._pending[key] = write
+                _coalesced.labels(self.name).inc()
+                return True
+            if len(self._pending) >= self.max_pending:
+                if self.policy == "block":
+                    self._cond.wait_for(lambda: len(self._pending) < self.max_pending, PERSISTENCE_SUBMIT_TIMEOUT)
+                if len(self._pending) >= self.max_pending:
+                    _dropped.labels(self.name).inc()
+                    tracing.log_event(logger, "write_dropped", logging.ERROR, scheduler=self.name, key=key)
+                    return False
+            self._pending[key] = write
+            _queue_depth.labels(self.name).set(len(self._pending))
+            self._cond.notify_all()
+            return True
+
+    def _next(self):
+        """the oldest queued write whose key isn't being written, called with the lock held"""
+        for key in self._pending:
+            if key not in self._running:
+                self._running.add(key)
+                write = self._pending.pop(key)
+                _queue_depth.labels(self.name).set(len(self._pending))
+                return key, write
+        return None
+
+    def _work(self):
+        while True:
+            with self._cond:
+                item = None
+                while not self._closed or self._pending:
+                    item = self._next()
+                    if item is not None:
+                        break
+                    self._cond.wait()
+                if item is None:
+                    return
+            key, write = item
+            began = time.perf_counter()
+            try:
+                write()
+            except Exception as e:
+                _write_errors.labels(self.name).inc()
+                tracing.log_event(logger, "write_failed", logging.ERROR, scheduler=self.name, key=key, error=repr(e))
+            finally:
+                _write_seconds.labels(self.name).observe(time.perf_counter() - began)
+                with self._cond:
+                    self._running.discard(key)
+                    self._cond.notify_all()
+
+    def flush(self, timeout: float = PERSISTENCE_FLUSH_TIMEOUT) -> bool:
+        """wait until everything queued so far is written, False on timeout"""
+        with self._cond:
+            return self._cond.wait_for(lambda: not self._pending and not self._running, timeout)
+
+    def close(self, timeout: float = PERSISTENCE_FLUSH_TIMEOUT) -> bool:
+        """write what is queued and stop the workers"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        flushed = self.flush(timeout)
+        if not flushed:
+            tracing.log_event(logger, "flush_timeout", logging.ERROR, scheduler=self.name,
+                              pending=len(self._pending))
+        return flushed
+
+
+def close_all(timeout: float = PERSISTENCE_FLUSH_TIMEOUT):
+    """flush and stop all schedulers, called on app shutdown"""
+    deadline = time.monotonic() + timeout
+    # newest first, the writes of a scheduler submit to the ones created before it (history -> summary)
+    for scheduler in reversed(list(_schedulers)):
+        scheduler.close(max(0.0, deadline - time.monotonic()))
@@ -0,0 +1,156 @@
+"""
+Statistical sampling profiler for production use.
+
+A daemon thread samples the stacks of all threads with sys._current_frames() while at least one
+profiling session is open, so nothing runs when profiling is off and the overhead is bounded by
+PROFILER_SAMPLE_INTERVAL. Sessions are either a fixed time window of the whole process, or armed to
+follow requests and kept only when the request turned out slow.
+"""
+import collections
+import itertools
+import os
+import sys
+import threading
+import time
+from typing import Dict, List, Optional
+
+PROFILER_SAMPLE_INTERVAL = float(os.environ.get("PROFILER_SAMPLE_INTERVAL", 0.005))
+PROFILER_MAX_DEPTH = int(os.environ.get("PROFILER_MAX_DEPTH", 64))
+PROFILER_MAX_PROFILES = int(os.environ.get("PROFILER_MAX_PROFILES", 20))
+
+
+class ProfileSession:
+    def __init__(self, session_id: int, name: str):
+        self.id = session_id
+        self.name = name
+        self.started = time.time()
+        self.duration = 0.0
+        self.samples = 0
+        self.stacks: Dict[tuple, int] = collections.Counter()
+
+    def add(self, stacks: List[tuple]):
+        self.samples += 1
+        for stack in stacks:
+            self.stacks[stack] += 1
+
+    def summary(self) -> dict:
+        return {"id": self.id, "name": self.name, "started": self.started, "duration": round(self.duration, 3),
+                "samples": self.samples}
+
+    def collapsed(self) -> str:
+        """folded stacks, the input format of flamegraph.pl / speedscope"""
+        return "\n".join(f"{';'.join(stack)} {count}" for stack, count in self.stacks.most_common())
+
+    def top(self, limit: int = 30) -> List[dict]:
+        """functions by samples on the stack (inclusive) and on top of the stack (self)"""
+        inclusive = collections.Counter()
+        own = collections.Counter()
+        for stack, count in self.stacks.items():
+            for frame in set(stack):
+                inclusive[frame] += count
+            own[stack[-1]] += count
+        total = sum(self.stacks.values()) or 1
+        return [{"function": frame, "inclusive": round(count / total, 4), "self": round(own[frame] / total, 4)}
+                for frame, count in inclusive.most_common(limit)]
+
+
+def _frame_name(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class SamplingProfiler:
+    def __init__(self, interval: float = PROFILER_SAMPLE_INTERVAL, max_profiles: int = PROFILER_MAX_PROFILES):
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._active: Dict[int, ProfileSession] = {}
+        self._ids = itertools.count(1)
+        self._thread: Optional[threading.Thread] = None
+        self._wakeup = threading.Event()
+        # slow request capture, armed by arm()
+        self._armed_prefix: Optional[str] = None
+        self._armed_min_seconds = 0.0
+        self._armed_remaining = 0
+        self.profiles = collections.OrderedDict()
+        self._max_profiles = max_profiles
+
+    def _sample(self) -> List[tuple]:
+        me = threading.get_ident()
+        stacks = []
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == me:
+                continue
+            stack = []
+            while frame is not None and len(stack) < PROFILER_MAX_DEPTH:
+                stack.append(_frame_name(frame))
+                frame = frame.f_back
+            stack.reverse()
+            stacks.append(tuple(stack))
+        return stacks
+
+    def _run(self):
+        while True:
+            self._wakeup.wait()
+            with self._lock:
+                sessions = list(self._active.values())
+                if not sessions:
+                    self._wakeup.clear()
+                    continue
+            stacks = self._sample()
+            for session in sessions:
+                session.add(stacks)
+            time.sleep(self.interval)
+
+    def start(self, name: str) -> ProfileSession:
+        with self._lock:
+            session = ProfileSession(next(self._ids), name)
+            self._active[session.id] = session
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+                self._thread.start()
+            self._wakeup.set()
+        return session
+
+    def stop(self, session: ProfileSession, keep: bool = True) -> ProfileSession:
+        with self._lock:
+            self._active.pop(session.id, None)
+            session.duration = time.time() - session.started
+            if keep:
+                self.profiles[session.id] = session
+                while len(self.profiles) > self._max_profiles:
+                    self.profiles.popitem(last=False)
+        return session
+
+    def arm(self, path_prefix: str = "/", min_seconds: float = 1.0, count: int = 5):
+        """profile the next requests under path_prefix, keep the profiles of those taking >= min_seconds"""
+        with self._lock:
+            self._armed_prefix = path_prefix
+            self._armed_min_seconds = min_seconds
+            self._armed_remaining = count
+
+    def disarm(self):
+        with self._lock:
+            self._armed_prefix = None
+            self._armed_remaining = 0
+
+    def armed_state(self) -> dict:
+        return {"path_prefix": self._armed_prefix, "min_seconds": self._armed_min_seconds,
+                "remaining": self._armed_remaining}
+
+    def start_request(self, method: str, path: str) -> Optional[ProfileSession]:
+        """called for every request, cheap when not armed"""
+        if self._armed_prefix is None or not path.startswith(self._armed_prefix):
+            return None
+        return self.start(f"{method} {path}")
+
+    def finish_request(self, session: ProfileSession, elapsed: float):
+        slow = elapsed >= self._armed_min_seconds
+        self.stop(session, keep=slow)
+        if slow:
+            with self._lock:
+                self._armed_remaining -= 1
+                if self._armed_remaining <= 0:
+                    self._armed_prefix = None
+
+
+profiler = SamplingProfiler()
@@ -0,0 +1,167 @@
+import asyncio
+import heapq
+import itertools
+import threading
+import time
+
+from comm import metrics
+
+_POLL_INTERVAL = 0.01
+
+
+class ConcurrencyLimiter:
+    """
+    Limit the number of concurrent calls, usable from threads (with) and coroutines (async with).
+
+    Coroutines poll instead of blocking a thread, so waiting never stalls the event loop.
+    A limit <= 0 means unlimited.
+    """
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self._sem = threading.BoundedSemaphore(limit) if limit > 0 else None
+
+    def __enter__(self):
+        if self._sem is not None:
+            self._sem.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self._sem is not None:
+            self._sem.release()
+
+    async def __aenter__(self):
+        if self._sem is not None:
+            while not self._sem.acquire(blocking=False):
+                await asyncio.sleep(_POLL_INTERVAL)
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        self.__exit__(exc_type, exc_val, exc_tb)
+
+
+PRIORITIES = {"interactive": 0, "normal": 1, "background": 2}
+
+_wait_seconds = metrics.histogram("llm_rate_limit_wait_seconds", "Time LLM calls waited for the rate limiter",
+                                  ["priority"])
+_throttled = metrics.counter("llm_rate_limit_throttled", "LLM calls delayed by the rate limiter", ["priority"])
+_queue_depth = metrics.gauge("llm_rate_limit_queue_depth", "LLM calls waiting for the rate limiter")
+
+
+class TokenBucket:
+    def __init__(self, per_minute: float):
+        self.capacity = per_minute
+        self.tokens = per_minute
+        self._rate = per_minute / 60
+        self._updated = time.monotonic()
+
+    def refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self._rate)
+        self._updated = now
+
+    def time_until(self, amount: float) -> float:
+        """seconds until the bucket holds amount, assuming it was refilled just now"""
+        return max(0.0, (min(amount, self.capacity) - self.tokens) / self._rate)
+
+
+class RateGovernor:
+    """
+    Process-wide requests/min and tokens/min limiter for the LLM endpoint.
+
+    Waiting calls are served by priority class first (interactive > normal > background), within a class
+    users take turns by start-time fair queuing on their token usage, so one heavy user can't starve the others.
+    Token cost is estimated up front and corrected by settle() once the real usage is known.
+    A limit <= 0 disables that bucket.
+    """
+
+    def __init__(self, requests_per_minute: float, tokens_per_minute: float):
+        self._lock = threading.Lock()
+        self._requests = TokenBucket(requests_per_minute) if requests_per_minute > 0 else None
+        self._tokens = TokenBucket(tokens_per_minute) if tokens_per_minute > 0 else None
+        self._waiters = []  # heap of tickets (priority, virtual start, seq)
+        self._virtual_time = 0.0
+        self._user_finish = {}  # user -> virtual finish time of the user's last call
+        self._seq = itertools.count()
+
+    @property
+    def enabled(self) -> bool:
+        return self._requests is not None or self._tokens is not None
+
+    def _enqueue(self, priority: int, user: str, tokens: int):
+        with self._lock:
+            start = max(self._virtual_time, self._user_finish.get(user, 0.0))
+            self._user_finish[user] = start + max(tokens, 1)
+            ticket = (priority, start, next(self._seq))
+            heapq.heappush(self._waiters, ticket)
+            _queue_depth.set(len(self._waiters))
+            return ticket
+
+    def _dequeue(self, ticket):
+        with self._lock:
+            if ticket in self._waiters:
+                self._waiters.remove(ticket)
+                heapq.heapify(self._waiters)
+                _queue_depth.set(len(self._waiters))
+
+    def _try_acquire(self, ticket, tokens: int) -> float:
+        """consume the capacity if the ticket is first in line, otherwise return the seconds to wait"""
+        with self._lock:
+            if self._waiters[0] is not ticket:
+                return _POLL_INTERVAL
+            now = time.monotonic()
+            wait = 0.0
+            for bucket, amount in ((self._requests, 1), (self._tokens, tokens)):
+                if bucket is not None:
+                    bucket.refill(now)
+                    wait = max(wait, bucket.time_until(amount))
+            if wait > 0:
+                return wait
+            if self._requests is not None:
+                self._requests.tokens -= 1
+            if self._tokens is not None:
+                self._tokens.tokens -= min(tokens, self._tokens.capacity)
+            heapq.heappop(self._waiters)
+            _queue_depth.set(len(self._waiters))
+            self._virtual_time = ticket[1]
+            if len(self._user_finish) > 10000:
+                self._user_finish = {u: t for u, t in self._user_finish.items() if t > self._virtual_time}
+            return 0.0
+
+    def _observe(self, priority_name: str, waited: float):
+        _wait_seconds.labels(priority_name).observe(waited)
+        if waited > 0:
+            _throttled.labels(priority_name).inc()
+
+    def acquire(self, priority: str = "normal", user: str = "default", tokens: int = 1):
+        if not self.enabled:
+            return
+        began = time.monotonic()
+        ticket = self._enqueue(PRIORITIES.get(priority, 1), user, tokens)
+        try:
+            while (wait := self._try_acquire(ticket, tokens)) > 0:
+                time.sleep(min(wait, _POLL_INTERVAL * 10))
+        except BaseException:
+            self._dequeue(ticket)
+            raise
+        self._observe(priority, time.monotonic() - began)
+
+    async def aacquire(self, priority: str = "normal", user: str = "default", tokens: int = 1):
+        if not self.enabled:
+            return
+        began = time.monotonic()
+        ticket = self._enqueue(PRIORITIES.get(priority, 1), user, tokens)
+        try:
+            while (wait := self._try_acquire(ticket, tokens)) > 0:
+                await asyncio.sleep(min(wait, _POLL_INTERVAL * 10))
+        except BaseException:
+            self._dequeue(ticket)
+            raise
+        self._observe(priority, time.monotonic() - began)
+
+    def settle(self, estimated_tokens: int, actual_tokens: int):
+        """correct the tokens/min bucket with the real usage of a call"""
+        if self._tokens is None or not actual_tokens:
+            return
+        with self._lock:
+            self._tokens.tokens = min(self._tokens.capacity,
+                                      self._tokens.tokens + min(estimated_tokens, self._tokens.capacity) - actual_tokens)
@@ -0,0 +1,183 @@
+"""
+Wire format of the streamed chat answers.
+
+Graphs emit events as dicts, they are encoded once at the edge as NDJSON lines or SSE frames (orjson
+when installed) and small frames are coalesced within STREAM_COALESCE_SECONDS / STREAM_COALESCE_BYTES,
+so a fast token stream doesn't cost one HTTP chunk and one send syscall per token. A sync event source
+iterated in the threadpool is closed as soon as the response stops, e.g. on a client disconnect, so the
+graph run and its finally blocks end then instead of at garbage collection.
+"""
+import asyncio
+import contextlib
+import json
+import os
+import threading
+from typing import AsyncIterator, Iterable, Iterator
+
+import anyio
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+STREAM_COALESCE_SECONDS = float(os.environ.get("STREAM_COALESCE_SECONDS", 0.02))
+STREAM_COALESCE_BYTES = int(os.environ.get("STREAM_COALESCE_BYTES", 4096))
+
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+SSE_MEDIA_TYPE = "text/event-stream"
+TEXT_MEDIA_TYPE = "text/plain; charset=utf-8"
+
+_END = object()
+
+
+def dumps(obj) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def get_media_type(accept: str) -> str:
+    """SSE if the client asks for it, NDJSON otherwise"""
+    return SSE_MEDIA_TYPE if accept and SSE_MEDIA_TYPE in accept else NDJSON_MEDIA_TYPE
+
+
+def _close(iterable):
+    """close a generator, a for loop left by an exception doesn't"""
+    close = getattr(iterable, "close", None)
+    if close is not None:
+        close()
+
+
+def encode_events(events: Iterable[dict], media_type: str = NDJSON_MEDIA_TYPE) -> Iterator[bytes]:
+    try:
+        if media_type == SSE_MEDIA_TYPE:
+            for event in events:
+                yield b"event: " + event.get("type", "message").encode("utf-8") + b"\ndata: " + dumps(event) + b"\n\n"
+        else:
+            for event in events:
+                yield dumps(event) + b"\n"
+    finally:
+        _close(events)
+
+
+async def aencode_events(events: AsyncIterator[dict], media_type: str = NDJSON_MEDIA_TYPE) -> AsyncIterator[bytes]:
+    async for event in events:
+        for frame in encode_events((event,), media_type):
+            yield frame
+
+
+def encode_text(chunks: Iterable[str]) -> Iterator[bytes]:
+    try:
+        for chunk in chunks:
+            if chunk:
+                yield chunk.encode("utf-8")
+    finally:
+        _close(chunks)
+
+
+async def aencode_text(chunks: AsyncIterator[str]) -> AsyncIterator[bytes]:
+    async for chunk in chunks:
+        if chunk:
+            yield chunk.encode("utf-8")
+
+
+async def iterate_in_threadpool(iterator: Iterable) -> AsyncIterator:
+    """starlette's iterate_in_threadpool, closing the iterator in the threadpool when the iteration stops early"""
+    iterator = iter(iterator)
+    # a cancelled next() keeps running in its thread, the close waits for it
+    lock = threading.Lock()
+
+    def step():
+        with lock:
+            return next(iterator, _END)
+
+    def close():
+        with lock:
+            _close(iterator)
+
+    try:
+        while True:
+            item = await anyio.to_thread.run_sync(step)
+            if item is _END:
+                break
+            yield item
+    finally:
+        with anyio.CancelScope(shield=True):
+            await anyio.to_thread.run_sync(close)
+
+
+async def coalesce(frames: AsyncIterator[bytes], max_delay: float = STREAM_COALESCE_SECONDS,
+                   max_bytes: int = STREAM_COALESCE_BYTES) -> AsyncIterator[bytes]:
+    """
+    Merge frames into larger chunks.
+
+    Args:
+        frames: encoded frames
+        max_delay: seconds the first buffered frame may wait, <= 0 disables coalescing
+        max_bytes: flush as soon as this many bytes are buffered
+
+    Returns:
+        the merged chunks, the producer runs ahead in a task so a pending flush never waits for the next frame
+    """
+    if max_delay <= 0:
+        try:
+            async for frame in frames:
+                yield frame
+        finally:
+            if hasattr(frames, "aclose"):
+                await frames.aclose()
+        return
+
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue(maxsize=1024)
+
+    async def produce():
+        cancelled = False
+        try:
+            async for frame in frames:
+                await queue.put(frame)
+        except asyncio.CancelledError:
+            # the consumer is gone, nobody waits for the end and the queue may stay full
+            cancelled = True
+            raise
+        finally:
+            # cancelled at the put the frames generator is suspended at a yield, close it now
+            if hasattr(frames, "aclose"):
+                await frames.aclose()
+            if not cancelled:
+                await queue.put(_END)
+
+    task = asyncio.create_task(produce())
+    buffer = []
+    size = 0
+    deadline = 0.0
+    try:
+        while True:
+            timeout = max(0.0, deadline - loop.time()) if buffer else None
+            try:
+                frame = await asyncio.wait_for(queue.get(), timeout)
+            except asyncio.TimeoutError:
+                frame = None
+            if frame is _END:
+                break
+            if frame is not None:
+                if not buffer:
+                    deadline = loop.time() + max_delay
+                buffer.append(frame)
+                size += len(frame)
+                if size < max_bytes and loop.time() < deadline:
+                    continue
+            yield b"".join(buffer)
+            buffer = []
+            size = 0
+        if buffer:
+            yield b"".join(buffer)
+        # re-raise an error of the producer
+        await task
+    finally:
+        if not task.done():
+            task.cancel()
+            # wait until the producer has closed the frames generator
+            with contextlib.suppress(asyncio.CancelledError):
+                await task
@@ -0,0 +1,216 @@
+"""
+Instrumentation of the LangGraph pipelines.
+
+- trace_node: duration / errors of a graph node (or conditional edge)
+- LLMCallbackHandler: latency, input / output tokens and cache hits of every LLM call of a model role,
+  retries are counted per role by the transport of comm.http_client (http_client_retries)
+- record_decision / record_loop: routing decisions and loop iterations (e.g. generate_count) of a run
+
+Metrics go to comm.metrics (served on /metrics), spans to OpenTelemetry when opentelemetry-api is
+installed and TRACING_ENABLED, events to structured logs (LOG_FORMAT=text|json). log_event checks the
+log level first, so disabled events cost almost nothing.
+"""
+import asyncio
+import json
+import logging
+import os
+import sys
+import time
+from contextlib import nullcontext
+from functools import wraps
+from typing import Optional
+
+from langchain_core.callbacks import BaseCallbackHandler
+
+from comm import metrics
+
+try:
+    from opentelemetry import trace as otel_trace
+except ImportError:
+    otel_trace = None
+
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "text").lower()
+TRACING_ENABLED = os.environ.get("TRACING_ENABLED", "true").lower() == "true"
+
+_tracer = otel_trace.get_tracer("azure-server-python") if otel_trace is not None and TRACING_ENABLED else None
+
+_node_duration = metrics.histogram("graph_node_duration_seconds", "Duration of graph nodes", ["graph", "node"])
+_node_errors = metrics.counter("graph_node_errors", "Graph nodes raising an exception", ["graph", "node"])
+_decisions = metrics.counter("graph_decisions", "Routing decisions of graph nodes and edges",
+                             ["graph", "node", "decision"])
+_loop_iterations = metrics.histogram("graph_loop_iterations", "Loop iterations per graph run", ["graph", "loop"],
+                                     buckets=(0, 1, 2, 3, 4, 5, 8, 10, 15, 20))
+_llm_duration = metrics.histogram("llm_call_duration_seconds", "Latency of LLM calls", ["role"])
+_llm_calls = metrics.counter("llm_calls", "LLM calls", ["role", "status"])
+_llm_tokens = metrics.counter("llm_tokens", "LLM tokens", ["role", "direction"])
+
+
+class _StructuredFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        fields = getattr(record, "fields", None) or {}
+        if LOG_FORMAT == "json":
+            data = {"ts": round(record.created, 3), "level": record.levelname, "logger": record.name,
+                    "event": record.getMessage(), **fields}
+            if record.exc_info:
+                data["exc_info"] = self.formatException(record.exc_info)
+            return json.dumps(data, ensure_ascii=False, default=str)
+        line = super().format(record)
+        if fields:
+            line += " " + " ".join(f"{k}={v}" for k, v in fields.items())
+        return line
+
+
+def _setup_logging() -> logging.Logger:
+    root = logging.getLogger("app")
+    if not root.handlers:
+        handler = logging.StreamHandler(sys.stdout)
+        handler.setFormatter(_StructuredFormatter("%(asctime)s %(levelname)s %(name)s %(message)s"))
+        root.addHandler(handler)
+        root.setLevel(LOG_LEVEL)
+        root.propagate = False
+    return root
+
+
+_setup_logging()
+
+
+def get_logger(name: str) -> logging.Logger:
+    return logging.getLogger(f"app.{name}")
+
+
+def log_event(logger: logging.Logger, event: str, level: int = logging.INFO, **fields):
+    """log an event with key / value fields, nothing is formatted if the level is disabled"""
+    if logger.isEnabledFor(level):
+        logger.log(level, event, extra={"fields": fields})
+
+
+def span(name: str, attributes: dict = None):
+    """OpenTelemetry span as context manager, a no-op when tracing is disabled"""
+    if _tracer is None:
+        return nullcontext()
+    return _tracer.start_as_current_span(name, attributes=attributes)
+
+
+def trace_node(graph: str, node: str = None):
+    """
+    Decorator timing a graph node or conditional edge function, sync or async.
+
+    Args:
+        graph: graph name of the metric labels
+        node: node name, default is the function name
+
+    Returns:
+        the decorator
+    """
+    def decorator(func):
+        name = node or func.__name__
+        duration = _node_duration.labels(graph, name)
+
+        if asyncio.iscoroutinefunction(func):
+            @wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                began = time.perf_counter()
+                with span(f"{graph}.{name}"):
+                    try:
+                        return await func(*args, **kwargs)
+                    except Exception:
+                        _node_errors.labels(graph, name).inc()
+                        raise
+                    finally:
+                        duration.observe(time.perf_counter() - began)
+            return async_wrapper
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            began = time.perf_counter()
+            with span(f"{graph}.{name}"):
+                try:
+                    return func(*args, **kwargs)
+                except Exception:
+                    _node_errors.labels(graph, name).inc()
+                    raise
+                finally:
+                    duration.observe(time.perf_counter() - began)
+        return wrapper
+
+    return decorator
+
+
+def record_decision(graph: str, node: str, decision: str):
+    _decisions.labels(graph, node, decision).inc()
+
+
+def record_loop(graph: str, loop: str, iterations: int):
+    _loop_iterations.labels(graph, loop).observe(iterations)
+
+
+def get_token_usage(response) -> tuple:
+    """(input tokens, output tokens) of an LLMResult, streamed calls carry it on the message"""
+    for generations in response.generations or []:
+        for generation in generations:
+            usage = getattr(getattr(generation, "message", None), "usage_metadata", None)
+            if usage:
+                return usage.get("input_tokens", 0), usage.get("output_tokens", 0)
+    usage = (response.llm_output or {}).get("token_usage") or {}
+    return (usage.get("prompt_tokens", usage.get("input_tokens", 0)),
+            usage.get("completion_tokens", usage.get("output_tokens", 0)))
+
+
+class LLMCallbackHandler(BaseCallbackHandler):
+    """Records latency, token usage, errors and cache hits of the calls of a model role"""
+
+    # cheap enough to run on the caller, avoids an executor hop for async runs
+    run_inline = True
+
+    def __init__(self, role: str):
+        self.role = role
+        self._started = {}
+        self._spans = {}
+        self._logger = get_logger("llm")
+
+    def _start(self, run_id):
+        self._started[run_id] = time.perf_counter()
+        if _tracer is not None:
+            self._spans[run_id] = _tracer.start_span(f"llm.{self.role}", attributes={"llm.role": self.role})
+
+    def _end(self, run_id, status: str, input_tokens: int = 0, output_tokens: int = 0) -> Optional[float]:
+        began = self._started.pop(run_id, None)
+        elapsed = time.perf_counter() - began if began is not None else None
+        # a cache hit is no model call, its latency would skew the one of the role
+        if elapsed is not None and status != "cache_hit":
+            _llm_duration.labels(self.role).observe(elapsed)
+        _llm_calls.labels(self.role, status).inc()
+        otel_span = self._spans.pop(run_id, None)
+        if otel_span is not None:
+            otel_span.set_attribute("llm.status", status)
+            otel_span.set_attribute("llm.input_tokens", input_tokens)
+            otel_span.set_attribute("llm.output_tokens", output_tokens)
+            otel_span.end()
+        return elapsed
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, **kwargs):
+        self._start(run_id)
+
+    def on_llm_start(self, serialized, prompts, *, run_id, **kwargs):
+        self._start(run_id)
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        # imported here, llm_cache logs through this module
+        from comm import llm_cache
+        if llm_cache.is_cache_hit(response):
+            # the cached generation carries the usage of the original call, no tokens were used
+            elapsed = self._end(run_id, "cache_hit")
+            log_event(self._logger, "llm_cache_hit", logging.DEBUG, role=self.role, seconds=elapsed)
+            return
+        input_tokens, output_tokens = get_token_usage(response)
+        _llm_tokens.labels(self.role, "input").inc(input_tokens)
+        _llm_tokens.labels(self.role, "output").inc(output_tokens)
+        elapsed = self._end(run_id, "ok", input_tokens, output_tokens)
+        log_event(self._logger, "llm_call", logging.DEBUG, role=self.role, seconds=elapsed,
+                  input_tokens=input_tokens, output_tokens=output_tokens)
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        elapsed = self._end(run_id, "error")
+        log_event(self._logger, "llm_call_failed", logging.WARNING, role=self.role, seconds=elapsed,
+                  error=repr(error))
@@ -1,11 +1,15 @@
-from typing import Union, Literal
+from typing import List, Union, Literal, Optional
 
-from fastapi import APIRouter, Request
+from fastapi import APIRouter, HTTPException, Request
 from pydantic import BaseModel
+from starlette.concurrency import run_in_threadpool
 from starlette.responses import StreamingResponse
 
+import chroma_db
 import graph
-from auth.security import get_current_user, require_login
+import local_router
+from auth.security import get_current_user, require_login, require_permissions
+from comm import streaming
 
 router = APIRouter()
 
@@ -13,20 +17,39 @@ router = APIRouter()
 class QuestionRequest(BaseModel):
     question: str
     stream: Union[Literal["answer", "detail"], bool] = False
+    conversation_id: Optional[str] = None
+    # continue the interrupted run of the conversation, e.g. after a dropped connection
+    resume: bool = False
+
+
+class CollectionRequest(BaseModel):
+    urls: List[str] = []
+    # backend of a new collection, VECTOR_STORE_BACKEND by default
+    backend: Optional[Literal["chroma", "quantized"]] = None
+
+
+class TenantRequest(BaseModel):
+    collection_name: Optional[str] = None
 
 
 @router.post('/chat/ask')
 @require_login()
 async def ask_question(request: Request, question: QuestionRequest):
     current_user = await get_current_user(request)
-    if question.stream:
-        # def stream_generator():
-        #     for chunk in graph.stream_answer(question.question, current_user.id):
-        #         yield chunk
-        return StreamingResponse(graph.stream_answer(question.question, current_user.id),
-                                 media_type="application/json")
+    if question.stream == "detail":
+        # structured events, NDJSON or SSE by the Accept header
+        media_type = streaming.get_media_type(request.headers.get("accept", ""))
+        frames = streaming.encode_events(graph.stream_events(question.question, current_user.id,
+                                                             question.conversation_id, question.resume),
+                                         media_type)
+        return StreamingResponse(streaming.coalesce(streaming.iterate_in_threadpool(frames)), media_type=media_type)
+    elif question.stream:
+        frames = streaming.encode_text(graph.stream_answer(question.question, current_user.id,
+                                                           question.conversation_id, question.resume))
+        return StreamingResponse(streaming.coalesce(streaming.iterate_in_threadpool(frames)),
+                                 media_type=streaming.TEXT_MEDIA_TYPE)
     else:
-        answer = graph.answer(question.question, current_user.id)
+        answer = graph.answer(question.question, current_user.id, question.conversation_id, question.resume)
         return {"answer": answer, "status": "success"}
 
 
@@ -43,3 +66,57 @@ async def conversation(request: Request):
                 "answer": conversation_list[i + 1]["content"]
             })
     return ret
+
+
+### Knowledge base administration ###
+@router.get("/admin/collections")
+@require_permissions(["admin"])
+async def list_collections(request: Request):
+    return await run_in_threadpool(chroma_db.manager.list_collections)
+
+
+@router.post("/admin/collections/{collection_name}")
+@require_permissions(["admin"])
+async def populate_collection(request: Request, collection_name: str, collection: CollectionRequest):
+    """create the collection if needed and index the web pages into it"""
+    try:
+        await run_in_threadpool(chroma_db.manager.create_collection, collection_name, collection.backend)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    chunks = await run_in_threadpool(chroma_db.manager.add_websites, collection_name, collection.urls)
+    return {"collection_name": collection_name, "indexed_chunks": chunks}
+
+
+@router.delete("/admin/collections/{collection_name}")
+@require_permissions(["admin"])
+async def drop_collection(request: Request, collection_name: str):
+    if collection_name == chroma_db.DEFAULT_COLLECTION:
+        raise HTTPException(status_code=400, detail="The default collection can't be dropped")
+    if await run_in_threadpool(chroma_db.manager.get_collection, collection_name) is None:
+        raise HTTPException(status_code=404, detail="Collection not found")
+    await run_in_threadpool(chroma_db.manager.drop_collection, collection_name)
+    return {"status": "success"}
+
+
+@router.get("/admin/tenants")
+@require_permissions(["admin"])
+async def list_tenants(request: Request):
+    return chroma_db.manager.get_tenants()
+
+
+@router.put("/admin/tenants/{user_id}")
+@require_permissions(["admin"])
+async def assign_tenant(request: Request, user_id: str, tenant: TenantRequest):
+    """route the questions of a user to a collection, no collection routes back to the default one"""
+    if tenant.collection_name and \
+            await run_in_threadpool(chroma_db.manager.get_collection, tenant.collection_name) is None:
+        raise HTTPException(status_code=404, detail="Collection not found")
+    chroma_db.manager.assign(user_id, tenant.collection_name)
+    return {"user_id": user_id, "collection_name": chroma_db.manager.resolve_collection(user_id)}
+
+
+@router.get("/admin/router")
+@require_permissions(["admin"])
+async def router_stats(request: Request):
+    """decisions of the local embedding router and the routing LLM calls it saved since start"""
+    return local_router.router.stats()
@@ -0,0 +1,48 @@
+"""
+Fit the thresholds of the retrieval grader pre-filter (grade_filter.py) from the logged LLM grades.
+
+Usage:
+    python langgraph_adaptive_rag/calibrate_grader.py --precision 0.95
+    python langgraph_adaptive_rag/calibrate_grader.py --dry-run
+"""
+import argparse
+import collections
+import json
+import os
+import sys
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [os.path.dirname(HERE), HERE]
+
+import grade_filter  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--decisions", default=grade_filter.GRADER_DECISIONS_FILE, help="logged LLM grades")
+    parser.add_argument("--output", default=grade_filter.GRADER_THRESHOLDS_FILE, help="thresholds file to write")
+    parser.add_argument("--precision", type=float, default=0.95,
+                        help="share of the LLM grades a threshold decision must agree with")
+    parser.add_argument("--min-support", type=int, default=20, help="decisions needed beyond a threshold")
+    parser.add_argument("--dry-run", action="store_true", help="print the thresholds only")
+    args = parser.parse_args()
+
+    decisions = collections.defaultdict(list)
+    with open(args.decisions, "r", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                item = json.loads(line)
+                decisions[item["collection"]].append((item["score"], item["grade"], item.get("weight", 1.0)))
+    thresholds = {name: grade_filter.fit_thresholds(items, args.precision, args.min_support)
+                  for name, items in sorted(decisions.items())}
+    print(json.dumps(thresholds, indent=2))
+    if not args.dry_run:
+        tmp_path = args.output + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(thresholds, f, indent=2)
+        os.replace(tmp_path, args.output)
+        print(f"written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
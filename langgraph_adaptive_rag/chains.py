@@ -1,4 +1,4 @@
-from typing import Literal
+from typing import List, Literal
 
 from langchain_core.output_parsers import StrOutputParser
 from langchain_core.prompts import ChatPromptTemplate
@@ -58,7 +58,7 @@ class RouteQuery(BaseModel):
 
 def route_query_chain():
     # LLM with function call
-    llm = llm_provider.get_chat_model()
+    llm = llm_provider.get_chat_model("router", cache=True)
     # 0.3.27对with_structured_output没问题，0.3.33对with_structured_output有bug
     structured_llm_router = llm.with_structured_output(RouteQuery)
 
@@ -84,7 +84,7 @@ class GradeDocuments(BaseModel):
 
 def retrieval_grader_chain():
     # LLM with function call
-    llm = llm_provider.get_chat_model()
+    llm = llm_provider.get_chat_model("grader", cache=True)
     structured_llm_grader = llm.with_structured_output(GradeDocuments)
 
     # Prompt
@@ -106,7 +106,7 @@ def generate_answer_chain(streaming=True):
     # prompt = util.get_prompt_from_hub("rlm/rag-prompt")
     prompt = ChatPromptTemplate.from_template(GENERATE_PROMPT)
     # LLM
-    llm = llm_provider.get_chat_model()
+    llm = llm_provider.get_chat_model("generator")
     if streaming:
         llm = llm.bind(stream=streaming)
     return prompt | llm | StrOutputParser()
@@ -123,7 +123,7 @@ class GradeAnswer(BaseModel):
 
 def answer_grader_chain():
     # LLM with function call
-    llm = llm_provider.get_chat_model()
+    llm = llm_provider.get_chat_model("grader", cache=True)
     structured_llm_grader = llm.with_structured_output(GradeAnswer)
 
     # Prompt
@@ -150,7 +150,7 @@ class GradeHallucinations(BaseModel):
 
 def hallucination_grader_chain():
     # LLM with function call
-    llm = llm_provider.get_chat_model()
+    llm = llm_provider.get_chat_model("grader", cache=True)
     structured_llm_grader = llm.with_structured_output(GradeHallucinations)
 
     # Prompt
@@ -167,7 +167,7 @@ def hallucination_grader_chain():
 
 def question_rewriter_chain():
     # LLM
-    llm = llm_provider.get_chat_model()
+    llm = llm_provider.get_chat_model("rewriter", cache=True)
 
     # Prompt
     system = """You a question re-writer that converts an input question to a better version that is optimized \n 
@@ -183,3 +183,52 @@ def question_rewriter_chain():
     )
 
     return re_write_prompt | llm | StrOutputParser()
+
+
+# Data model
+class RewrittenQuestions(BaseModel):
+    """Diverse reformulations of a question for retrieval."""
+
+    questions: List[str] = Field(
+        description="Reformulations of the question, each from a different angle"
+    )
+
+
+def multi_query_rewriter_chain():
+    # LLM with function call
+    llm = llm_provider.get_chat_model("rewriter", cache=True)
+    structured_llm_rewriter = llm.with_structured_output(RewrittenQuestions)
+
+    # Prompt
+    system = """You a question re-writer that converts an input question to {count} different versions optimized \n 
+         for vectorstore retrieval. Reason about the underlying semantic intent / meaning and make the versions \n
+         diverse: use other keywords, synonyms, a more specific or a more general wording."""
+    re_write_prompt = ChatPromptTemplate.from_messages(
+        [
+            ("system", system),
+            (
+                "human",
+                "Here is the initial question: \n\n {question} \n Formulate {count} improved questions.",
+            ),
+        ]
+    )
+
+    return re_write_prompt | structured_llm_rewriter
+
+
+def conversation_summary_chain():
+    # LLM
+    llm = llm_provider.get_chat_model("rewriter")
+
+    # Prompt
+    system = """You maintain the running summary of a conversation between a user and an assistant. \n
+         Merge the new turns into the summary. Keep the facts, names, preferences and open questions the user \n
+         may refer to later, drop small talk. Answer with the updated summary only, at most {max_words} words."""
+    summary_prompt = ChatPromptTemplate.from_messages(
+        [
+            ("system", system),
+            ("human", "Summary so far: \n\n {summary} \n\n New turns: \n\n {turns}"),
+        ]
+    )
+
+    return summary_prompt | llm | StrOutputParser()
@@ -1,58 +1,371 @@
+import collections
+import hashlib
+import json
 import os
+import re
+import shutil
+import tempfile
+import threading
+import time
 
 import chromadb
-from langchain_community.document_loaders import WebBaseLoader
-from langchain_text_splitters import RecursiveCharacterTextSplitter
+import numpy as np
 from langchain_chroma import Chroma
 
-from comm import llm_provider
+import chunking
+from comm import llm_provider, metrics, tracing
+from quantized_store import QUANTIZED_IVF_MIN_VECTORS, QuantizedVectorStore
 
-CHUNK_SIZE = os.environ["EMBED_CHUNK_SIZE"] if "EMBED_CHUNK_SIZE" in os.environ else 500
-CHUNK_OVERLAP = os.environ["EMBED_CHUNK_OVERLAP"] if "EMBED_CHUNK_OVERLAP" in os.environ else 20
+logger = tracing.get_logger("chroma_db")
+
+# tokens, capped by chunking.EMBED_MODEL_MAX_TOKENS
+CHUNK_SIZE = int(os.environ["EMBED_CHUNK_SIZE"]) if "EMBED_CHUNK_SIZE" in os.environ else 500
+CHUNK_OVERLAP = int(os.environ["EMBED_CHUNK_OVERLAP"]) if "EMBED_CHUNK_OVERLAP" in os.environ else 20
+PERSIST_DIRECTORY = os.environ["CHROMA_PERSIST_DIRECTORY"] if "CHROMA_PERSIST_DIRECTORY" in os.environ \
+    else "./chroma_db"
+DEFAULT_COLLECTION = os.environ.get("DEFAULT_COLLECTION", "rag-chroma")
+VECTOR_STORE_CACHE_SIZE = int(os.environ.get("VECTOR_STORE_CACHE_SIZE", 32))
+VECTOR_STORE_IDLE_TIMEOUT = float(os.environ.get("VECTOR_STORE_IDLE_TIMEOUT", 1800))
+# backend of new collections: "chroma" (HNSW, float32 in memory) or "quantized" (int8, memory-mapped)
+VECTOR_STORE_BACKEND = os.environ.get("VECTOR_STORE_BACKEND", "chroma")
+VECTOR_STORE_BACKENDS = ("chroma", "quantized")
+QUANTIZED_DIRECTORY_NAME = "quantized"
+TENANTS_FILE_NAME = "tenants.json"
+COLLECTION_NAME_PATTERN = re.compile(r"^[a-zA-Z0-9][a-zA-Z0-9._-]{1,61}[a-zA-Z0-9]$")
+# search results cached per collection version, 0 disables the cache
+RETRIEVAL_CACHE_SIZE = int(os.environ.get("RETRIEVAL_CACHE_SIZE", 2048))
+# versions are per process, the TTL bounds how long another worker's ingestion stays unseen
+RETRIEVAL_CACHE_TTL = float(os.environ.get("RETRIEVAL_CACHE_TTL", 300))
+
+_retrieval_cache_lookups = metrics.counter("retrieval_cache_lookups", "Retrieval cache lookups by result", ["result"])
 
 
 def load_websites_to_index(collection_name, urls, chuck_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP,
-                           embed_model=None, persist_directory="./chroma_db"):
+                           embed_model=None, persist_directory=PERSIST_DIRECTORY) -> int:
     # Load
-    docs = [WebBaseLoader(url).load() for url in urls]
-    docs_list = [item for sublist in docs for item in sublist]
-    # Split
-    text_splitter = RecursiveCharacterTextSplitter.from_tiktoken_encoder(
-        chunk_size=chuck_size, chunk_overlap=chunk_overlap
-    )
-    doc_splits = text_splitter.split_documents(docs_list)
+    pages = llm_provider.load_web_html(urls)
+    # Split along headings / sections, in a process pool for large crawls
+    doc_splits = chunking.split_pages(pages, int(chuck_size), int(chunk_overlap))
     if embed_model is None:
-        embed_model = llm_provider.get_embedding_model()
+        # ingestion must not slow down interactive queries
+        embed_model = llm_provider.get_embedding_model("background")
+    store = manager.open_store(collection_name, embed_model, persist_directory)
     total_len = len(doc_splits)
     finished = 0
     while finished < total_len:
         batch = doc_splits[finished:min(finished + llm_provider.EMBED_MODEL_BATCH_SIZE, total_len)]
-        Chroma.from_documents(
-            documents=batch,
-            collection_name=collection_name,
-            embedding=embed_model,
-            persist_directory=persist_directory
-        )
+        if isinstance(store, QuantizedVectorStore):
+            # the store instance is shared with the searches, the batch is embedded by the ingestion model
+            texts = [doc.page_content for doc in batch]
+            store.add_embeddings(texts, embed_model.embed_documents(texts), [doc.metadata for doc in batch])
+        else:
+            store.add_documents(batch)
         finished = min(finished + llm_provider.EMBED_MODEL_BATCH_SIZE, total_len)
-    print(f"Finished loading {finished} docs")
+        # the new chunks are searchable, cached results are outdated
+        manager.bump_version(collection_name)
+    if isinstance(store, QuantizedVectorStore) and store.meta["nlist"] == 0 \
+            and store.count >= QUANTIZED_IVF_MIN_VECTORS:
+        store.build_index()
+        manager.bump_version(collection_name)
+    tracing.log_event(logger, "index_loaded", collection=collection_name, chunks=finished)
+    return finished
 
 
-def get_retriever(collection_name, embed_model=None, persist_directory="./chroma_db"):
-    if embed_model is None:
-        embed_model = llm_provider.get_embedding_model()
-    return Chroma(
-        collection_name=collection_name,
-        embedding_function=embed_model,
-        persist_directory=persist_directory
-    ).as_retriever()
-
-
-def get_collection(collection_name, persist_directory="./chroma_db"):
-    client = chromadb.PersistentClient(path=persist_directory)
-    try:
-        return client.get_collection(collection_name)
-    except Exception as e:
-        if "does not exist" in str(e):
+def _get_relevance_fn(collection):
+    """
+    distance of the collection's metric -> cosine similarity, the scale of the quantized store.
+
+    The embeddings are unit length: chroma's l2 is the squared euclidean distance (2 - 2 cos), its cosine
+    and ip distances are 1 - cos.
+    """
+    hnsw = (getattr(collection, "configuration", None) or {}).get("hnsw") or {}
+    space = hnsw.get("space") or (collection.metadata or {}).get("hnsw:space", "l2")
+    if space == "l2":
+        return lambda distance: 1.0 - distance / 2
+    if space in ("cosine", "ip"):
+        return lambda distance: 1.0 - distance
+    raise ValueError(f"unsupported distance metric {space} of collection {collection.name}")
+
+
+class VectorStoreManager:
+    """
+    Knowledge bases (Chroma collections) of all tenants.
+
+    Keeps one PersistentClient per directory and an LRU of vector stores per collection, idle ones are
+    evicted by evict_idle(). A collection is either a Chroma collection or a quantized index (see
+    quantized_store.py) in the "quantized" folder of the persist directory, chosen when it is created.
+    Users are routed to the collection of their tenant, unassigned users to DEFAULT_COLLECTION. The
+    assignments are stored in tenants.json of the persist directory.
+    Search results are cached in an LRU keyed by collection, collection version, query and k. Ingestion
+    bumps the version of a collection, so results cached before are never returned again.
+    A quantized collection has one store instance per process, searches and ingestions share its lock and
+    count, so concurrent writers append in turn. Writing one collection from several processes is not supported.
+    """
+
+    def __init__(self, persist_directory: str = PERSIST_DIRECTORY, cache_size: int = VECTOR_STORE_CACHE_SIZE):
+        self.persist_directory = persist_directory
+        self.cache_size = cache_size
+        self._lock = threading.RLock()
+        self._clients = {}
+        self._stores = collections.OrderedDict()  # collection -> (vector store, last used)
+        self._quantized = {}  # path -> QuantizedVectorStore, never evicted, the writers need the same instance
+        self._tenants = None
+        self._versions = collections.defaultdict(int)  # collection -> version
+        self._results = collections.OrderedDict()  # (collection, version, query key, k) -> (documents, cached)
+        self._results_lock = threading.Lock()
+
+    def get_client(self, persist_directory: str = None):
+        path = os.path.abspath(persist_directory or self.persist_directory)
+        with self._lock:
+            if path not in self._clients:
+                self._clients[path] = chromadb.PersistentClient(path=path)
+            return self._clients[path]
+
+    def _quantized_path(self, collection_name: str, persist_directory: str = None) -> str:
+        return os.path.join(persist_directory or self.persist_directory, QUANTIZED_DIRECTORY_NAME, collection_name)
+
+    def get_backend(self, collection_name: str, persist_directory: str = None) -> str:
+        if QuantizedVectorStore.exists(self._quantized_path(collection_name, persist_directory)):
+            return "quantized"
+        return "chroma"
+
+    def _get_quantized(self, collection_name: str, persist_directory: str = None) -> QuantizedVectorStore:
+        """the store instance of a quantized collection, created if needed"""
+        path = os.path.abspath(self._quantized_path(collection_name, persist_directory))
+        with self._lock:
+            store = self._quantized.get(path)
+            if store is None:
+                store = self._quantized[path] = QuantizedVectorStore(path, llm_provider.get_embedding_model())
+            return store
+
+    def open_store(self, collection_name: str, embed_model=None, persist_directory: str = None):
+        """the vector store of the collection, a quantized one is the shared instance with the default model"""
+        if self.get_backend(collection_name, persist_directory) == "quantized":
+            return self._get_quantized(collection_name, persist_directory)
+        embed_model = embed_model or llm_provider.get_embedding_model()
+        return Chroma(client=self.get_client(persist_directory), collection_name=collection_name,
+                      embedding_function=embed_model)
+
+    def get_vectorstore(self, collection_name: str):
+        with self._lock:
+            if collection_name in self._stores:
+                store, _ = self._stores.pop(collection_name)
+            else:
+                store = self.open_store(collection_name)
+            self._stores[collection_name] = (store, time.monotonic())
+            while len(self._stores) > self.cache_size:
+                self._stores.popitem(last=False)
+            return store
+
+    def get_retriever(self, collection_name: str = DEFAULT_COLLECTION, **kwargs):
+        return self.get_vectorstore(collection_name).as_retriever(**kwargs)
+
+    def get_version(self, collection_name: str) -> int:
+        with self._results_lock:
+            return self._versions[collection_name]
+
+    def bump_version(self, collection_name: str):
+        """invalidate the cached search results of the collection"""
+        with self._results_lock:
+            self._versions[collection_name] += 1
+            for key in [key for key in self._results if key[0] == collection_name]:
+                del self._results[key]
+
+    def _get_cached(self, key: tuple):
+        if RETRIEVAL_CACHE_SIZE <= 0:
             return None
+        with self._results_lock:
+            item = self._results.get(key)
+            if item is None or time.monotonic() - item[1] > RETRIEVAL_CACHE_TTL:
+                return None
+            self._results.move_to_end(key)
+        # copies, callers may change the metadata
+        return [doc.model_copy(update={"metadata": dict(doc.metadata)}) for doc in item[0]]
+
+    def _put_cached(self, key: tuple, documents: list):
+        if RETRIEVAL_CACHE_SIZE <= 0:
+            return
+        documents = [doc.model_copy(update={"metadata": dict(doc.metadata)}) for doc in documents]
+        with self._results_lock:
+            # a search that overlapped ingestion is cached under the old version, which is never asked again
+            self._results[key] = (documents, time.monotonic())
+            self._results.move_to_end(key)
+            while len(self._results) > RETRIEVAL_CACHE_SIZE:
+                self._results.popitem(last=False)
+
+    def search(self, collection_name: str, query: str, k: int = 4, embed_query=None) -> list:
+        """
+        The k nearest documents of a query text, cached by the normalized query.
+
+        Args:
+            collection_name: collection to search
+            query: the query text
+            k: number of documents
+            embed_query: function embedding the query, the default embedding model if None
+
+        Returns:
+            documents with their relevance score in metadata "relevance_score", a hot query needs neither
+            the embedding nor the vector search
+        """
+        key = (collection_name, self.get_version(collection_name), "query:" + " ".join(query.lower().split()), k)
+        documents = self._get_cached(key)
+        if documents is not None:
+            _retrieval_cache_lookups.labels("query_hit").inc()
+            return documents
+        embed_query = embed_query or llm_provider.get_embedding_model().embed_query
+        documents = self.search_by_vector(collection_name, embed_query(query), k)
+        self._put_cached(key, documents)
+        return documents
+
+    def search_by_vector(self, collection_name: str, embedding, k: int = 4) -> list:
+        """the k nearest documents, metadata "relevance_score" is their cosine similarity to the embedding"""
+        vector = np.asarray(embedding, dtype=np.float32)
+        key = (collection_name, self.get_version(collection_name),
+               "embedding:" + hashlib.sha1(vector.tobytes()).hexdigest(), k)
+        documents = self._get_cached(key)
+        if documents is not None:
+            _retrieval_cache_lookups.labels("embedding_hit").inc()
+            return documents
+        _retrieval_cache_lookups.labels("miss").inc()
+        documents = self._search_by_vector(collection_name, embedding, k)
+        self._put_cached(key, documents)
+        return documents
+
+    def _search_by_vector(self, collection_name: str, embedding, k: int) -> list:
+        store = self.get_vectorstore(collection_name)
+        if isinstance(store, QuantizedVectorStore):
+            results = store.similarity_search_by_vector_with_score(embedding, k)
         else:
-            raise e
+            # chroma returns distances of the collection's metric
+            relevance = _get_relevance_fn(self.get_collection(collection_name))
+            results = [(doc, relevance(distance))
+                       for doc, distance in store.similarity_search_by_vector_with_relevance_scores(embedding, k)]
+        for doc, score in results:
+            doc.metadata["relevance_score"] = float(score)
+        return [doc for doc, _ in results]
+
+    def evict_idle(self, max_idle: float = VECTOR_STORE_IDLE_TIMEOUT):
+        now = time.monotonic()
+        with self._lock:
+            for name in [n for n, (_, used) in self._stores.items() if now - used > max_idle]:
+                del self._stores[name]
+
+    def get_collection(self, collection_name: str, persist_directory: str = None):
+        """the Chroma collection, the QuantizedVectorStore for quantized ones, None if it doesn't exist"""
+        if self.get_backend(collection_name, persist_directory) == "quantized":
+            return self._get_quantized(collection_name, persist_directory)
+        try:
+            return self.get_client(persist_directory).get_collection(collection_name)
+        except Exception as e:
+            if "does not exist" in str(e):
+                return None
+            else:
+                raise e
+
+    def sample_embeddings(self, collection_name: str, limit: int = 2000):
+        """up to limit stored embeddings of the collection, e.g. for its centroid"""
+        collection = self.get_collection(collection_name)
+        if collection is None:
+            return []
+        if isinstance(collection, QuantizedVectorStore):
+            return collection.sample_vectors(limit)
+        embeddings = collection.get(limit=limit, include=["embeddings"])["embeddings"]
+        return [] if embeddings is None else embeddings
+
+    def list_collections(self) -> list[dict]:
+        ret = []
+        for item in self.get_client().list_collections():
+            # chromadb >= 0.6 returns names
+            collection = self.get_client().get_collection(item) if isinstance(item, str) else item
+            ret.append({"name": collection.name, "count": collection.count(), "backend": "chroma"})
+        quantized_root = os.path.join(self.persist_directory, QUANTIZED_DIRECTORY_NAME)
+        if os.path.isdir(quantized_root):
+            for name in sorted(os.listdir(quantized_root)):
+                if self.get_backend(name) == "quantized":
+                    store = self.get_vectorstore(name)
+                    ret.append({"name": name, "count": store.count, "backend": "quantized"})
+        return ret
+
+    def create_collection(self, collection_name: str, backend: str = None):
+        """create the collection if needed, backend None keeps the existing one or uses VECTOR_STORE_BACKEND"""
+        if not COLLECTION_NAME_PATTERN.match(collection_name):
+            raise ValueError("Collection name must be 3-63 characters of [a-zA-Z0-9._-], "
+                             "starting and ending with a letter or digit")
+        if backend is not None and backend not in VECTOR_STORE_BACKENDS:
+            raise ValueError(f"Backend must be one of {', '.join(VECTOR_STORE_BACKENDS)}")
+        with self._lock:
+            current = self.get_backend(collection_name)
+            if current == "chroma" and self.get_collection(collection_name) is None:
+                current = None
+            if current is not None and backend is not None and current != backend:
+                raise ValueError(f"Collection {collection_name} already exists with backend {current}")
+            backend = current or backend or VECTOR_STORE_BACKEND
+            if backend == "quantized":
+                return self._get_quantized(collection_name)
+            return self.get_client().get_or_create_collection(collection_name)
+
+    def add_websites(self, collection_name: str, urls: list[str], backend: str = None) -> int:
+        self.create_collection(collection_name, backend)
+        return load_websites_to_index(collection_name, urls, persist_directory=self.persist_directory)
+
+    def drop_collection(self, collection_name: str):
+        with self._lock:
+            self._stores.pop(collection_name, None)
+            if self.get_backend(collection_name) == "quantized":
+                self._quantized.pop(os.path.abspath(self._quantized_path(collection_name)), None)
+                shutil.rmtree(self._quantized_path(collection_name))
+            else:
+                self.get_client().delete_collection(collection_name)
+            self.bump_version(collection_name)
+            tenants = self._get_tenants()
+            for user_id in [u for u, c in tenants.items() if c == collection_name]:
+                del tenants[user_id]
+            self._save_tenants()
+
+    def _get_tenants(self) -> dict:
+        if self._tenants is None:
+            path = os.path.join(self.persist_directory, TENANTS_FILE_NAME)
+            if os.path.exists(path):
+                with open(path, "r", encoding="utf-8") as f:
+                    self._tenants = json.load(f)
+            else:
+                self._tenants = {}
+        return self._tenants
+
+    def _save_tenants(self):
+        os.makedirs(self.persist_directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.persist_directory, suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(self._tenants, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, os.path.join(self.persist_directory, TENANTS_FILE_NAME))
+
+    def get_tenants(self) -> dict:
+        with self._lock:
+            return dict(self._get_tenants())
+
+    def assign(self, user_id: str, collection_name: str = None):
+        """route the user to a collection, None routes it back to the default collection"""
+        with self._lock:
+            tenants = self._get_tenants()
+            if collection_name:
+                tenants[user_id] = collection_name
+            else:
+                tenants.pop(user_id, None)
+            self._save_tenants()
+
+    def resolve_collection(self, user_id: str = None) -> str:
+        with self._lock:
+            return self._get_tenants().get(user_id or "default", DEFAULT_COLLECTION)
+
+
+manager = VectorStoreManager()
+
+
+def get_retriever(collection_name, embed_model=None, persist_directory=PERSIST_DIRECTORY):
+    if embed_model is None and persist_directory == PERSIST_DIRECTORY:
+        return manager.get_retriever(collection_name)
+    return manager.open_store(collection_name, embed_model, persist_directory).as_retriever()
+
+
+def get_collection(collection_name, persist_directory=PERSIST_DIRECTORY):
+    return manager.get_collection(collection_name, persist_directory)
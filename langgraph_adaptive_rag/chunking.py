@@ -0,0 +1,218 @@
+"""
+Structure-aware splitting of web pages into chunks for the index.
+
+Pages are split along their HTML structure instead of the flat text: a chunk never spans two sections,
+paragraphs are only cut at sentence boundaries and code blocks (<pre>) only at line boundaries. Every
+chunk starts with its section path ("Title > Heading > Subheading") and stays within the token budget,
+which is capped by the embedding model's input window. The metadata records url, title, section path
+and the character offsets of the chunk in the extracted page text (the blocks joined by blank lines).
+Large crawls are split in a process pool, parsing and token counting are CPU bound.
+"""
+import multiprocessing
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, NamedTuple, Optional, Tuple
+
+from bs4 import BeautifulSoup, NavigableString, Tag
+from langchain_core.documents import Document
+
+from comm.llm_provider import count_tokens
+
+# input window of the embedding model, text-embedding-ada-002 / text-embedding-3-* take 8191 tokens
+EMBED_MODEL_MAX_TOKENS = int(os.environ.get("EMBED_MODEL_MAX_TOKENS", 8191))
+CHUNKING_WORKERS = int(os.environ.get("CHUNKING_WORKERS", os.cpu_count() or 1))
+# fewer pages are split in process, the pool start-up costs more than it saves
+CHUNKING_PROCESS_MIN_PAGES = int(os.environ.get("CHUNKING_PROCESS_MIN_PAGES", 8))
+SECTION_SEPARATOR = " > "
+
+HEADING_TAGS = ("h1", "h2", "h3", "h4", "h5", "h6")
+BLOCK_TAGS = ("p", "li", "pre", "table", "blockquote", "dt", "dd", "figcaption")
+SKIP_TAGS = ("script", "style", "noscript", "nav", "header", "footer", "aside", "form", "svg", "template")
+# text level tags, their text runs on with the text around them in the same block
+INLINE_TAGS = ("a", "abbr", "b", "bdi", "bdo", "br", "cite", "code", "data", "del", "dfn", "em", "i", "img", "ins",
+               "kbd", "label", "mark", "q", "s", "samp", "small", "span", "strong", "sub", "sup", "time", "u", "var",
+               "wbr")
+_SENTENCE = re.compile(r"\S.*?(?:[.!?]+(?=\s)|$)", re.S)
+_WORDS = re.compile(r"\S+")
+
+
+class Block(NamedTuple):
+    text: str
+    section: Tuple[str, ...]
+    code: bool
+
+
+class Unit(NamedTuple):
+    """piece of a block that is never cut, offsets are in the page text"""
+    text: str
+    start: int
+    end: int
+    code: bool
+    block: int
+
+
+def _join(units: List[Unit]) -> str:
+    """pieces of the same block joined by a space (a newline in code), blocks by a blank line"""
+    parts = []
+    for i, unit in enumerate(units):
+        if i:
+            parts.append(("\n" if unit.code else " ") if unit.block == units[i - 1].block else "\n\n")
+        parts.append(unit.text)
+    return "".join(parts)
+
+
+def _text(element: Tag, code: bool) -> str:
+    text = element.get_text()
+    return text.strip("\n") if code else " ".join(text.split())
+
+
+def extract_blocks(html: str) -> Tuple[str, List[Block]]:
+    """title and text blocks in document order, with the headings they are under"""
+    soup = BeautifulSoup(html, "html.parser")
+    title = " ".join(soup.title.get_text().split()) if soup.title else ""
+    blocks = []
+    headings = []  # (level, text)
+
+    def flush(inline: List[str]):
+        """the text run of a container up to a block, heading or nested container as one block"""
+        text = " ".join("".join(inline).split())
+        if text:
+            blocks.append(Block(text, tuple(h for _, h in headings), False))
+        inline.clear()
+
+    def walk(element: Tag):
+        inline = []
+        for child in element.children:
+            if isinstance(child, NavigableString):
+                # comments, doctype and CDATA are subclasses
+                if type(child) is NavigableString:
+                    inline.append(str(child))
+                continue
+            if not isinstance(child, Tag) or child.name in SKIP_TAGS:
+                continue
+            if child.name in INLINE_TAGS:
+                inline.append(" " if child.name == "br" else child.get_text())
+                continue
+            flush(inline)
+            if child.name in HEADING_TAGS:
+                level = int(child.name[1])
+                while headings and headings[-1][0] >= level:
+                    headings.pop()
+                text = _text(child, False)
+                if text:
+                    headings.append((level, text))
+            elif child.name in BLOCK_TAGS:
+                code = child.name == "pre"
+                text = _text(child, code)
+                if text:
+                    blocks.append(Block(text, tuple(h for _, h in headings), code))
+            else:
+                walk(child)
+        flush(inline)
+
+    walk(soup.body or soup)
+    return title, blocks
+
+
+def _split_units(text: str, start: int, code: bool, block: int, max_tokens: int) -> List[Unit]:
+    """the block as one unit if it fits, else sentences (lines of code), too long ones cut into words"""
+    if count_tokens(text) <= max_tokens:
+        return [Unit(text, start, start + len(text), code, block)]
+    pattern = re.compile(r".+", re.M) if code else _SENTENCE
+    units = []
+    for match in pattern.finditer(text):
+        piece = match.group().rstrip()
+        if not piece.strip():
+            continue
+        if count_tokens(piece) <= max_tokens:
+            units.append(Unit(piece, start + match.start(), start + match.start() + len(piece), code, block))
+            continue
+        words = list(_WORDS.finditer(piece))
+        # words are ~1-3 tokens, cut into windows of a safe word count
+        step = max(1, max_tokens // 3)
+        for i in range(0, len(words), step):
+            first, last = words[i], words[min(i + step, len(words)) - 1]
+            units.append(Unit(piece[first.start():last.end()], start + match.start() + first.start(),
+                              start + match.start() + last.end(), code, block))
+    return units
+
+
+def split_html(url: str, html: str, chunk_size: int, chunk_overlap: int) -> List[Document]:
+    """
+    Split a web page into chunks along its structure.
+
+    Args:
+        url: source of the page
+        html: the page
+        chunk_size: max tokens of a chunk, the section path included
+        chunk_overlap: tokens of trailing sentences repeated at the start of the next chunk of a section
+
+    Returns:
+        the chunks, with metadata source, title, section, start_index, end_index, chunk_index and tokens
+    """
+    chunk_size = min(chunk_size, EMBED_MODEL_MAX_TOKENS)
+    title, blocks = extract_blocks(html)
+    docs = []
+    offset = 0
+    pending: List[Unit] = []
+    pending_section: Optional[Tuple[str, ...]] = None
+
+    def emit(units: List[Unit], section: Tuple[str, ...]):
+        path = SECTION_SEPARATOR.join(s for s in (title,) + section if s)
+        body = _join(units)
+        content = f"{path}\n\n{body}" if path else body
+        docs.append(Document(page_content=content, metadata={
+            "source": url, "title": title, "section": SECTION_SEPARATOR.join(section),
+            "start_index": units[0].start, "end_index": units[-1].end, "chunk_index": len(docs),
+            "tokens": count_tokens(content)}))
+
+    def overlap(units: List[Unit]) -> List[Unit]:
+        """trailing text units of a full chunk that fit in chunk_overlap"""
+        ret = []
+        tokens = 0
+        for unit in reversed(units):
+            tokens += count_tokens(unit.text)
+            if unit.code or tokens > chunk_overlap:
+                break
+            ret.insert(0, unit)
+        # a chunk of only repeated text would add nothing
+        return ret if len(ret) < len(units) else []
+
+    for i, block in enumerate(blocks):
+        if block.section != pending_section:
+            if pending:
+                emit(pending, pending_section)
+            pending = []
+            pending_section = block.section
+        path = SECTION_SEPARATOR.join(s for s in (title,) + block.section if s)
+        budget = max(16, chunk_size - count_tokens(path) - 2)
+        for unit in _split_units(block.text, offset, block.code, i, budget):
+            if pending and count_tokens(_join(pending + [unit])) > budget:
+                emit(pending, pending_section)
+                pending = overlap(pending)
+                while pending and count_tokens(_join(pending + [unit])) > budget:
+                    pending.pop(0)
+            pending.append(unit)
+        offset += len(block.text) + 2
+    if pending:
+        emit(pending, pending_section)
+    return docs
+
+
+def _split_page(args) -> List[Document]:
+    return split_html(*args)
+
+
+def split_pages(pages: List[Tuple[str, str]], chunk_size: int, chunk_overlap: int,
+                workers: int = CHUNKING_WORKERS) -> List[Document]:
+    """split (url, html) pages, in a process pool for large crawls, chunks keep the page order"""
+    tasks = [(url, html, chunk_size, chunk_overlap) for url, html in pages]
+    if workers <= 1 or len(pages) < CHUNKING_PROCESS_MIN_PAGES:
+        results = map(_split_page, tasks)
+    else:
+        # no fork, the server is multi-threaded and a forked child can inherit locks held by other threads
+        with ProcessPoolExecutor(max_workers=min(workers, len(pages)),
+                                 mp_context=multiprocessing.get_context("forkserver")) as pool:
+            results = list(pool.map(_split_page, tasks, chunksize=max(1, len(tasks) // (workers * 4))))
+    return [doc for docs in results for doc in docs]
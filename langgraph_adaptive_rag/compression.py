@@ -0,0 +1,89 @@
+"""
+Context compression between retrieval and generation.
+
+Instead of every retrieved chunk verbatim, generation (and the hallucination grader) get the sentences
+most similar to the question: the sentences are embedded in one batch and scored against the query
+embedding the retrieval already computed, near duplicates across chunks are dropped and the selection
+stops at COMPRESSION_MAX_TOKENS. The kept sentences stay in their chunk, in their original order.
+"""
+import os
+import re
+from typing import List
+
+import numpy as np
+from langchain_core.documents import Document
+
+from comm import metrics
+from comm.llm_provider import count_tokens
+
+COMPRESSION_MAX_TOKENS = int(os.environ.get("COMPRESSION_MAX_TOKENS", 1200))
+# sentences this similar to a kept one are duplicates
+COMPRESSION_DEDUP_SIMILARITY = float(os.environ.get("COMPRESSION_DEDUP_SIMILARITY", 0.95))
+# sentences below are never kept, even when the budget isn't used up
+COMPRESSION_MIN_SIMILARITY = float(os.environ.get("COMPRESSION_MIN_SIMILARITY", 0.0))
+
+_SENTENCE = re.compile(r"\S.*?(?:[.!?]+(?=\s)|$)")
+
+_tokens = metrics.counter("context_compression_tokens", "Context tokens before and after compression",
+                          ["graph", "stage"])
+
+
+def split_sentences(text: str) -> List[str]:
+    return [m.group() for line in text.splitlines() for m in _SENTENCE.finditer(line)]
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    return vectors / np.maximum(np.linalg.norm(vectors, axis=-1, keepdims=True), 1e-12)
+
+
+def compress_documents(query_embedding: List[float], documents: List[Document], embed_model,
+                       max_tokens: int = COMPRESSION_MAX_TOKENS, graph: str = "adaptive_rag") -> List[Document]:
+    """
+    Reduce the documents to the sentences relevant to the query.
+
+    Args:
+        query_embedding: embedding of the question
+        documents: retrieved documents
+        embed_model: the embedding model of the query embedding
+        max_tokens: token budget of all kept sentences
+        graph: metric label
+
+    Returns:
+        the documents with only the kept sentences, documents without any are dropped; unchanged when
+        they fit in the budget already
+    """
+    total = sum(count_tokens(d.page_content) for d in documents)
+    _tokens.labels(graph, "input").inc(total)
+    if total <= max_tokens:
+        _tokens.labels(graph, "output").inc(total)
+        return documents
+
+    sentences = []  # (document index, sentence)
+    for i, doc in enumerate(documents):
+        sentences.extend((i, s) for s in split_sentences(doc.page_content))
+    if not sentences:
+        return documents
+    vectors = _normalize(np.asarray(embed_model.embed_documents([s for _, s in sentences]), dtype=np.float32))
+    scores = vectors @ _normalize(np.asarray(query_embedding, dtype=np.float32))
+
+    kept = []
+    used = 0
+    for j in np.argsort(-scores):
+        if scores[j] < COMPRESSION_MIN_SIMILARITY or used >= max_tokens:
+            break
+        tokens = count_tokens(sentences[j][1])
+        if used + tokens > max_tokens:
+            continue
+        if kept and float(np.max(vectors[kept] @ vectors[j])) >= COMPRESSION_DEDUP_SIMILARITY:
+            continue
+        kept.append(int(j))
+        used += tokens
+
+    ret = []
+    kept = set(kept)
+    for i, doc in enumerate(documents):
+        selected = [s for j, (d, s) in enumerate(sentences) if d == i and j in kept]
+        if selected:
+            ret.append(Document(page_content=" ".join(selected), metadata={**doc.metadata, "compressed": True}))
+    _tokens.labels(graph, "output").inc(used)
+    return ret
@@ -0,0 +1,139 @@
+"""
+Similarity pre-filter in front of the LLM retrieval grader.
+
+Retrieved chunks carry their relevance score (metadata "relevance_score"), the cosine similarity of the
+query and chunk embeddings in [-1, 1] whatever the vector store backend, the thresholds are on this scale.
+Chunks scoring at least the accept threshold are relevant, at most the reject threshold irrelevant,
+only the band in between is graded by the LLM. Every LLM grade is logged with its score to
+GRADER_DECISIONS_FILE, calibrate_grader.py fits the thresholds per collection from it and writes them
+to GRADER_THRESHOLDS_FILE. Without calibrated thresholds GRADER_ACCEPT_THRESHOLD /
+GRADER_REJECT_THRESHOLD apply, by default every chunk goes to the LLM. A GRADER_AUDIT_RATE sample of the
+chunks beyond the thresholds is graded by the LLM as well, logged with the weight 1 / GRADER_AUDIT_RATE,
+so a recalibration still sees the scores the thresholds decide and not only the band.
+"""
+import json
+import os
+import random
+import threading
+import time
+from typing import List, Optional, Tuple
+
+from comm import metrics, tracing
+
+GRADER_DATA_DIR = os.environ["GRADER_DATA_DIR"] if "GRADER_DATA_DIR" in os.environ else "_grader"
+GRADER_DECISIONS_FILE = os.path.join(GRADER_DATA_DIR, "decisions.jsonl")
+GRADER_THRESHOLDS_FILE = os.path.join(GRADER_DATA_DIR, "thresholds.json")
+GRADER_ACCEPT_THRESHOLD = float(os.environ.get("GRADER_ACCEPT_THRESHOLD", 2))
+GRADER_REJECT_THRESHOLD = float(os.environ.get("GRADER_REJECT_THRESHOLD", -2))
+# reload the thresholds file after this many seconds, so a new calibration applies without restart
+GRADER_THRESHOLDS_RELOAD = float(os.environ.get("GRADER_THRESHOLDS_RELOAD", 60))
+# share of the chunks beyond the thresholds graded by the LLM anyway, as calibration data
+GRADER_AUDIT_RATE = float(os.environ.get("GRADER_AUDIT_RATE", 0.05))
+
+RELEVANCE_SCORE_KEY = "relevance_score"
+
+logger = tracing.get_logger("grade_filter")
+_grades = metrics.counter("graph_retrieval_grades", "Retrieval grades by who decided", ["graph", "grader", "grade"])
+
+_lock = threading.Lock()
+_thresholds = {}
+_thresholds_loaded = 0.0
+
+
+def get_thresholds(collection_name: str) -> Tuple[float, float]:
+    """(accept, reject) thresholds of the collection"""
+    global _thresholds, _thresholds_loaded
+    now = time.monotonic()
+    if now - _thresholds_loaded > GRADER_THRESHOLDS_RELOAD:
+        try:
+            with open(GRADER_THRESHOLDS_FILE, "r", encoding="utf-8") as f:
+                _thresholds = json.load(f)
+        except FileNotFoundError:
+            _thresholds = {}
+        except (OSError, ValueError) as e:
+            tracing.log_event(logger, "thresholds_load_failed", error=repr(e))
+        _thresholds_loaded = now
+    item = _thresholds.get(collection_name) or {}
+    return item.get("accept", GRADER_ACCEPT_THRESHOLD), item.get("reject", GRADER_REJECT_THRESHOLD)
+
+
+def prefilter(score: Optional[float], collection_name: str, graph: str = "adaptive_rag") -> Optional[str]:
+    """
+    Grade a chunk by its relevance score.
+
+    Args:
+        score: relevance score of the chunk, None for chunks without (e.g. web results)
+        collection_name: collection the chunk was retrieved from
+        graph: metric label
+
+    Returns:
+        "yes" / "no", None if the LLM grader has to decide, as for the audit sample
+    """
+    if score is None:
+        return None
+    accept, reject = get_thresholds(collection_name)
+    if score >= accept:
+        grade = "yes"
+    elif score <= reject:
+        grade = "no"
+    else:
+        return None
+    if GRADER_AUDIT_RATE > 0 and random.random() < GRADER_AUDIT_RATE:
+        _grades.labels(graph, "audit", grade).inc()
+        return None
+    _grades.labels(graph, "threshold", grade).inc()
+    return grade
+
+
+def log_decision(score: Optional[float], collection_name: str, grade: str, graph: str = "adaptive_rag"):
+    """log a grade of the LLM as calibration data, an audited chunk stands for the ones the thresholds decided"""
+    _grades.labels(graph, "llm", grade).inc()
+    if score is None:
+        return
+    accept, reject = get_thresholds(collection_name)
+    item = {"collection": collection_name, "score": round(score, 6), "grade": grade, "time": time.time()}
+    if (score >= accept or score <= reject) and GRADER_AUDIT_RATE > 0:
+        item["weight"] = round(1 / GRADER_AUDIT_RATE, 6)
+    with _lock:
+        os.makedirs(GRADER_DATA_DIR, exist_ok=True)
+        with open(GRADER_DECISIONS_FILE, "a", encoding="utf-8") as f:
+            f.write(json.dumps(item) + "\n")
+
+
+def fit_thresholds(decisions: List[Tuple], precision: float = 0.95, min_support: int = 20) -> dict:
+    """
+    Fit the thresholds to LLM grades.
+
+    Args:
+        decisions: (score, grade) or (score, grade, weight) tuples, an audited grade weighs for the chunks
+            the thresholds decided without LLM
+        precision: weighted share of the LLM grades a threshold decision must agree with
+        min_support: decisions needed beyond a threshold
+
+    Returns:
+        accept / reject thresholds (missing if no threshold reaches the precision), the number of
+        decisions and the (weighted) share of them the thresholds decide without LLM
+    """
+    ranked = sorted(((d[0], d[1], d[2] if len(d) > 2 else 1.0) for d in decisions), key=lambda d: d[0],
+                    reverse=True)
+    ret = {"decisions": len(ranked)}
+    yes = total = 0.0
+    for i, (score, grade, weight) in enumerate(ranked, 1):
+        total += weight
+        yes += weight if grade == "yes" else 0.0
+        # the lowest score above which the grades are still precise enough, ties can't be split
+        if i >= min_support and yes / total >= precision and (i == len(ranked) or ranked[i][0] < score):
+            ret["accept"] = score
+    no = total = 0.0
+    for i, (score, grade, weight) in enumerate(reversed(ranked), 1):
+        total += weight
+        no += weight if grade == "no" else 0.0
+        if i >= min_support and no / total >= precision and (i == len(ranked) or ranked[-i - 1][0] > score):
+            ret["reject"] = score
+    if "accept" in ret and "reject" in ret and ret["reject"] >= ret["accept"]:
+        # overlapping bands only happen with conflicting grades, trust the LLM
+        del ret["accept"], ret["reject"]
+    decided = sum(weight for score, _, weight in ranked if score >= ret.get("accept", float("inf"))
+                  or score <= ret.get("reject", float("-inf")))
+    ret["threshold_share"] = round(decided / sum(weight for _, _, weight in ranked), 4) if ranked else 0.0
+    return ret
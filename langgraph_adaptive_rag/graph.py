@@ -1,17 +1,23 @@
-import json
+import functools
+import logging
 import os
-from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
 from typing import List, Iterator, Literal
 
 from langchain_core.documents import Document
 from typing_extensions import TypedDict
-from langchain_community.tools import TavilySearchResults
 from langgraph.graph import END, StateGraph, START
-from langgraph.config import get_stream_writer
+from langgraph.config import get_config, get_stream_writer
 
 import chroma_db
 import chains
-from comm import llm_provider
+import compression
+import grade_filter
+import local_router
+import memory
+from comm import budget, checkpoint, llm_provider, metrics, persistence, tracing
 
 os.environ["USER_AGENT"] = "my-rag-app/1.0.0 (contact: developer@example.com)"
 
@@ -25,22 +31,45 @@ def load_websites_to_index(collect_name):
             "https://lilianweng.github.io/posts/2023-03-15-prompt-engineering/",
             "https://lilianweng.github.io/posts/2023-10-25-adv-attack-llm/",
         ]
-        chroma_db.load_websites_to_index(collect_name, urls)
+        chroma_db.manager.add_websites(collect_name, urls)
 
 
-collect_name = "rag-chroma"
+collect_name = chroma_db.DEFAULT_COLLECTION
 load_websites_to_index(collect_name)
-retriever = chroma_db.get_retriever(collect_name)
 question_router = chains.route_query_chain()
 retrieval_grader = chains.retrieval_grader_chain()
 generator = chains.generate_answer_chain()
 answer_grader = chains.answer_grader_chain()
 hallucination_grader = chains.hallucination_grader_chain()
 question_rewriter = chains.question_rewriter_chain()
-web_search_tool = TavilySearchResults(k=3)
-CONVERSATION_HISTORY_STORE_FILE_DIR = "_conversation_history"
-CONVERSATION_HISTORY_STORE_FILE_NAME_PATTERN = "dialogue_%s.json"
-_executor = ThreadPoolExecutor(max_workers=3)
+multi_query_rewriter = chains.multi_query_rewriter_chain()
+web_search_tool = llm_provider.get_search_tool(max_results=3)
+_history_writer = persistence.PersistenceScheduler("conversation_history", workers=3)
+# compress the retrieved documents to the relevant sentences before generating, see compression.py
+CONTEXT_COMPRESSION = os.environ.get("CONTEXT_COMPRESSION", "false").lower() == "true"
+RETRIEVE_TOP_K = int(os.environ.get("RETRIEVE_TOP_K", 4))
+# start retrieval (and optionally the web search) while the question is routed, see route_question()
+SPECULATIVE_RETRIEVAL = os.environ.get("SPECULATIVE_RETRIEVAL", "true").lower() == "true"
+SPECULATIVE_WEB_SEARCH = os.environ.get("SPECULATIVE_WEB_SEARCH", "false").lower() == "true"
+SPECULATIVE_WORKERS = int(os.environ.get("SPECULATIVE_WORKERS", 8))
+# prefetched results not taken within this time are dropped
+SPECULATIVE_TTL = float(os.environ.get("SPECULATIVE_TTL", 60))
+# rewrite a failed vectorstore question to several ones retrieved together, see transform_query()
+MULTI_QUERY_REWRITE = os.environ.get("MULTI_QUERY_REWRITE", "false").lower() == "true"
+MULTI_QUERY_COUNT = int(os.environ.get("MULTI_QUERY_COUNT", 3))
+# fused chunks passed to the grader
+MULTI_QUERY_TOP_K = int(os.environ.get("MULTI_QUERY_TOP_K", 6))
+# rank constant of the reciprocal rank fusion
+MULTI_QUERY_RRF_K = int(os.environ.get("MULTI_QUERY_RRF_K", 60))
+MULTI_QUERY_WORKERS = int(os.environ.get("MULTI_QUERY_WORKERS", 8))
+GRAPH_NAME = "adaptive_rag"
+logger = tracing.get_logger(GRAPH_NAME)
+_speculative_executor = ThreadPoolExecutor(max_workers=SPECULATIVE_WORKERS, thread_name_prefix="speculative")
+_multi_query_executor = ThreadPoolExecutor(max_workers=MULTI_QUERY_WORKERS, thread_name_prefix="multi_query")
+_speculative_lock = threading.Lock()
+_speculative = {}  # (datasource, collection, question) -> (future, started)
+_speculative_outcomes = metrics.counter("graph_speculative_prefetches", "Speculative prefetches by outcome",
+                                        ["graph", "datasource", "outcome"])
 
 
 # Post-processing
@@ -55,6 +84,102 @@ def format_docs(docs):
     return "\n\n".join(ret)
 
 
+@functools.lru_cache(maxsize=1024)
+def _embed_query(question: str) -> tuple:
+    return tuple(llm_provider.get_embedding_model().embed_query(question))
+
+
+def embed_query(question: str) -> List[float]:
+    """query embedding, cached so retrieval and compression of a question embed it once"""
+    return list(_embed_query(question))
+
+
+def _retrieve_documents(collection_name: str, question: str) -> List[Document]:
+    """the nearest chunks, with their relevance score for the grader pre-filter, cached per collection version"""
+    return chroma_db.manager.search(collection_name, question, k=RETRIEVE_TOP_K, embed_query=embed_query)
+
+
+def _retrieve_fused(collection_name: str, questions: List[str]) -> List[Document]:
+    """
+    Retrieve for all questions concurrently and fuse the results by reciprocal rank.
+
+    Args:
+        collection_name: collection to retrieve from
+        questions: reformulations of the question
+
+    Returns:
+        the best MULTI_QUERY_TOP_K chunks, deduplicated by chunk id, with the best relevance score of a chunk
+    """
+    futures = [_multi_query_executor.submit(_retrieve_documents, collection_name, q) for q in questions]
+    fused = {}  # chunk id -> [fusion score, document]
+    for future in futures:
+        for rank, doc in enumerate(future.result()):
+            key = doc.id or doc.page_content
+            item = fused.setdefault(key, [0.0, doc])
+            item[0] += 1.0 / (MULTI_QUERY_RRF_K + rank + 1)
+            score = doc.metadata.get(grade_filter.RELEVANCE_SCORE_KEY)
+            best = item[1].metadata.get(grade_filter.RELEVANCE_SCORE_KEY)
+            if score is not None and (best is None or score > best):
+                item[1] = doc
+    ranked = sorted(fused.values(), key=lambda item: item[0], reverse=True)[:MULTI_QUERY_TOP_K]
+    tracing.log_event(logger, "retrieve_fused", logging.DEBUG, questions=len(questions), chunks=len(fused),
+                      kept=len(ranked))
+    return [doc for _, doc in ranked]
+
+
+def _search_web(question: str) -> List[Document]:
+    docs = web_search_tool.invoke({"query": question})
+    return [Document(page_content=d["content"] if "content" in d else str(d)) for d in docs]
+
+
+def _speculate(datasource: str, collection_name: str, question: str):
+    """start the work of a datasource in the background, before the route is known"""
+    now = time.monotonic()
+    key = (datasource, collection_name, question)
+    with _speculative_lock:
+        for stale in [k for k, (_, started) in _speculative.items() if now - started > SPECULATIVE_TTL]:
+            _speculative.pop(stale)[0].cancel()
+            _speculative_outcomes.labels(GRAPH_NAME, stale[0], "expired").inc()
+        if key in _speculative:
+            return
+        if datasource == "vectorstore":
+            future = _speculative_executor.submit(_retrieve_documents, collection_name, question)
+        else:
+            future = _speculative_executor.submit(_search_web, question)
+        _speculative[key] = (future, now)
+
+
+def _take_speculative(datasource: str, collection_name: str, question: str) -> Future:
+    """the prefetch of the datasource, None if there is none"""
+    with _speculative_lock:
+        item = _speculative.pop((datasource, collection_name, question), None)
+    return item[0] if item else None
+
+
+def _discard_speculative(datasource: str, collection_name: str, question: str):
+    future = _take_speculative(datasource, collection_name, question)
+    if future is not None:
+        # a started one can't be cancelled, its result is dropped
+        future.cancel()
+        _speculative_outcomes.labels(GRAPH_NAME, datasource, "discarded").inc()
+
+
+def _get_prefetched(datasource: str, collection_name: str, question: str) -> List[Document]:
+    """result of the prefetch, None if there is none or it failed"""
+    future = _take_speculative(datasource, collection_name, question)
+    if future is None:
+        return None
+    try:
+        documents = future.result()
+    except Exception as e:
+        _speculative_outcomes.labels(GRAPH_NAME, datasource, "failed").inc()
+        tracing.log_event(logger, "speculative_prefetch_failed", logging.WARNING, datasource=datasource,
+                          error=repr(e))
+        return None
+    _speculative_outcomes.labels(GRAPH_NAME, datasource, "used").inc()
+    return documents
+
+
 # Graph State class
 class GraphState(TypedDict):
     """
@@ -71,9 +196,17 @@ class GraphState(TypedDict):
     datasource: Literal["vectorstore", "web_search", "generate_directly"]
     generation: str
     documents: List[str]
+    queries: List[str]  # reformulations retrieved together, set by a multi-query transform_query
     generate_count: int  # generate times
     max_generate_count: int
+    generation_grade: str  # decision of the last grade_generation
+    # best graded generation of the run, the answer when the request budget runs out
+    best_generation: str
+    best_generate_id: int
+    best_score: int  # -1 while no generation was graded
     conversation_history: List[dict]  # store conversation history
+    conversation_summary: str  # summary of the older messages, see memory.py
+    summarized_seq: int  # seq of the last message in the summary
     max_context_length: int  # the max length of context
     user_id: str   # user id to isolate context
 
@@ -91,11 +224,15 @@ def get_coverage_history_txt(state: GraphState, question_len: int, prompt_len: i
     Returns:
         The conversation history text
     """
-    conversation_history = state.get("conversation_history", [])
+    # older messages are in the summary, only the recent ones go verbatim
+    conversation_history = memory.get_prompt_messages(state.get("conversation_history", []),
+                                                      state.get("summarized_seq", -1))
+    summary = state.get("conversation_summary", "")
+    summary_txt = f"Summary of the earlier conversation: {summary}\n" if summary else ""
     conversation_history_txt = ""
-    max_len = llm_provider.MAX_CHAT_MODEL_INPUT_LENGTH - question_len - prompt_len - docs_txt_len
+    max_len = llm_provider.MAX_CHAT_MODEL_INPUT_LENGTH - question_len - prompt_len - docs_txt_len - len(summary_txt)
     if conversation_history and max_len > 0:
-        filter_conversation_history = state.get("conversation_history", []).copy()
+        filter_conversation_history = conversation_history.copy()
         while calculate_context_length(filter_conversation_history) > max_len:
             if len(filter_conversation_history) > 2:
                 filter_conversation_history = filter_conversation_history[2:]
@@ -107,7 +244,7 @@ def get_coverage_history_txt(state: GraphState, question_len: int, prompt_len: i
                     f"Turn {i//2 + 1} [{item['role']}]: {item['content']}"
                     for i, item in enumerate(filter_conversation_history)
                 ])
-    return conversation_history_txt
+    return summary_txt + conversation_history_txt
 
 
 def add_qa_pair_to_context(state: GraphState) -> List[dict]:
@@ -124,13 +261,16 @@ def add_qa_pair_to_context(state: GraphState) -> List[dict]:
     history = state.get("conversation_history", []).copy()
 
     # 添加新的问答对
+    seq = memory.next_seq(history)
     history.append({
         "role": "user",
-        "content": state["org_question"]
+        "content": state["org_question"],
+        "seq": seq
     })
     history.append({
         "role": "assistant",
-        "content": state["generation"]
+        "content": state["generation"],
+        "seq": seq + 1
     })
 
     while calculate_context_length(history) > llm_provider.MAX_CHAT_MODEL_INPUT_LENGTH and len(history) > 2:
@@ -156,6 +296,7 @@ def calculate_context_length(history: List[dict]) -> int:
 
 
 ### Graph Nodes ###
+@tracing.trace_node(GRAPH_NAME)
 def retrieve(state):
     """
     Retrieve documents
@@ -166,17 +307,26 @@ def retrieve(state):
     Returns:
         state (dict): New key added to state, documents, that contains retrieved documents
     """
-    print("---RETRIEVE---")
     question = state["question"]
+    collection_name = chroma_db.manager.resolve_collection(state.get("user_id"))
+    tracing.log_event(logger, "retrieve", logging.DEBUG, collection=collection_name)
     stream_writer = get_stream_writer()
     generation_id = state.get("generate_count", 0)
-    stream_writer(f"{{\"type\": \"retrieve\", \"generate_id\": {generation_id}}}")
+    stream_writer({"type": "retrieve", "generate_id": generation_id})
+
+    queries = state.get("queries") or []
+    if len(queries) > 1:
+        documents = _retrieve_fused(collection_name, queries)
+        return {"documents": documents, "question": question, "datasource": "vectorstore", "queries": []}
 
-    # Retrieval
-    documents = retriever.invoke(question)
+    # Retrieval, started by route_question already if speculative
+    documents = _get_prefetched("vectorstore", collection_name, question)
+    if documents is None:
+        documents = _retrieve_documents(collection_name, question)
     return {"documents": documents, "question": question, "datasource": "vectorstore"}
 
 
+@tracing.trace_node(GRAPH_NAME)
 def generate(state):
     """
     Generate answer
@@ -187,7 +337,7 @@ def generate(state):
     Returns:
         state (dict): New key added to state, generation, that contains LLM generation
     """
-    print("---GENERATE---")
+    tracing.log_event(logger, "generate", logging.DEBUG)
     question = state["question"]
     documents = state["documents"]
 
@@ -197,6 +347,7 @@ def generate(state):
     return {"documents": documents, "question": question, "generation": generation}
 
 
+@tracing.trace_node(GRAPH_NAME, "generate")
 def stream_generate(state):
     """
     Generate answer in streaming
@@ -207,7 +358,6 @@ def stream_generate(state):
     Returns:
         state (dict): New key added to state, generation, that contains LLM generation
     """
-    print("---GENERATE (Streaming)---")
     question = state["question"]
     documents = state["documents"] if "documents" in state else []
     org_question = state.get("org_question", question)
@@ -218,16 +368,17 @@ def stream_generate(state):
     collected = []
     stream_writer = get_stream_writer()
     generate_count = state.get("generate_count", 0) + 1
-    stream_writer(f"{{\"type\": \"start\", \"generate_id\": {generate_count}}}")
+    stream_writer({"type": "start", "generate_id": generate_count})
     for chunk in generator.stream({"context": docs_txt, "question": question, "history": history_txt}):
         # streaming:
-        stream_writer(f"{{\"type\": \"chunk\", \"generate_id\": {generate_count}, \"content\": \"{chunk}\"}}")
+        stream_writer({"type": "chunk", "generate_id": generate_count, "content": chunk})
         collected.append(chunk)
     datasource = state.get("datasource", "generate_directly")
     return {"documents": documents, "question": question, "datasource": datasource, "generation": "".join(collected),
-            "generate_count": generate_count, "max_generate_count": 15, "org_question": org_question}
+            "generate_count": generate_count, "org_question": org_question}
 
 
+@tracing.trace_node(GRAPH_NAME)
 def grade_documents(state):
     """
     Determines whether the retrieved documents are relevant to the question.
@@ -239,26 +390,57 @@ def grade_documents(state):
         state (dict): Updates documents key with only filtered relevant documents
     """
 
-    print("---CHECK DOCUMENT RELEVANCE TO QUESTION---")
     question = state["question"]
     documents = state["documents"]
+    collection_name = chroma_db.manager.resolve_collection(state.get("user_id"))
+    request_budget = _get_budget()
 
-    # Score each doc
+    # Score each doc, confident relevance scores are decided without LLM
     filtered_docs = []
     for d in documents:
-        score = retrieval_grader.invoke(
-            {"question": question, "document": d.page_content}
-        )
-        grade = score.binary_score
+        relevance_score = d.metadata.get(grade_filter.RELEVANCE_SCORE_KEY)
+        grade = grade_filter.prefilter(relevance_score, collection_name, GRAPH_NAME)
+        if grade is None and request_budget is not None and request_budget.exhausted():
+            # no budget left to grade, the last generation uses the documents as retrieved
+            grade = "yes"
+        elif grade is None:
+            score = retrieval_grader.invoke(
+                {"question": question, "document": d.page_content}
+            )
+            grade = score.binary_score
+            grade_filter.log_decision(relevance_score, collection_name, grade, GRAPH_NAME)
+        tracing.record_decision(GRAPH_NAME, "grade_documents", grade)
         if grade == "yes":
-            print("---GRADE: DOCUMENT RELEVANT---")
             filtered_docs.append(d)
         else:
-            print("---GRADE: DOCUMENT NOT RELEVANT---")
             continue
+    tracing.log_event(logger, "grade_documents", logging.DEBUG, relevant=len(filtered_docs), total=len(documents))
     return {"documents": filtered_docs, "question": question}
 
 
+@tracing.trace_node(GRAPH_NAME)
+def compress_context(state):
+    """
+    Compress the documents to the sentences relevant to the question.
+
+    Args:
+        state (dict): The current graph state
+
+    Returns:
+        state (dict): Updates documents key with the compressed documents
+    """
+    question = state["question"]
+    documents = state["documents"] if "documents" in state else []
+    if not documents:
+        return {"documents": documents}
+    compressed = compression.compress_documents(embed_query(question), documents,
+                                                llm_provider.get_embedding_model(), graph=GRAPH_NAME)
+    tracing.log_event(logger, "compress_context", logging.DEBUG, documents=len(documents), kept=len(compressed))
+    # keep the originals if nothing was similar enough
+    return {"documents": compressed or documents}
+
+
+@tracing.trace_node(GRAPH_NAME)
 def transform_query(state):
     """
     Transform the query to produce a better question.
@@ -270,15 +452,24 @@ def transform_query(state):
         state (dict): Updates question key with a re-phrased question
     """
 
-    print("---TRANSFORM QUERY---")
     question = state["question"]
     documents = state["documents"] if "documents" in state else []
 
+    if MULTI_QUERY_REWRITE and state.get("datasource") == "vectorstore":
+        # several reformulations in one call, retrieved together in one round
+        rewritten = multi_query_rewriter.invoke({"question": question, "count": MULTI_QUERY_COUNT}).questions
+        queries = list(dict.fromkeys(q.strip() for q in rewritten if q.strip()))[:MULTI_QUERY_COUNT]
+        if queries:
+            tracing.log_event(logger, "transform_query", logging.DEBUG, question=question, queries=queries)
+            return {"documents": documents, "question": queries[0], "queries": queries}
+
     # Re-write question
     better_question = question_rewriter.invoke({"question": question})
+    tracing.log_event(logger, "transform_query", logging.DEBUG, question=question, better_question=better_question)
     return {"documents": documents, "question": better_question}
 
 
+@tracing.trace_node(GRAPH_NAME)
 def web_search(state):
     """
     Web search based on the re-phrased question.
@@ -290,15 +481,16 @@ def web_search(state):
         state (dict): Updates documents key with appended web results
     """
 
-    print("---WEB SEARCH---")
+    tracing.log_event(logger, "web_search", logging.DEBUG)
     question = state["question"]
     stream_writer = get_stream_writer()
     generation_id = state.get("generate_count", 0)
-    stream_writer(f"{{\"type\": \"search\", \"generate_id\": {generation_id}}}")
+    stream_writer({"type": "search", "generate_id": generation_id})
 
-    # Web search
-    docs = web_search_tool.invoke({"query": question})
-    documents = [Document(page_content=d["content"] if "content" in d else str(d)) for d in docs]
+    # Web search, started by route_question already if speculative
+    documents = _get_prefetched("web_search", "", question)
+    if documents is None:
+        documents = _search_web(question)
     return {"documents": documents, "question": question, "datasource": "web_search"}
 
 
@@ -316,21 +508,36 @@ def store_conversation(state):
     user_id = state.get("user_id", "default")
 
     def save_to_file():
-        print("---Store CONVERSATION---")
-        try:
-            os.makedirs(CONVERSATION_HISTORY_STORE_FILE_DIR, exist_ok=True)
-            store_path = os.path.join(CONVERSATION_HISTORY_STORE_FILE_DIR,
-                                      CONVERSATION_HISTORY_STORE_FILE_NAME_PATTERN % user_id)
-            # update history
-            with open(store_path, 'w', encoding='utf-8') as f:
-                json.dump(history, f, ensure_ascii=False, indent=2)
-        except Exception as e:
-            print(f"Error saving conversation history: {e}")
-    # async store history to file
-    _executor.submit(save_to_file)
+        # keeps the summary of the file, older messages are summarized in the background
+        memory.write_history(user_id, history)
+    # async store history to file, writes of a user are ordered and only the latest is written
+    _history_writer.submit(user_id, save_to_file)
+
+
+@tracing.trace_node(GRAPH_NAME)
+def finish_with_best(state):
+    """
+    Finish with the best graded generation when the request budget is used up.
+
+    Args:
+        state (dict): The current graph state
+
+    Returns:
+        state (dict): Updates generation key with the best generation so far
+    """
+    request_budget = _get_budget()
+    current = state.get("generate_count", 0)
+    generation = state["best_generation"] if state.get("best_score", -1) >= 0 else state.get("generation", "")
+    stream_writer = get_stream_writer()
+    stream_writer({"type": "budget_exhausted", "generate_id": current, "reason": request_budget.reason,
+                   "best_generate_id": state.get("best_generate_id", 0), "content": generation})
+    _finish_run("budget_" + request_budget.reason, current)
+    store_conversation({**state, "generation": generation})
+    return {"generation": generation}
 
 
 ### Edges ###
+@tracing.trace_node(GRAPH_NAME)
 def route_question(state):
     """
     Route question to web search or RAG.
@@ -342,23 +549,41 @@ def route_question(state):
         str: Next node to call
     """
 
-    print("---ROUTE QUESTION---")
     question = state["question"]
     stream_writer = get_stream_writer()
-    stream_writer(f"{{\"type\": \"init\", \"generate_id\": 0}}")
-    history_txt = get_coverage_history_txt(state, len(question), len(chains.ROUTE_PROMPT), 0)
-    source = question_router.invoke({"question": question, "history": history_txt})
-    if source.datasource == "web_search":
-        print("---ROUTE QUESTION TO WEB SEARCH---")
+    stream_writer({"type": "init", "generate_id": 0})
+    collection_name = chroma_db.manager.resolve_collection(state.get("user_id"))
+    # clear cases are routed by the question embedding, which retrieval needs anyway
+    datasource = None
+    if local_router.LOCAL_ROUTER:
+        datasource = local_router.router.route(embed_query(question), collection_name)
+    if datasource is None:
+        # overlap the retrieval with the routing LLM call, most questions go to the vectorstore
+        if SPECULATIVE_RETRIEVAL:
+            _speculate("vectorstore", collection_name, question)
+        if SPECULATIVE_WEB_SEARCH:
+            _speculate("web_search", "", question)
+        history_txt = get_coverage_history_txt(state, len(question), len(chains.ROUTE_PROMPT), 0)
+        try:
+            datasource = question_router.invoke({"question": question, "history": history_txt}).datasource
+        finally:
+            if datasource != "vectorstore":
+                _discard_speculative("vectorstore", collection_name, question)
+            if datasource != "web_search":
+                _discard_speculative("web_search", "", question)
+        if local_router.LOCAL_ROUTER:
+            local_router.router.learn(question, embed_query(question), collection_name, datasource)
+    tracing.record_decision(GRAPH_NAME, "route_question", datasource)
+    tracing.log_event(logger, "route_question", logging.DEBUG, datasource=datasource)
+    if datasource == "web_search":
         return "web_search"
-    elif source.datasource == "vectorstore":
-        print("---ROUTE QUESTION TO RAG---")
+    elif datasource == "vectorstore":
         return "vectorstore"
-    elif source.datasource == "generate_directly":
-        print("---ROUTE QUESTION TO GENERATE DIRECTLY---")
+    elif datasource == "generate_directly":
         return "generate_directly"
 
 
+@tracing.trace_node(GRAPH_NAME)
 def decide_to_generate(state):
     """
     Determines whether to generate an answer, or re-generate a question.
@@ -370,22 +595,26 @@ def decide_to_generate(state):
         str: Binary decision for next node to call
     """
 
-    print("---ASSESS GRADED DOCUMENTS---")
     filtered_documents = state["documents"] if "documents" in state else []
+    request_budget = _get_budget()
 
+    if request_budget is not None and request_budget.exhausted():
+        # no more query rewrites, answer with the best generation or generate a last one
+        decision = "finish_with_best" if state.get("best_score", -1) >= 0 else "generate"
+        tracing.record_decision(GRAPH_NAME, "decide_to_generate", decision)
+        return decision
     if not filtered_documents:
         # All documents have been filtered check_relevance
         # We will re-generate a new query
-        print(
-            "---DECISION: ALL DOCUMENTS ARE NOT RELEVANT TO QUESTION, TRANSFORM QUERY---"
-        )
+        tracing.record_decision(GRAPH_NAME, "decide_to_generate", "transform_query")
         return "transform_query"
     else:
         # We have relevant documents, so generate answer
-        print("---DECISION: GENERATE---")
+        tracing.record_decision(GRAPH_NAME, "decide_to_generate", "generate")
         return "generate"
 
 
+@tracing.trace_node(GRAPH_NAME, "grade_generation")
 def grade_generation_v_documents_and_question(state):
     """
     Determines whether the generation is grounded in the document and answers question.
@@ -394,17 +623,24 @@ def grade_generation_v_documents_and_question(state):
         state (dict): The current graph state
 
     Returns:
-        str: Decision for next node to call
+        state (dict): Updates generation_grade key with the decision for next node to call and the best
+        generation keys if the generation is graded better than the previous ones
     """
-    limit = state["max_generate_count"]
+    limit = state.get("max_generate_count", budget.REQUEST_BUDGET_GENERATIONS)
     current = state["generate_count"]
     stream_writer = get_stream_writer()
+    request_budget = _get_budget()
+    if request_budget is not None and request_budget.exhausted():
+        # out of budget before grading, the generation competes ungraded
+        stream_writer({"type": "end", "generate_id": current})
+        return {"generation_grade": "finish_with_best", **_record_generation(state, current, 0)}
     if current >= limit:
         # 发送终止标记
-        stream_writer(f"{{\"type\": \"final\", \"generate_id\": {current}}}")
-        print("---Reach the generate limit, return---")
+        stream_writer({"type": "final", "generate_id": current})
+        tracing.log_event(logger, "generate_limit_reached", logging.WARNING, generate_count=current)
+        _finish_run("limit", current)
         store_conversation(state)
-        return "useful"
+        return {"generation_grade": "useful"}
 
     question = state["question"]
     documents = state["documents"]
@@ -413,36 +649,59 @@ def grade_generation_v_documents_and_question(state):
     if state["datasource"] == "generate_directly":
         grade = "yes"
     else:
-        print("---CHECK HALLUCINATIONS---")
         score = hallucination_grader.invoke(
-            {"documents": documents, "generation": generation}
+            {"documents": format_docs(documents), "generation": generation}
         )
         grade = score.binary_score
 
     # Check hallucination
     if grade == "yes":
-        if state["datasource"] != "generate_directly":
-            print("---DECISION: GENERATION IS GROUNDED IN DOCUMENTS---")
         # Check question-answering
-        print("---GRADE GENERATION vs QUESTION---")
         score = answer_grader.invoke({"question": question, "generation": generation})
         grade = score.binary_score
         if grade == "yes":
             # 发送终止标记
-            stream_writer(f"{{\"type\": \"final\", \"generate_id\": {current}}}")
-            print("---DECISION: GENERATION ADDRESSES QUESTION---")
+            stream_writer({"type": "final", "generate_id": current})
+            _finish_run("useful", current)
             store_conversation(state)
-            return "useful"
+            return {"generation_grade": "useful"}
         else:
             # 发送结束标记
-            stream_writer(f"{{\"type\": \"end\", \"generate_id\": {current}}}")
-            print("---DECISION: GENERATION DOES NOT ADDRESS QUESTION---")
-            return "not useful"
+            stream_writer({"type": "end", "generate_id": current})
+            tracing.record_decision(GRAPH_NAME, "grade_generation", "not useful")
+            # grounded but not answering, better than not grounded
+            return {"generation_grade": _loop_or_finish("not useful"), **_record_generation(state, current, 1)}
     else:
         # 发送结束标记
-        stream_writer(f"{{\"type\": \"end\", \"generate_id\": {current}}}")
-        print("---DECISION: GENERATION IS NOT GROUNDED IN DOCUMENTS, RE-TRY---")
-        return "not supported"
+        stream_writer({"type": "end", "generate_id": current})
+        tracing.record_decision(GRAPH_NAME, "grade_generation", "not supported")
+        return {"generation_grade": _loop_or_finish("not supported"), **_record_generation(state, current, 0)}
+
+
+def _record_generation(state, generate_id: int, score: int) -> dict:
+    """state update keeping the generation if it's graded better than the previous ones, ties keep the earlier"""
+    if score > state.get("best_score", -1):
+        return {"best_generation": state["generation"], "best_generate_id": generate_id, "best_score": score}
+    return {}
+
+
+def _loop_or_finish(decision: str) -> str:
+    """the loop decision, or finish_with_best if the grading used up the request budget"""
+    request_budget = _get_budget()
+    if request_budget is not None and request_budget.exhausted():
+        return "finish_with_best"
+    return decision
+
+
+def _get_budget() -> budget.RequestBudget:
+    """budget of the running request, None outside of stream_events() / answer()"""
+    return budget.from_config(get_config())
+
+
+def _finish_run(outcome: str, generate_count: int):
+    tracing.record_decision(GRAPH_NAME, "grade_generation", outcome)
+    tracing.record_loop(GRAPH_NAME, "generate", generate_count)
+    tracing.log_event(logger, "answer_finished", outcome=outcome, generate_count=generate_count)
 
 
 def build_graph():
@@ -455,6 +714,15 @@ def build_graph():
     workflow.add_node("grade_documents", grade_documents)  # grade documents
     workflow.add_node("generate", stream_generate)  # generate
     workflow.add_node("transform_query", transform_query)  # transform_query
+    workflow.add_node("grade_generation", grade_generation_v_documents_and_question)  # grade generation
+    workflow.add_node("finish_with_best", finish_with_best)  # budget used up
+    workflow.add_edge("finish_with_best", END)
+    # documents pass the compression on their way to generation if enabled
+    generate_node = "generate"
+    if CONTEXT_COMPRESSION:
+        workflow.add_node("compress_context", compress_context)  # compress context
+        workflow.add_edge("compress_context", "generate")
+        generate_node = "compress_context"
 
     # Build graph
     workflow.add_conditional_edges(
@@ -466,14 +734,15 @@ def build_graph():
             "generate_directly": "generate",
         },
     )
-    workflow.add_edge("web_search", "generate")
+    workflow.add_edge("web_search", generate_node)
     workflow.add_edge("retrieve", "grade_documents")
     workflow.add_conditional_edges(
         "grade_documents",
         decide_to_generate,
         {
             "transform_query": "transform_query",
-            "generate": "generate",
+            "generate": generate_node,
+            "finish_with_best": "finish_with_best",
         },
     )
     workflow.add_conditional_edges(
@@ -485,18 +754,20 @@ def build_graph():
             "generate_directly": "generate",
         },
     )
+    workflow.add_edge("generate", "grade_generation")
     workflow.add_conditional_edges(
-        "generate",
-        grade_generation_v_documents_and_question,
+        "grade_generation",
+        lambda state: state["generation_grade"],
         {
             "not supported": "generate",
             "useful": END,
             "not useful": "transform_query",
+            "finish_with_best": "finish_with_best",
         },
     )
 
-    # Compile
-    return workflow.compile()
+    # Compile, the checkpointer stores the state after every node, so an interrupted run can be resumed
+    return workflow.compile(checkpointer=checkpoint.get_sqlite_saver("adaptive_rag"))
 
 
 _app = build_graph()
@@ -512,70 +783,120 @@ def load_conversation_history(user_id: str = None) -> List[dict]:
     Returns:
         List[dict]: conversation history list
     """
+    return _load_dialogue(user_id)["history"]
+
+
+def _load_dialogue(user_id: str = None) -> dict:
     user_id = user_id or 'default'
     try:
-        os.makedirs(CONVERSATION_HISTORY_STORE_FILE_DIR, exist_ok=True)
-        store_path = os.path.join(CONVERSATION_HISTORY_STORE_FILE_DIR,
-                                  CONVERSATION_HISTORY_STORE_FILE_NAME_PATTERN % user_id)
-        if os.path.exists(store_path):
-            with open(store_path, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        return []
+        return memory.read_dialogue(user_id)
     except Exception as e:
-        print(f"Error loading conversation history: {e}")
-        return []
+        tracing.log_event(logger, "load_conversation_history_failed", logging.ERROR, user_id=user_id, error=repr(e))
+        return {"summary": "", "summarized_seq": -1, "history": []}
 
 
-def stream_answer(question: str, user_id: str = None) -> Iterator[str]:
-    user_id = user_id or 'default'
-    conversation_history = load_conversation_history(user_id)
-    inputs = {
+def _get_run_inputs(question: str, user_id: str, config: dict, resume: bool, request_budget: budget.RequestBudget):
+    """
+    Get the graph inputs of a run.
+
+    Args:
+        question: the user question
+        user_id: user id
+        config: the run config with the thread id
+        resume: continue the unfinished run of the thread instead of starting a new one
+        request_budget: budget of the request, limits the generations of a new run
+
+    Returns:
+        None to resume from the last checkpoint, otherwise the initial state of a new run
+    """
+    if resume and _app.get_state(config).next:
+        tracing.log_event(logger, "resume_from_checkpoint", thread_id=config["configurable"]["thread_id"])
+        return None
+    dialogue = _load_dialogue(user_id)
+    # the thread state survives between runs, reset the per-run values
+    return {
         "user_id": user_id,
         "question": question,
-        "conversation_history": conversation_history,
+        "org_question": question,
+        "datasource": "generate_directly",
+        "documents": [],
+        "queries": [],
+        "generation": "",
+        "generate_count": 0,
+        "max_generate_count": request_budget.max_generations,
+        "generation_grade": "",
+        "best_generation": "",
+        "best_generate_id": 0,
+        "best_score": -1,
+        "conversation_history": dialogue["history"],
+        "conversation_summary": dialogue["summary"],
+        "summarized_seq": dialogue["summarized_seq"],
     }
-    for chunk in _app.stream(inputs, stream_mode="custom"):
-        if isinstance(chunk, str):
-            try:
-                chunk_data = json.loads(chunk)
-            except json.JSONDecodeError as e:
-                print(f"Warning: Failed to parse chunk as JSON: {chunk}. Error: {e}")
+
+
+# text marker of the events in the plain text stream, chunks carry their content
+_TEXT_MARKERS = {
+    "init": "[Thinking...]\n",
+    "search": "[Searching on web...]\n",
+    "retrieve": "[Referencing on knowledge base...]\n",
+    "start": "[Answer]\n",
+    "end": "\n[Re-thinking to find a better answer...]\n",
+    "final": "",
+    "budget_exhausted": "\n[Time is up, the best answer so far]\n",
+}
+
+
+def stream_events(question: str, user_id: str = None, conversation_id: str = None,
+                  resume: bool = False) -> Iterator[dict]:
+    """
+    Stream the events of answering a question.
+
+    Args:
+        question: the user question
+        user_id: user id
+        conversation_id: conversation of the user, selects the checkpoints
+        resume: continue the unfinished run of the conversation
+
+    Returns:
+        events as dicts with type (init / search / retrieve / start / chunk / end / final / budget_exhausted),
+        generate_id and, for chunks and budget_exhausted, content
+    """
+    user_id = user_id or 'default'
+    request_budget = budget.get_budget(GRAPH_NAME, user_id)
+    config = budget.attach(checkpoint.make_config(user_id, conversation_id), request_budget)
+    inputs = _get_run_inputs(question, user_id, config, resume, request_budget)
+    try:
+        for event in _app.stream(inputs, config, stream_mode="custom"):
+            if not isinstance(event, dict):
+                tracing.log_event(logger, "invalid_stream_event", logging.WARNING, event=repr(event))
                 continue
+            if event.get("generate_id", -1) >= 0:
+                yield event
+    finally:
+        request_budget.finish()
+
+
+def stream_answer(question: str, user_id: str = None, conversation_id: str = None,
+                  resume: bool = False) -> Iterator[str]:
+    """the answer as plain text with progress markers, the format of the web frontend"""
+    for event in stream_events(question, user_id, conversation_id, resume):
+        marker = _TEXT_MARKERS.get(event["type"])
+        if marker is None:
+            yield event.get("content", "")
         else:
-            chunk_data = chunk
-        chunk_type = chunk_data.get("type", "")
-        generate_id = chunk_data.get("generate_id", -1)
-        if generate_id >= 0:
-            if chunk_type == "init":
-                # 初始化标记
-                yield "[Thinking...]\n"
-            elif chunk_type == "search":
-                # 启动标记
-                yield "[Searching on web...]\n"
-            elif chunk_type == "retrieve":
-                # 启动标记
-                yield "[Referencing on knowledge base...]\n"
-            elif chunk_type == "start":
-                # 开始标记
-                yield "[Answer]\n"
-            elif chunk_type == "end":
-                # 结束标记
-                yield "\n[Re-thinking to find a better answer...]\n"
-            elif chunk_type == "final":
-                yield ""
-            else:
-                yield chunk_data.get("content", "")
+            # the best answer of an exhausted budget follows its marker
+            yield marker + event.get("content", "") if event["type"] == "budget_exhausted" else marker
 
 
-def answer(question: str, user_id: str = None) -> str:
+def answer(question: str, user_id: str = None, conversation_id: str = None, resume: bool = False) -> str:
     user_id = user_id or 'default'
-    conversation_history = load_conversation_history(user_id)
-    inputs = {
-        "user_id": user_id,
-        "question": question,
-        "conversation_history": conversation_history,
-    }
-    result = _app.invoke(inputs)
+    request_budget = budget.get_budget(GRAPH_NAME, user_id)
+    config = budget.attach(checkpoint.make_config(user_id, conversation_id), request_budget)
+    inputs = _get_run_inputs(question, user_id, config, resume, request_budget)
+    try:
+        result = _app.invoke(inputs, config)
+    finally:
+        request_budget.finish()
     if "generation" in result:
         return result["generation"]
     return ""
@@ -0,0 +1,188 @@
+"""
+Embedding based routing of questions, in front of the routing LLM call.
+
+Every decision of the LLM router is logged with the question embedding as a labeled example. A new
+question is compared to the examples of its collection (mean similarity of the nearest ones per
+datasource with at least ROUTER_MIN_EXAMPLES examples), a vectorstore score is raised by the
+similarity to the centroid of the collection's chunks. When at least two datasources are scored and
+the best is similar enough and clearly ahead of the second, it is taken without asking the LLM,
+otherwise the LLM decides and the decision becomes another example.
+The examples are kept in ROUTER_DATA_DIR: examples.jsonl (question, datasource, collection) and
+embeddings.f32 (the rows of the same order).
+"""
+import json
+import logging
+import os
+import threading
+import time
+from typing import List, Optional
+
+import numpy as np
+
+import chroma_db
+from comm import metrics, tracing
+
+LOCAL_ROUTER = os.environ.get("LOCAL_ROUTER", "true").lower() == "true"
+ROUTER_DATA_DIR = os.environ["ROUTER_DATA_DIR"] if "ROUTER_DATA_DIR" in os.environ else "_router"
+# examples per datasource needed before it is routed locally
+ROUTER_MIN_EXAMPLES = int(os.environ.get("ROUTER_MIN_EXAMPLES", 20))
+ROUTER_NEIGHBORS = int(os.environ.get("ROUTER_NEIGHBORS", 5))
+ROUTER_MIN_SIMILARITY = float(os.environ.get("ROUTER_MIN_SIMILARITY", 0.85))
+ROUTER_MIN_MARGIN = float(os.environ.get("ROUTER_MIN_MARGIN", 0.05))
+ROUTER_MAX_EXAMPLES = int(os.environ.get("ROUTER_MAX_EXAMPLES", 20000))
+ROUTER_CENTROID_TTL = float(os.environ.get("ROUTER_CENTROID_TTL", 3600))
+ROUTER_CENTROID_SAMPLE = int(os.environ.get("ROUTER_CENTROID_SAMPLE", 2000))
+
+EXAMPLES_FILE_NAME = "examples.jsonl"
+EMBEDDINGS_FILE_NAME = "embeddings.f32"
+
+logger = tracing.get_logger("local_router")
+_routes = metrics.counter("graph_routes", "Routing decisions by router", ["graph", "router", "datasource"])
+_llm_calls_avoided = metrics.counter("graph_router_llm_calls_avoided", "Routing LLM calls saved by the local router",
+                                     ["graph"])
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    return vectors / np.maximum(np.linalg.norm(vectors, axis=-1, keepdims=True), 1e-12)
+
+
+class EmbeddingRouter:
+    def __init__(self, data_dir: str = ROUTER_DATA_DIR, graph: str = "adaptive_rag"):
+        self.data_dir = data_dir
+        self.graph = graph
+        self._lock = threading.Lock()
+        self._examples = None  # list of (datasource, collection)
+        self._embeddings = None
+        self._centroids = {}  # collection -> (centroid, computed)
+        self.local_routes = 0
+        self.llm_routes = 0
+
+    def _load(self):
+        """read the logged examples, called with the lock held"""
+        if self._examples is not None:
+            return
+        self._examples = []
+        self._embeddings = np.zeros((0, 0), dtype=np.float32)
+        examples_path = os.path.join(self.data_dir, EXAMPLES_FILE_NAME)
+        embeddings_path = os.path.join(self.data_dir, EMBEDDINGS_FILE_NAME)
+        if not os.path.exists(examples_path) or not os.path.exists(embeddings_path):
+            return
+        with open(examples_path, "r", encoding="utf-8") as f:
+            examples = [json.loads(line) for line in f if line.strip()]
+        if not examples:
+            return
+        embeddings = np.fromfile(embeddings_path, dtype=np.float32)
+        dimension = examples[0]["dimension"]
+        # an interrupted append leaves a row without example, cut both files to the complete ones
+        count = min(len(examples), embeddings.size // dimension)
+        if count < len(examples) or count * dimension < embeddings.size:
+            embeddings[:count * dimension].tofile(embeddings_path)
+            with open(examples_path, "w", encoding="utf-8") as f:
+                f.writelines(json.dumps(e, ensure_ascii=False) + "\n" for e in examples[:count])
+        self._examples = [(e["datasource"], e["collection"]) for e in examples[:count]][-ROUTER_MAX_EXAMPLES:]
+        self._embeddings = embeddings[:count * dimension].reshape(count, dimension)[-ROUTER_MAX_EXAMPLES:].copy()
+        tracing.log_event(logger, "examples_loaded", examples=len(self._examples))
+
+    def _get_centroid(self, collection_name: str) -> Optional[np.ndarray]:
+        now = time.monotonic()
+        cached = self._centroids.get(collection_name)
+        if cached is None or now - cached[1] > ROUTER_CENTROID_TTL:
+            vectors = chroma_db.manager.sample_embeddings(collection_name, ROUTER_CENTROID_SAMPLE)
+            centroid = _normalize(np.mean(vectors, axis=0)) if len(vectors) else None
+            cached = self._centroids[collection_name] = (centroid, now)
+        return cached[0]
+
+    def route(self, embedding: List[float], collection_name: str) -> Optional[str]:
+        """
+        Route by the embedding of the question.
+
+        Args:
+            embedding: the question embedding
+            collection_name: the collection the question would be retrieved from
+
+        Returns:
+            the datasource, None if the router isn't confident and the LLM has to decide
+        """
+        query = _normalize(np.asarray(embedding, dtype=np.float32))
+        with self._lock:
+            self._load()
+            examples, embeddings = self._examples, self._embeddings[:len(self._examples)]
+        scores = {}
+        if len(examples) and embeddings.shape[1] == len(query):
+            similarities = embeddings @ query
+            labels = np.array([datasource for datasource, _ in examples])
+            in_collection = np.array([collection == collection_name for _, collection in examples])
+            for datasource in set(labels[in_collection].tolist()):
+                label_similarities = similarities[in_collection & (labels == datasource)]
+                if len(label_similarities) >= ROUTER_MIN_EXAMPLES:
+                    nearest = np.sort(label_similarities)[-ROUTER_NEIGHBORS:]
+                    scores[datasource] = float(nearest.mean())
+        if len(scores) < 2:
+            # without examples of another datasource there is no margin to trust
+            return None
+        if "vectorstore" in scores:
+            # the centroid only supports a vectorstore score backed by examples, alone it would send any
+            # question near the collection's topic to retrieval
+            centroid = self._get_centroid(collection_name)
+            if centroid is not None and len(centroid) == len(query):
+                scores["vectorstore"] = max(scores["vectorstore"], float(centroid @ query))
+        ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)
+        best, best_score = ranked[0]
+        margin = best_score - ranked[1][1]
+        if best_score < ROUTER_MIN_SIMILARITY or margin < ROUTER_MIN_MARGIN:
+            tracing.log_event(logger, "route_uncertain", logging.DEBUG, best=best, score=round(best_score, 4),
+                              margin=round(margin, 4))
+            return None
+        self.local_routes += 1
+        _routes.labels(self.graph, "local", best).inc()
+        _llm_calls_avoided.labels(self.graph).inc()
+        return best
+
+    def learn(self, question: str, embedding: List[float], collection_name: str, datasource: str):
+        """log a decision of the LLM router as labeled example"""
+        self.llm_routes += 1
+        _routes.labels(self.graph, "llm", datasource).inc()
+        row = _normalize(np.asarray(embedding, dtype=np.float32))
+        with self._lock:
+            self._load()
+            if self._examples and self._embeddings.shape[1] != len(row):
+                # the embedding model changed, the old examples are useless
+                tracing.log_event(logger, "examples_reset", logging.WARNING, dimension=len(row))
+                self._examples = []
+                self._embeddings = np.zeros((0, len(row)), dtype=np.float32)
+                for name in (EXAMPLES_FILE_NAME, EMBEDDINGS_FILE_NAME):
+                    if os.path.exists(os.path.join(self.data_dir, name)):
+                        os.remove(os.path.join(self.data_dir, name))
+            os.makedirs(self.data_dir, exist_ok=True)
+            with open(os.path.join(self.data_dir, EMBEDDINGS_FILE_NAME), "ab") as f:
+                f.write(row.tobytes())
+            with open(os.path.join(self.data_dir, EXAMPLES_FILE_NAME), "a", encoding="utf-8") as f:
+                f.write(json.dumps({"question": question, "datasource": datasource, "collection": collection_name,
+                                    "dimension": len(row), "time": time.time()}, ensure_ascii=False) + "\n")
+            self._append(datasource, collection_name, row)
+
+    def _append(self, datasource: str, collection_name: str, row: np.ndarray):
+        """add to the in-memory examples, the rows grow by doubling, route() reads a prefix of them"""
+        count = len(self._examples)
+        if count >= ROUTER_MAX_EXAMPLES:
+            # forget the oldest tenth at once
+            drop = max(1, ROUTER_MAX_EXAMPLES // 10)
+            self._examples = self._examples[drop:]
+            self._embeddings = self._embeddings[drop:count].copy()
+            count = len(self._examples)
+        if self._embeddings.shape[1] != len(row) or count >= len(self._embeddings):
+            grown = np.zeros((max(16, count * 2), len(row)), dtype=np.float32)
+            if count:
+                grown[:count] = self._embeddings[:count]
+            self._embeddings = grown
+        self._embeddings[count] = row
+        # a new list, route() may be iterating the old one
+        self._examples = self._examples + [(datasource, collection_name)]
+
+    def stats(self) -> dict:
+        total = self.local_routes + self.llm_routes
+        return {"local_routes": self.local_routes, "llm_routes": self.llm_routes,
+                "llm_calls_avoided_ratio": round(self.local_routes / total, 4) if total else 0.0}
+
+
+router = EmbeddingRouter()
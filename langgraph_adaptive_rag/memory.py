@@ -0,0 +1,125 @@
+"""
+Conversation memory of the adaptive RAG graph: the dialogue files and their rolling summary.
+
+A dialogue file holds the messages of a user ({"role", "content", "seq"}, seq counts the messages of
+the user) with a running summary of the older ones. Prompts get the summary and only the recent
+messages verbatim, so their size stays flat however long the conversation runs. Once more than
+CONVERSATION_RECENT_TURNS + CONVERSATION_SUMMARY_BATCH_TURNS turns are unsummarized, the older ones
+are folded into the summary in the background, one LLM call per batch.
+"""
+import json
+import logging
+import os
+import tempfile
+import threading
+from typing import List
+
+import chains
+from comm import metrics, persistence, tracing
+
+CONVERSATION_HISTORY_STORE_FILE_DIR = os.environ["CONVERSATION_HISTORY_DIR"] \
+    if "CONVERSATION_HISTORY_DIR" in os.environ else "_conversation_history"
+CONVERSATION_HISTORY_STORE_FILE_NAME_PATTERN = "dialogue_%s.json"
+CONVERSATION_SUMMARY = os.environ.get("CONVERSATION_SUMMARY", "true").lower() == "true"
+# turns (question and answer) always in the prompt verbatim
+CONVERSATION_RECENT_TURNS = int(os.environ.get("CONVERSATION_RECENT_TURNS", 3))
+# turns folded into the summary at once
+CONVERSATION_SUMMARY_BATCH_TURNS = int(os.environ.get("CONVERSATION_SUMMARY_BATCH_TURNS", 3))
+CONVERSATION_SUMMARY_MAX_WORDS = int(os.environ.get("CONVERSATION_SUMMARY_MAX_WORDS", 200))
+
+logger = tracing.get_logger("memory")
+_summaries = metrics.counter("conversation_summaries", "Background summarizations of conversations", ["outcome"])
+
+# the history writes and the summarization of a file must not overwrite each other
+_file_lock = threading.Lock()
+_summary_writer = persistence.PersistenceScheduler("conversation_summary", workers=2, policy="drop")
+_summarizer = None
+
+
+def _get_path(user_id: str) -> str:
+    return os.path.join(CONVERSATION_HISTORY_STORE_FILE_DIR, CONVERSATION_HISTORY_STORE_FILE_NAME_PATTERN % user_id)
+
+
+def read_dialogue(user_id: str) -> dict:
+    """the dialogue file of the user: summary, summarized_seq (last summarized message) and history"""
+    path = _get_path(user_id)
+    if not os.path.exists(path):
+        return {"summary": "", "summarized_seq": -1, "history": []}
+    with open(path, "r", encoding="utf-8") as f:
+        dialogue = json.load(f)
+    if isinstance(dialogue, list):
+        # files written before the summary are the plain message list
+        dialogue = {"summary": "", "summarized_seq": -1, "history": dialogue}
+    for i, message in enumerate(dialogue["history"]):
+        message.setdefault("seq", i)
+    return dialogue
+
+
+def _write_dialogue(user_id: str, dialogue: dict):
+    """called with the file lock held"""
+    os.makedirs(CONVERSATION_HISTORY_STORE_FILE_DIR, exist_ok=True)
+    # write a temp file and rename it, a concurrent load never sees a half written file
+    fd, tmp_path = tempfile.mkstemp(dir=CONVERSATION_HISTORY_STORE_FILE_DIR, suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(dialogue, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, _get_path(user_id))
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def write_history(user_id: str, history: List[dict]):
+    """store the messages, keeping the summary of the file, and summarize in the background if due"""
+    with _file_lock:
+        dialogue = read_dialogue(user_id)
+        dialogue["history"] = history
+        _write_dialogue(user_id, dialogue)
+    if CONVERSATION_SUMMARY and len(get_unsummarized(history, dialogue["summarized_seq"])) > \
+            2 * (CONVERSATION_RECENT_TURNS + CONVERSATION_SUMMARY_BATCH_TURNS):
+        # a queued summarization of the user is replaced, the newer one folds the same messages and more
+        _summary_writer.submit(user_id, lambda: summarize(user_id))
+
+
+def next_seq(history: List[dict]) -> int:
+    return history[-1].get("seq", len(history) - 1) + 1 if history else 0
+
+
+def get_unsummarized(history: List[dict], summarized_seq: int) -> List[dict]:
+    return [message for message in history if message.get("seq", -1) > summarized_seq]
+
+
+def get_prompt_messages(history: List[dict], summarized_seq: int) -> List[dict]:
+    """the messages a prompt gets verbatim, the older ones are in the summary"""
+    if not CONVERSATION_SUMMARY:
+        return history
+    # if the summary lags behind, the messages between it and the recent ones are left out
+    return get_unsummarized(history, summarized_seq)[-2 * (CONVERSATION_RECENT_TURNS +
+                                                           CONVERSATION_SUMMARY_BATCH_TURNS):]
+
+
+def summarize(user_id: str):
+    """fold all but the recent turns into the summary"""
+    global _summarizer
+    with _file_lock:
+        dialogue = read_dialogue(user_id)
+    summarized_seq = dialogue["summarized_seq"]
+    fold = get_unsummarized(dialogue["history"], summarized_seq)[:-2 * CONVERSATION_RECENT_TURNS]
+    if not fold:
+        return
+    if _summarizer is None:
+        _summarizer = chains.conversation_summary_chain()
+    turns = "\n".join(f"[{message['role']}]: {message['content']}" for message in fold)
+    summary = _summarizer.invoke({"summary": dialogue["summary"] or "(empty)", "turns": turns,
+                                  "max_words": CONVERSATION_SUMMARY_MAX_WORDS})
+    with _file_lock:
+        dialogue = read_dialogue(user_id)
+        if dialogue["summarized_seq"] != summarized_seq:
+            _summaries.labels("conflict").inc()
+            return
+        dialogue["summary"] = summary.strip()
+        dialogue["summarized_seq"] = fold[-1]["seq"]
+        _write_dialogue(user_id, dialogue)
+    _summaries.labels("ok").inc()
+    tracing.log_event(logger, "conversation_summarized", logging.DEBUG, user_id=user_id, messages=len(fold),
+                      summarized_seq=fold[-1]["seq"])
@@ -0,0 +1,289 @@
+"""
+Compact vector index for large knowledge bases, the "quantized" backend of chroma_db.
+
+Embeddings are L2 normalized and kept twice in flat files of the collection directory: int8 codes with
+one scale per vector (a quarter of float32), scanned for every query, and the float32 vectors, only read
+to re-score the candidates. All files are memory-mapped, so the resident memory is the part the OS keeps
+in the page cache instead of the whole index. Once build_index() ran, an IVF index (spherical k-means
+centroids) limits the scan to the QUANTIZED_NPROBE lists nearest to the query.
+"""
+import json
+import os
+import threading
+import uuid
+from typing import Any, Iterable, List, Optional, Tuple
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.vectorstores import VectorStore
+
+from comm import tracing
+
+QUANTIZED_NPROBE = int(os.environ.get("QUANTIZED_NPROBE", 8))
+QUANTIZED_RESCORE_FACTOR = int(os.environ.get("QUANTIZED_RESCORE_FACTOR", 4))
+QUANTIZED_IVF_MIN_VECTORS = int(os.environ.get("QUANTIZED_IVF_MIN_VECTORS", 50000))
+QUANTIZED_SCAN_BLOCK = int(os.environ.get("QUANTIZED_SCAN_BLOCK", 4096))
+
+META_FILE = "meta.json"
+CODES_FILE = "codes.i8"
+SCALES_FILE = "scales.f32"
+VECTORS_FILE = "vectors.f32"
+LISTS_FILE = "lists.i32"
+CENTROIDS_FILE = "centroids.f32"
+DOCS_FILE = "docs.jsonl"
+OFFSETS_FILE = "docs.i64"
+
+logger = tracing.get_logger("quantized_store")
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def quantize(vectors: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """symmetric int8 quantization with one scale per vector"""
+    scales = np.abs(vectors).max(axis=1) / 127.0
+    scales[scales == 0] = 1.0
+    codes = np.clip(np.rint(vectors / scales[:, None]), -127, 127).astype(np.int8)
+    return codes, scales.astype(np.float32)
+
+
+def _top(scores: np.ndarray, k: int) -> np.ndarray:
+    """indexes of the k best scores, best first"""
+    if k >= len(scores):
+        return np.argsort(-scores)
+    best = np.argpartition(-scores, k)[:k]
+    return best[np.argsort(-scores[best])]
+
+
+class QuantizedVectorStore(VectorStore):
+    def __init__(self, path: str, embedding_function: Embeddings, dimension: int = None):
+        self.path = path
+        self.embedding_function = embedding_function
+        self._lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+        meta_path = os.path.join(path, META_FILE)
+        if os.path.exists(meta_path):
+            with open(meta_path, "r", encoding="utf-8") as f:
+                self.meta = json.load(f)
+        else:
+            self.meta = {"dimension": dimension, "count": 0, "nlist": 0}
+            self._save_meta()
+        self._open()
+
+    @staticmethod
+    def exists(path: str) -> bool:
+        return os.path.exists(os.path.join(path, META_FILE))
+
+    @property
+    def embeddings(self) -> Optional[Embeddings]:
+        return self.embedding_function
+
+    @property
+    def count(self) -> int:
+        return self.meta["count"]
+
+    def _file(self, name: str) -> str:
+        return os.path.join(self.path, name)
+
+    def _save_meta(self):
+        tmp_path = self._file(META_FILE + ".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.meta, f)
+        os.replace(tmp_path, self._file(META_FILE))
+
+    def _map(self, name: str, dtype, shape):
+        if not shape[0]:
+            return np.zeros(shape, dtype=dtype)
+        return np.memmap(self._file(name), dtype=dtype, mode="r", shape=shape)
+
+    def _open(self):
+        """(re)map the files, searches keep using the maps they started with"""
+        n, d, nlist = self.meta["count"], self.meta["dimension"] or 0, self.meta["nlist"]
+        self._codes = self._map(CODES_FILE, np.int8, (n, d))
+        self._scales = self._map(SCALES_FILE, np.float32, (n,))
+        self._vectors = self._map(VECTORS_FILE, np.float32, (n, d))
+        self._offsets = self._map(OFFSETS_FILE, np.int64, (n,))
+        self._lists = self._map(LISTS_FILE, np.int32, (n,)) if nlist else None
+        self._centroids = np.fromfile(self._file(CENTROIDS_FILE), dtype=np.float32).reshape(nlist, d) \
+            if nlist else None
+
+    def _append(self, name: str, array: np.ndarray):
+        with open(self._file(name), "ab") as f:
+            # cut the tail an interrupted add left behind, the rows must stay aligned with the count
+            expected = self.meta["count"] * (array.nbytes // len(array))
+            if f.tell() != expected:
+                f.truncate(expected)
+            f.write(np.ascontiguousarray(array).tobytes())
+
+    def add_embeddings(self, texts: List[str], embeddings, metadatas: List[dict] = None,
+                       ids: List[str] = None) -> List[str]:
+        vectors = _normalize(np.asarray(embeddings, dtype=np.float32))
+        ids = ids or [str(uuid.uuid4()) for _ in texts]
+        metadatas = metadatas or [{} for _ in texts]
+        with self._lock:
+            if self.meta["dimension"] is None:
+                self.meta["dimension"] = vectors.shape[1]
+            elif vectors.shape[1] != self.meta["dimension"]:
+                raise ValueError(f"Embedding dimension {vectors.shape[1]} doesn't match the collection's "
+                                 f"{self.meta['dimension']}")
+            codes, scales = quantize(vectors)
+            docs_path = self._file(DOCS_FILE)
+            offset = os.path.getsize(docs_path) if os.path.exists(docs_path) else 0
+            offsets = []
+            lines = []
+            for doc_id, text, metadata in zip(ids, texts, metadatas):
+                line = (json.dumps({"id": doc_id, "text": text, "metadata": metadata}, ensure_ascii=False)
+                        + "\n").encode("utf-8")
+                offsets.append(offset)
+                offset += len(line)
+                lines.append(line)
+            with open(docs_path, "ab") as f:
+                f.write(b"".join(lines))
+            self._append(OFFSETS_FILE, np.asarray(offsets, dtype=np.int64))
+            self._append(CODES_FILE, codes)
+            self._append(SCALES_FILE, scales)
+            self._append(VECTORS_FILE, vectors)
+            if self.meta["nlist"]:
+                # keep the index up to date, build_index() re-trains the centroids
+                self._append(LISTS_FILE, self._assign(vectors, self._centroids))
+            # the count is saved last, a crash before leaves only tails that the next add cuts
+            self.meta["count"] += len(texts)
+            self._save_meta()
+            self._open()
+        return ids
+
+    def add_texts(self, texts: Iterable[str], metadatas: Optional[List[dict]] = None,
+                  ids: Optional[List[str]] = None, **kwargs: Any) -> List[str]:
+        texts = list(texts)
+        if not texts:
+            return []
+        return self.add_embeddings(texts, self.embedding_function.embed_documents(texts), metadatas, ids)
+
+    @staticmethod
+    def _assign(vectors: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+        return np.argmax(vectors @ centroids.T, axis=1).astype(np.int32)
+
+    def build_index(self, nlist: int = None, iterations: int = 10, sample_size: int = 256, seed: int = 0):
+        """
+        Train the IVF centroids and assign all vectors to their lists.
+
+        Args:
+            nlist: number of lists, sqrt of the vector count by default
+            iterations: k-means iterations
+            sample_size: training vectors per list
+            seed: random seed of the sampling
+        """
+        with self._lock:
+            n = self.meta["count"]
+            nlist = min(nlist or max(1, int(np.sqrt(n))), n)
+            if not nlist:
+                return
+            rng = np.random.default_rng(seed)
+            sample = np.asarray(self._vectors[np.sort(rng.choice(n, min(n, nlist * sample_size), replace=False))])
+            centroids = sample[rng.choice(len(sample), nlist, replace=False)]
+            for _ in range(iterations):
+                assigned = self._assign(sample, centroids)
+                sums = np.zeros_like(centroids)
+                np.add.at(sums, assigned, sample)
+                empty = np.bincount(assigned, minlength=nlist) == 0
+                # restart empty lists from random samples
+                sums[empty] = sample[rng.choice(len(sample), int(empty.sum()))]
+                centroids = _normalize(sums)
+            lists = np.concatenate([self._assign(np.asarray(self._vectors[i:i + QUANTIZED_SCAN_BLOCK]), centroids)
+                                    for i in range(0, n, QUANTIZED_SCAN_BLOCK)])
+            lists.tofile(self._file(LISTS_FILE))
+            centroids.astype(np.float32).tofile(self._file(CENTROIDS_FILE))
+            self.meta["nlist"] = nlist
+            self._save_meta()
+            self._open()
+        tracing.log_event(logger, "index_built", path=self.path, vectors=n, nlist=nlist)
+
+    def search_vector(self, embedding, k: int = 4, nprobe: int = QUANTIZED_NPROBE,
+                      rescore_factor: int = QUANTIZED_RESCORE_FACTOR) -> List[Tuple[int, float]]:
+        """
+        Nearest vectors by cosine similarity.
+
+        Args:
+            embedding: the query vector
+            k: number of results
+            nprobe: IVF lists to scan, ignored without index
+            rescore_factor: k * rescore_factor int8 candidates are re-scored with the float32 vectors
+
+        Returns:
+            (position, similarity) pairs, most similar first
+        """
+        codes, scales, vectors, lists, centroids = self._codes, self._scales, self._vectors, self._lists, \
+            self._centroids
+        if not len(codes):
+            return []
+        query = _normalize(np.asarray(embedding, dtype=np.float32)[None, :])[0]
+        candidates = k * max(1, rescore_factor)
+        if centroids is not None:
+            probes = _top(centroids @ query, nprobe)
+            positions = np.flatnonzero(np.isin(lists, probes))
+            blocks = [positions[i:i + QUANTIZED_SCAN_BLOCK] for i in range(0, len(positions), QUANTIZED_SCAN_BLOCK)]
+        else:
+            blocks = [np.arange(i, min(i + QUANTIZED_SCAN_BLOCK, len(codes)))
+                      for i in range(0, len(codes), QUANTIZED_SCAN_BLOCK)]
+        best_positions = []
+        best_scores = []
+        for block in blocks:
+            if block[-1] - block[0] + 1 == len(block):
+                block_codes, block_scales = codes[block[0]:block[-1] + 1], scales[block[0]:block[-1] + 1]
+            else:
+                block_codes, block_scales = codes[block], scales[block]
+            scores = (block_codes @ query) * block_scales
+            top = _top(scores, candidates)
+            best_positions.append(block[top])
+            best_scores.append(scores[top])
+        positions = np.concatenate(best_positions)
+        positions = np.sort(positions[_top(np.concatenate(best_scores), candidates)])
+        # re-score with full precision
+        scores = np.asarray(vectors[positions]) @ query
+        top = _top(scores, k)
+        return [(int(positions[i]), float(scores[i])) for i in top]
+
+    def sample_vectors(self, limit: int) -> np.ndarray:
+        """up to limit float32 vectors, evenly spread over the index"""
+        vectors = self._vectors
+        step = max(1, len(vectors) // max(limit, 1))
+        return np.asarray(vectors[::step][:limit])
+
+    def get_documents(self, positions: List[int]) -> List[Document]:
+        docs = []
+        with open(self._file(DOCS_FILE), "rb") as f:
+            for position in positions:
+                f.seek(int(self._offsets[position]))
+                item = json.loads(f.readline())
+                docs.append(Document(page_content=item["text"], metadata=item["metadata"], id=item["id"]))
+        return docs
+
+    def similarity_search_by_vector_with_score(self, embedding: List[float], k: int = 4,
+                                               **kwargs: Any) -> List[Tuple[Document, float]]:
+        hits = self.search_vector(embedding, k, **kwargs)
+        return list(zip(self.get_documents([p for p, _ in hits]), [s for _, s in hits]))
+
+    def similarity_search_with_score(self, query: str, k: int = 4, **kwargs: Any) -> List[Tuple[Document, float]]:
+        return self.similarity_search_by_vector_with_score(self.embedding_function.embed_query(query), k, **kwargs)
+
+    def similarity_search_by_vector(self, embedding: List[float], k: int = 4, **kwargs: Any) -> List[Document]:
+        return [doc for doc, _ in self.similarity_search_by_vector_with_score(embedding, k, **kwargs)]
+
+    def similarity_search(self, query: str, k: int = 4, **kwargs: Any) -> List[Document]:
+        return [doc for doc, _ in self.similarity_search_with_score(query, k, **kwargs)]
+
+    def _select_relevance_score_fn(self):
+        # scores are cosine similarities already
+        return lambda score: score
+
+    @classmethod
+    def from_texts(cls, texts: List[str], embedding: Embeddings, metadatas: Optional[List[dict]] = None,
+                   path: str = None, **kwargs: Any) -> "QuantizedVectorStore":
+        if path is None:
+            raise ValueError("path of the index is required")
+        store = cls(path, embedding)
+        store.add_texts(texts, metadatas, **kwargs)
+        return store
@@ -14,13 +14,13 @@ def test_query_node():
 
 
 def test_retrieval_grader(question):
-    docs = graph.retriever.invoke(question)
+    docs = graph._retrieve_documents(graph.collect_name, question)
     doc_txt = docs[1].page_content
     print(graph.retrieval_grader.invoke({"question": question, "document": doc_txt}))
 
 
 def test_generate_in_stream(question):
-    docs = graph.retriever.invoke(question)
+    docs = graph._retrieve_documents(graph.collect_name, question)
     docs_txt = graph.format_docs(docs)
     generation = graph.generator.invoke({"context": docs_txt, "question": question})
     for token in generation:
@@ -28,7 +28,7 @@ def test_generate_in_stream(question):
 
 
 def test_generate(question):
-    docs = graph.retriever.invoke(question)
+    docs = graph._retrieve_documents(graph.collect_name, question)
     docs_txt = graph.format_docs(docs)
     generation = graph.generator.invoke({"context": docs_txt, "question": question})
     print(generation)
@@ -42,7 +42,7 @@ def test_answer_grader(question):
 
 def test_hallucination_grader(question):
     generation = test_generate(question)
-    docs = graph.retriever.invoke(question)
+    docs = graph._retrieve_documents(graph.collect_name, question)
     print(
         graph.hallucination_grader.invoke(
             {"documents": docs, "generation": generation}
@@ -0,0 +1,84 @@
+
+import chunking
+
+# deterministic, offline token counter (~4 characters per token), tiktoken downloads its vocabulary
+chunking.count_tokens = lambda text: (len(text) + 3) // 4
+
+PAGE = """
+<html><head><title>Agents</title></head><body>
+<nav>Home | Docs</nav>
+<h1>Memory</h1>
+<div>The <b>agent</b> uses <a href="#">memory</a> to plan.</div>
+<p>Short-term memory is the context window. Long-term memory is an external store.</p>
+<h2>Retrieval</h2>
+<p>Memories are retrieved by similarity.</p>
+<pre>def recall(query):
+    return store.search(query)</pre>
+<h1>Tools</h1>
+<ul><li>Search the web.</li><li>Run code.</li></ul>
+</body></html>
+"""
+
+
+### test methods ###
+
+def test_extract_blocks():
+    title, blocks = chunking.extract_blocks(PAGE)
+    assert title == "Agents"
+    texts = [block.text for block in blocks]
+    # inline tags run on with the text around them, the navigation is skipped
+    assert texts[0] == "The agent uses memory to plan.", texts
+    assert "Home | Docs" not in texts
+    assert blocks[0].section == ("Memory",)
+    assert blocks[2].section == ("Memory", "Retrieval")
+    assert blocks[3].code and blocks[3].text.startswith("def recall(query):\n")
+    # a new h1 closes the sections below the previous one
+    assert blocks[4].section == ("Tools",) and blocks[4].text == "Search the web."
+    print(texts)
+
+
+def test_section_boundaries():
+    docs = chunking.split_html("https://example.com", PAGE, chunk_size=512, chunk_overlap=0)
+    sections = [doc.metadata["section"] for doc in docs]
+    # a chunk never spans two sections
+    assert sections == ["Memory", "Memory > Retrieval", "Tools"], sections
+    assert docs[0].page_content.startswith("Agents > Memory\n\nThe agent uses memory to plan.")
+    assert [doc.metadata["chunk_index"] for doc in docs] == list(range(len(docs)))
+    print(sections)
+
+
+def test_offsets():
+    _, blocks = chunking.extract_blocks(PAGE)
+    page_text = "\n\n".join(block.text for block in blocks)
+    docs = chunking.split_html("https://example.com", PAGE, chunk_size=512, chunk_overlap=0)
+    for doc in docs:
+        body = doc.page_content.split("\n\n", 1)[1]
+        assert page_text[doc.metadata["start_index"]:doc.metadata["end_index"]] == body, doc
+    print([(doc.metadata["start_index"], doc.metadata["end_index"]) for doc in docs])
+
+
+def test_token_cap():
+    sentences = " ".join(f"Sentence number {i} is about agent memory and planning." for i in range(200))
+    page = f"<html><head><title>Long</title></head><body><h1>Notes</h1><p>{sentences}</p>" \
+           f"<p>{'word ' * 500}</p></body></html>"
+    chunk_size = 64
+    docs = chunking.split_html("https://example.com/long", page, chunk_size=chunk_size, chunk_overlap=16)
+    assert len(docs) > 1
+    for doc in docs:
+        assert doc.metadata["tokens"] <= chunk_size, doc.metadata
+        assert doc.metadata["tokens"] == chunking.count_tokens(doc.page_content)
+    # sentences are not cut, the overlap repeats the trailing ones of the previous chunk
+    first = docs[0].page_content.split("\n\n", 1)[1]
+    assert first.endswith("planning."), first
+    assert docs[1].metadata["start_index"] < docs[0].metadata["end_index"]
+    # the cap is the embedding model's input window however large the chunk size
+    docs = chunking.split_html("https://example.com/long", page, chunk_size=10 ** 6, chunk_overlap=0)
+    assert all(doc.metadata["tokens"] <= chunking.EMBED_MODEL_MAX_TOKENS for doc in docs)
+    print(len(docs), [doc.metadata["tokens"] for doc in docs])
+
+
+if __name__ == "__main__":
+    test_extract_blocks()
+    test_section_boundaries()
+    test_offsets()
+    test_token_cap()
@@ -0,0 +1,61 @@
+
+import grade_filter
+
+
+### test methods ###
+
+def test_fit_thresholds():
+    # relevant chunks score high, irrelevant ones low, a conflicting band in the middle
+    decisions = [(0.9 - i * 0.01, "yes") for i in range(30)] + \
+                [(0.55, "no"), (0.5, "yes"), (0.45, "no"), (0.4, "yes")] + \
+                [(0.3 - i * 0.01, "no") for i in range(30)]
+    ret = grade_filter.fit_thresholds(decisions, precision=0.99, min_support=20)
+    assert ret["decisions"] == 64
+    assert ret["accept"] == 0.9 - 29 * 0.01 and ret["reject"] == 0.3, ret
+    assert ret["threshold_share"] == round(60 / 64, 4)
+    print(ret)
+
+
+def test_fit_thresholds_ties():
+    # the five yes grades at 0.5 come first, without the tie rule 0.5 would reach the precision
+    decisions = [(0.9 - i * 0.01, "yes") for i in range(20)] + [(0.5, "yes")] * 5 + [(0.5, "no")] * 5
+    ret = grade_filter.fit_thresholds(decisions, precision=0.95, min_support=20)
+    assert ret["accept"] == 0.9 - 19 * 0.01, ret
+    assert "reject" not in ret
+    print(ret)
+
+
+def test_fit_thresholds_min_support():
+    decisions = [(0.9 - i * 0.01, "yes") for i in range(19)] + [(0.1 - i * 0.01, "no") for i in range(19)]
+    ret = grade_filter.fit_thresholds(decisions, precision=0.99, min_support=20)
+    assert "accept" not in ret and "reject" not in ret, ret
+    assert ret["threshold_share"] == 0.0
+    ret = grade_filter.fit_thresholds(decisions, precision=0.99, min_support=19)
+    assert ret["accept"] == 0.9 - 18 * 0.01 and ret["reject"] == 0.1, ret
+    print(ret)
+
+
+def test_fit_thresholds_overlapping_bands():
+    # the LLM grades the low scores relevant and the high ones not, the bands overlap
+    decisions = [(i / 40, "yes" if i < 20 else "no") for i in range(40)]
+    ret = grade_filter.fit_thresholds(decisions, precision=0.5, min_support=20)
+    assert "accept" not in ret and "reject" not in ret, ret
+    assert ret["threshold_share"] == 0.0
+    print(ret)
+
+
+def test_fit_thresholds_weights():
+    # an audited grade stands for the chunks the thresholds decided, one wrong audit outweighs the band
+    decisions = [(0.9 - i * 0.01, "yes") for i in range(20)] + [(0.95, "no")]
+    assert "accept" in grade_filter.fit_thresholds(decisions, precision=0.95, min_support=20)
+    ret = grade_filter.fit_thresholds(decisions[:-1] + [(0.95, "no", 20.0)], precision=0.95, min_support=20)
+    assert "accept" not in ret, ret
+    print(ret)
+
+
+if __name__ == "__main__":
+    test_fit_thresholds()
+    test_fit_thresholds_ties()
+    test_fit_thresholds_min_support()
+    test_fit_thresholds_overlapping_bands()
+    test_fit_thresholds_weights()
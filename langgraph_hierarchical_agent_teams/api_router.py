@@ -1,4 +1,4 @@
-from typing import Union, Literal
+from typing import Union, Literal, Optional
 
 from fastapi import APIRouter, Request
 from pydantic import BaseModel
@@ -6,6 +6,7 @@ from starlette.responses import StreamingResponse
 
 import teams_graph as graph
 from auth.security import get_current_user, require_login
+from comm import streaming
 
 teams_router = APIRouter()
 
@@ -13,18 +14,22 @@ teams_router = APIRouter()
 class QuestionRequest(BaseModel):
     question: str
     stream: Union[Literal["answer", "detail"], bool] = False
+    conversation_id: Optional[str] = None
+    # continue the interrupted run of the conversation, e.g. after a dropped connection
+    resume: bool = False
 
 
 @teams_router.post('/chat/ask')
 @require_login()
 async def ask_question(request: Request, question: QuestionRequest):
     current_user = await get_current_user(request)
-    return StreamingResponse(graph.answer(question.question, current_user.id), media_type="application/json")
+    frames = streaming.aencode_text(graph.answer(question.question, current_user.id,
+                                                 question.conversation_id, question.resume))
+    return StreamingResponse(streaming.coalesce(frames), media_type=streaming.TEXT_MEDIA_TYPE)
 
 
 @teams_router.get("/chat/history")
 @require_login()
-async def conversation(request: Request):
+async def conversation(request: Request, conversation_id: Optional[str] = None):
     current_user = await get_current_user(request)
-    ret = []
-    return ret
+    return await graph.load_conversation_history(current_user.id, conversation_id)
@@ -0,0 +1,109 @@
+"""
+Compaction of the supervisor inputs.
+
+Every worker report is appended to the graph messages, a supervisor only needs the user request and
+what the workers achieved to route the next round. The supervisor gets the latest user request and the
+latest reports in full, the older messages as a ledger of one truncated line per report, all within
+SUPERVISOR_PROMPT_TOKENS. Messages within the budget are passed unchanged, the graph state always
+keeps the full messages.
+"""
+import collections
+import os
+from typing import List
+
+from langchain_core.messages import BaseMessage, HumanMessage
+
+from comm import metrics
+from comm.llm_provider import count_tokens
+
+SUPERVISOR_COMPACTION = os.environ.get("SUPERVISOR_COMPACTION", "true").lower() == "true"
+SUPERVISOR_PROMPT_TOKENS = int(os.environ.get("SUPERVISOR_PROMPT_TOKENS", 3000))
+# latest worker reports the supervisor reads in full, as far as the budget allows
+SUPERVISOR_RECENT_REPORTS = int(os.environ.get("SUPERVISOR_RECENT_REPORTS", 2))
+# tokens of a report in its ledger line
+SUPERVISOR_LEDGER_PREVIEW_TOKENS = int(os.environ.get("SUPERVISOR_LEDGER_PREVIEW_TOKENS", 48))
+# older ledger lines are merged into one line of counts
+SUPERVISOR_LEDGER_ENTRIES = int(os.environ.get("SUPERVISOR_LEDGER_ENTRIES", 20))
+LEDGER_NAME = "ledger"
+
+_tokens = metrics.histogram("supervisor_prompt_tokens", "Message tokens of a supervisor call", ["graph", "stage"],
+                            buckets=(250, 500, 1000, 2000, 4000, 8000, 16000, 32000, 64000))
+
+
+def _is_request(message: BaseMessage) -> bool:
+    """a user message, worker reports are human messages named by their worker"""
+    return message.type == "human" and not message.name
+
+
+def truncate(text: str, max_tokens: int) -> str:
+    """the head of the text within max_tokens, marked as truncated"""
+    tokens = count_tokens(text)
+    if tokens <= max_tokens:
+        return text
+    # cut by characters in proportion, then trim until it fits
+    cut = text[:max(0, len(text) * max_tokens // tokens)]
+    while cut and count_tokens(cut) > max_tokens:
+        cut = cut[:len(cut) * 9 // 10]
+    return cut.rstrip() + f" ...[truncated, {tokens} tokens]"
+
+
+def _ledger_line(number: int, message: BaseMessage) -> str:
+    content = message.content if isinstance(message.content, str) else str(message.content)
+    who = message.name or ("user" if message.type == "human" else message.type)
+    status = "reported" if content.strip() else "no result"
+    preview = " ".join(truncate(content, SUPERVISOR_LEDGER_PREVIEW_TOKENS).split())
+    return f"{number}. [{who}] {status}: {preview}"
+
+
+def _ledger(messages: List[BaseMessage]) -> str:
+    lines = [_ledger_line(i, m) for i, m in enumerate(messages, 1)]
+    if len(lines) > SUPERVISOR_LEDGER_ENTRIES:
+        merged = len(lines) - SUPERVISOR_LEDGER_ENTRIES
+        counts = collections.Counter(m.name or m.type for m in messages[:merged])
+        lines = [f"1-{merged}. " + ", ".join(f"{who} x{n}" for who, n in counts.items())] + lines[merged:]
+    return "\n".join(lines)
+
+
+def compact_messages(messages: List[BaseMessage], graph: str = "teams",
+                     max_tokens: int = SUPERVISOR_PROMPT_TOKENS) -> List[BaseMessage]:
+    """
+    Compact the messages of a supervisor call.
+
+    Args:
+        messages: the graph messages
+        graph: metric label
+        max_tokens: budget of the compacted messages
+
+    Returns:
+        a ledger of the earlier conversation, the latest user request, a ledger of the older reports to
+        it and the latest reports, the reports not fitting the budget truncated
+    """
+    if not SUPERVISOR_COMPACTION or not messages:
+        return messages
+    total = sum(count_tokens(str(m.content)) for m in messages)
+    _tokens.labels(graph, "full").observe(total)
+    if total <= max_tokens:
+        return messages
+    request_index = max((i for i, m in enumerate(messages) if _is_request(m)), default=0)
+    earlier, request, reports = messages[:request_index], messages[request_index], messages[request_index + 1:]
+    recent = reports[-SUPERVISOR_RECENT_REPORTS:] if SUPERVISOR_RECENT_REPORTS > 0 else []
+    older = reports[:len(reports) - len(recent)]
+
+    ret = []
+    if earlier:
+        ret.append(HumanMessage(content="Earlier conversation:\n" + _ledger(earlier), name=LEDGER_NAME))
+    ret.append(request)
+    if older:
+        ret.append(HumanMessage(content="Worker outcomes so far:\n" + _ledger(older), name=LEDGER_NAME))
+    remaining = max_tokens - sum(count_tokens(str(m.content)) for m in ret)
+    kept = []
+    for message in reversed(recent):
+        content = message.content if isinstance(message.content, str) else str(message.content)
+        limit = max(remaining, SUPERVISOR_LEDGER_PREVIEW_TOKENS)
+        if count_tokens(content) > limit:
+            message = message.model_copy(update={"content": truncate(content, limit)})
+        remaining -= count_tokens(message.content)
+        kept.append(message)
+    ret.extend(reversed(kept))
+    _tokens.labels(graph, "compacted").observe(sum(count_tokens(str(m.content)) for m in ret))
+    return ret
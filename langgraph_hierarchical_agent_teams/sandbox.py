@@ -0,0 +1,325 @@
+"""
+Process-pool sandbox for LLM-written python code.
+
+Code runs in pre-forked worker processes (matplotlib/pandas already imported), so it never
+holds the GIL of the web server. Every worker enforces a CPU-time limit per run, the parent
+kills workers exceeding the RSS or wall-clock limit, and each session gets its own namespace.
+Charts are written as PNG temp files into the caller's output directory and returned by path.
+
+This module only depends on the standard library, the heavy imports happen in the workers.
+"""
+import io
+import multiprocessing
+import os
+import signal
+import threading
+import time
+import traceback
+import uuid
+from contextlib import redirect_stdout, redirect_stderr
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+SANDBOX_POOL_SIZE = int(os.environ.get("SANDBOX_POOL_SIZE", 2))
+SANDBOX_CPU_TIME_LIMIT = int(os.environ.get("SANDBOX_CPU_TIME_LIMIT", 30))  # cpu seconds per run
+SANDBOX_WALL_TIME_LIMIT = float(os.environ.get("SANDBOX_WALL_TIME_LIMIT", 60))  # seconds per run
+SANDBOX_MEMORY_LIMIT_MB = int(os.environ.get("SANDBOX_MEMORY_LIMIT_MB", 1024))  # RSS per worker
+SANDBOX_MAX_SESSIONS_PER_WORKER = int(os.environ.get("SANDBOX_MAX_SESSIONS_PER_WORKER", 32))
+# seconds a run waits for the busy worker of its session before taking an idle one with a fresh namespace
+SANDBOX_STICKY_WAIT = float(os.environ.get("SANDBOX_STICKY_WAIT", 2))
+SANDBOX_MAX_OUTPUT_LENGTH = int(os.environ.get("SANDBOX_MAX_OUTPUT_LENGTH", 10000))
+_WARM_MODULES = ["matplotlib", "pandas"]
+_RSS_CHECK_INTERVAL = 0.1
+
+
+@dataclass
+class SandboxResult:
+    stdout: str = ""
+    images: List[str] = field(default_factory=list)
+    error: Optional[str] = None
+
+
+class _CPUTimeExceeded(Exception):
+    pass
+
+
+### Worker process side ###
+def _on_cpu_time_exceeded(signum, frame):
+    raise _CPUTimeExceeded("CPU time limit exceeded")
+
+
+def _warm_imports():
+    os.environ.setdefault("MPLBACKEND", "Agg")
+    try:
+        import matplotlib
+        matplotlib.use("Agg")
+        import matplotlib.pyplot  # noqa: F401
+    except ImportError:
+        pass
+    try:
+        import pandas  # noqa: F401
+    except ImportError:
+        pass
+
+
+def _set_cpu_limit(seconds):
+    if resource is None:
+        return
+    _, hard = resource.getrlimit(resource.RLIMIT_CPU)
+    if seconds is None:
+        resource.setrlimit(resource.RLIMIT_CPU, (hard, hard))
+        return
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    soft = int(usage.ru_utime + usage.ru_stime) + seconds
+    if hard != resource.RLIM_INFINITY:
+        soft = min(soft, hard)
+    resource.setrlimit(resource.RLIMIT_CPU, (soft, hard))
+
+
+def _save_figures(output_dir) -> List[str]:
+    try:
+        import matplotlib.pyplot as plt
+    except ImportError:
+        return []
+    images = []
+    for num in plt.get_fignums():
+        path = os.path.join(output_dir, f"chart_{uuid.uuid4().hex[:12]}.png")
+        plt.figure(num).savefig(path)
+        images.append(path)
+    plt.close("all")
+    return images
+
+
+def _run_code(namespace: dict, code: str, output_dir: str, cpu_limit: int) -> SandboxResult:
+    result = SandboxResult()
+    buffer = io.StringIO()
+    cwd = os.getcwd()
+    try:
+        os.makedirs(output_dir, exist_ok=True)
+        os.chdir(output_dir)
+        _set_cpu_limit(cpu_limit)
+        with redirect_stdout(buffer), redirect_stderr(buffer):
+            exec(code, namespace)
+        result.images = _save_figures(output_dir)
+    except BaseException as e:
+        result.error = repr(e)
+        buffer.write(traceback.format_exc(limit=3))
+    finally:
+        _set_cpu_limit(None)
+        os.chdir(cwd)
+    result.stdout = buffer.getvalue()[-SANDBOX_MAX_OUTPUT_LENGTH:]
+    return result
+
+
+def _worker_main(conn):
+    if hasattr(signal, "SIGXCPU"):
+        signal.signal(signal.SIGXCPU, _on_cpu_time_exceeded)
+    _warm_imports()
+    namespaces: Dict[str, dict] = {}  # session id -> globals, in LRU order
+    while True:
+        try:
+            task = conn.recv()
+        except (EOFError, KeyboardInterrupt):
+            break
+        if task is None:
+            break
+        command, session_id = task[0], task[1]
+        if command == "reset":
+            namespaces.pop(session_id, None)
+            conn.send(SandboxResult())
+            continue
+        code, output_dir, cpu_limit = task[2:]
+        namespace = namespaces.pop(session_id, None)
+        if namespace is None:
+            namespace = {"__name__": "__main__"}
+        namespaces[session_id] = namespace
+        while len(namespaces) > SANDBOX_MAX_SESSIONS_PER_WORKER:
+            namespaces.pop(next(iter(namespaces)))
+        conn.send(_run_code(namespace, code, output_dir, cpu_limit))
+
+
+### Parent process side ###
+def _get_mp_context():
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        ctx = multiprocessing.get_context("forkserver")
+        # the fork server imports these once, every worker forked from it starts warm
+        ctx.set_forkserver_preload(_WARM_MODULES)
+        return ctx
+    return multiprocessing.get_context("spawn")
+
+
+def _get_rss_mb(pid) -> float:
+    try:
+        with open(f"/proc/{pid}/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+class _Worker:
+    def __init__(self, ctx, index):
+        self.index = index
+        self.busy = False
+        self.sessions: Dict[str, None] = {}  # session ids in the LRU order of the worker namespaces
+        self._ctx = ctx
+        self._start()
+
+    def _start(self):
+        parent_conn, child_conn = self._ctx.Pipe()
+        self.process = self._ctx.Process(target=_worker_main, args=(child_conn,), daemon=True,
+                                         name=f"sandbox-worker-{self.index}")
+        self.process.start()
+        child_conn.close()
+        self.conn = parent_conn
+        self.sessions = {}
+
+    def restart(self):
+        self.stop(graceful=False)
+        self._start()
+
+    def stop(self, graceful=True):
+        try:
+            if graceful and self.process.is_alive():
+                self.conn.send(None)
+                self.process.join(1)
+        except (OSError, BrokenPipeError):
+            pass
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join(1)
+        self.conn.close()
+
+    def execute(self, task, wall_limit) -> SandboxResult:
+        try:
+            self.conn.send(task)
+        except (OSError, BrokenPipeError):
+            self.restart()
+            return SandboxResult(error="Sandbox worker was not available, please retry.")
+        deadline = time.monotonic() + wall_limit
+        while not self.conn.poll(_RSS_CHECK_INTERVAL):
+            if _get_rss_mb(self.process.pid) > SANDBOX_MEMORY_LIMIT_MB:
+                self.restart()
+                return SandboxResult(error=f"MemoryError('exceeded {SANDBOX_MEMORY_LIMIT_MB} MB, session reset')")
+            if time.monotonic() > deadline or not self.process.is_alive():
+                break
+        if not self.conn.poll():
+            alive = self.process.is_alive()
+            self.restart()
+            if alive:
+                return SandboxResult(error=f"TimeoutError('exceeded {wall_limit} seconds, session reset')")
+            return SandboxResult(error="Sandbox worker crashed (CPU or memory limit), session reset.")
+        try:
+            return self.conn.recv()
+        except (EOFError, OSError):
+            self.restart()
+            return SandboxResult(error="Sandbox worker crashed (CPU or memory limit), session reset.")
+
+
+class SandboxPool:
+    """A fixed pool of sandbox workers, a session sticks to one worker to keep its namespace unless that worker
+    stays busy for SANDBOX_STICKY_WAIT seconds."""
+
+    def __init__(self, size: int = SANDBOX_POOL_SIZE):
+        ctx = _get_mp_context()
+        self._workers = [_Worker(ctx, i) for i in range(max(1, size))]
+        self._session_worker: Dict[str, _Worker] = {}
+        self._cond = threading.Condition()
+
+    def _acquire(self, session_id, sticky_wait: Optional[float] = SANDBOX_STICKY_WAIT) -> _Worker:
+        """the worker of the session, an idle one once the session's worker is busy for sticky_wait seconds
+        (None waits for it)"""
+        deadline = None if sticky_wait is None else time.monotonic() + sticky_wait
+        with self._cond:
+            while True:
+                worker = self._session_worker.get(session_id)
+                if worker is not None and not worker.busy:
+                    break
+                idle = [w for w in self._workers if not w.busy]
+                if idle and (worker is None or deadline is not None and time.monotonic() >= deadline):
+                    if worker is not None:
+                        # the namespace on the busy worker is given up, the worker evicts it in time
+                        worker.sessions.pop(session_id, None)
+                    worker = min(idle, key=lambda w: len(w.sessions))
+                    self._session_worker[session_id] = worker
+                    break
+                remaining = deadline - time.monotonic() if worker is not None and deadline is not None else 0
+                self._cond.wait(remaining if remaining > 0 else None)
+            self._touch(worker, session_id)
+            worker.busy = True
+            return worker
+
+    def _touch(self, worker: _Worker, session_id):
+        """mirror the LRU of the worker namespaces, called with the lock held"""
+        worker.sessions.pop(session_id, None)
+        worker.sessions[session_id] = None
+        while len(worker.sessions) > SANDBOX_MAX_SESSIONS_PER_WORKER:
+            # the worker drops the namespace of its least recently used session on this run
+            evicted = next(iter(worker.sessions))
+            del worker.sessions[evicted]
+            if self._session_worker.get(evicted) is worker:
+                del self._session_worker[evicted]
+
+    def _release(self, worker: _Worker):
+        with self._cond:
+            worker.busy = False
+            if not worker.sessions:
+                # the worker was restarted, forget the sessions stuck to the dead process
+                for session_id in [s for s, w in self._session_worker.items() if w is worker]:
+                    del self._session_worker[session_id]
+            self._cond.notify_all()
+
+    def run(self, code: str, session_id: str, output_dir: str,
+            cpu_limit: int = SANDBOX_CPU_TIME_LIMIT, wall_limit: float = SANDBOX_WALL_TIME_LIMIT) -> SandboxResult:
+        worker = self._acquire(session_id)
+        try:
+            return worker.execute(("run", session_id, code, str(output_dir), cpu_limit), wall_limit)
+        finally:
+            self._release(worker)
+
+    def reset_session(self, session_id: str):
+        with self._cond:
+            worker = self._session_worker.get(session_id)
+        if worker is None:
+            return
+        worker = self._acquire(session_id, sticky_wait=None)
+        try:
+            worker.execute(("reset", session_id), SANDBOX_WALL_TIME_LIMIT)
+            with self._cond:
+                worker.sessions.pop(session_id, None)
+                self._session_worker.pop(session_id, None)
+        finally:
+            self._release(worker)
+
+    def shutdown(self):
+        for worker in self._workers:
+            worker.stop()
+
+
+_pool: Optional[SandboxPool] = None
+_pool_lock = threading.Lock()
+
+
+def get_pool() -> SandboxPool:
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = SandboxPool()
+    return _pool
+
+
+def shutdown_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown()
+            _pool = None
+
+
+def run(code: str, session_id: str, output_dir: str) -> SandboxResult:
+    return get_pool().run(code, session_id, output_dir)
@@ -1,25 +1,38 @@
 import asyncio
-from typing import Literal, Optional, AsyncGenerator
+import logging
+import os
+from contextvars import ContextVar
+from typing import Literal, Optional, AsyncGenerator, Callable
 
 from langgraph.graph import StateGraph, MessagesState, START, END
+from langgraph.graph.message import REMOVE_ALL_MESSAGES
 from langgraph.types import Command
 from langchain_core.language_models.chat_models import BaseChatModel
-from langchain_core.messages import HumanMessage
+from langchain_core.messages import HumanMessage, RemoveMessage
 from langgraph.prebuilt import create_react_agent
 from pydantic import field_validator, BaseModel
 
-from comm import llm_provider
-from langgraph_hierarchical_agent_teams import tools
+from comm import checkpoint, llm_provider, tracing
+from langgraph_hierarchical_agent_teams import compaction, tools
+
+TEAM_MEMBERS = ["research_team", "writing_team", "general_qa"]
+# earlier turns (question and final team report) a new run of a conversation starts with, the worker
+# reports of the earlier runs are dropped from the checkpointed messages, so the state stays flat
+TEAMS_HISTORY_TURNS = int(os.environ.get("TEAMS_HISTORY_TURNS", 3))
+logger = tracing.get_logger("agent_teams")
+
+# the writer of the running answer() call, kept out of the state because the state is checkpointed
+_stream_writer: ContextVar[Optional[Callable]] = ContextVar("stream_writer", default=None)
 
 
 class State(MessagesState):
     next: str
     stream: bool = True
-    stream_writer: Optional[callable] = None
 
 
 async def stream_react_agent(node_name, agent, state: State):
     messages = []
+    stream_writer = _stream_writer.get()
     async for event in agent.astream_events(state):
         event_type = event.get("event", "")
         data = event.get("data", {})
@@ -29,13 +42,14 @@ async def stream_react_agent(node_name, agent, state: State):
             if chunk and not getattr(chunk, "tool_calls", None) and not getattr(chunk, "tool_call_chunks", None):
                 if chunk.content:
                     token = chunk.content
-                    total_tokens = chunk.usage_metadata.get("total_tokens", 0)
-                    input_tokens = chunk.usage_metadata.get("input_tokens", 0)
+                    usage = chunk.usage_metadata or {}
+                    total_tokens = usage.get("total_tokens", 0)
+                    input_tokens = usage.get("input_tokens", 0)
                     if total_tokens - input_tokens == 1 and token == "\n":
                         # ignore
                         continue
-                    token_message = HumanMessage(token, name=node_name)
-                    state["stream_writer"](token_message)
+                    if stream_writer:
+                        stream_writer(HumanMessage(token, name=node_name))
         elif event_type == "on_chain_end" and event.get("name", "") == "LangGraph":
             output = data.get("output", {})
             if "messages" in output:
@@ -43,7 +57,7 @@ async def stream_react_agent(node_name, agent, state: State):
     return {"messages": messages}
 
 
-def make_supervisor_node(llm: BaseChatModel, members: list[str]):
+def make_supervisor_node(llm: BaseChatModel, members: list[str], graph_name: str):
     options = ["FINISH"] + members
     system_prompt = (
         "You are a supervisor tasked with managing a conversation between the"
@@ -64,32 +78,36 @@ def make_supervisor_node(llm: BaseChatModel, members: list[str]):
                 raise ValueError(f"next must be one of {options}")
             return v
 
+    @tracing.trace_node(graph_name, "supervisor")
     def supervisor_node(state: State) -> Command:
-        print("=== Supervisor routing ===")
         """An LLM-based router."""
+        # the user request and a ledger of the worker outcomes, the cost of a round stays bounded
         messages = [
             {"role": "system", "content": system_prompt},
-        ] + state["messages"]
+        ] + compaction.compact_messages(state["messages"], graph_name)
         response = llm.with_structured_output(Router).invoke(messages)
         goto = response.next
         if goto == "FINISH":
             goto = END
 
-        print(f"{{\"supervisor\": \"next\": {goto}}}")
+        tracing.record_decision(graph_name, "supervisor", response.next)
+        tracing.log_event(logger, "supervisor_routing", logging.DEBUG, graph=graph_name, next=response.next)
         return Command(goto=goto, update={"next": goto})
 
     return supervisor_node
 
 
-llm = llm_provider.get_chat_model()
+llm = llm_provider.get_chat_model("agent")
+supervisor_llm = llm_provider.get_chat_model("router")
 
 ### Research Team ###
-search_agent = create_react_agent(llm, tools=[tools.tavily_tool])
+# long tool outputs are shortened, the agents page through the full ones with read_document
+search_agent = create_react_agent(llm, tools=[tools.web_search, tools.read_document])
 
 
+@tracing.trace_node("research_team")
 async def search_node(state: State) -> Command[Literal["supervisor"]]:
     # result = search_agent.invoke(state)
-    print("=== Call search ===")
     result = await stream_react_agent("search", search_agent, state)
     return Command(
         update={
@@ -102,12 +120,12 @@ async def search_node(state: State) -> Command[Literal["supervisor"]]:
     )
 
 
-web_scraper_agent = create_react_agent(llm, tools=[tools.scrape_webpages])
+web_scraper_agent = create_react_agent(llm, tools=[tools.scrape_webpages, tools.read_document])
 
 
+@tracing.trace_node("research_team")
 async def web_scraper_node(state: State) -> Command[Literal["supervisor"]]:
     # result = web_scraper_agent.invoke(state)
-    print("=== Call web scraper ===")
     result = await stream_react_agent("web_scraper", web_scraper_agent, state)
     return Command(
         update={
@@ -120,7 +138,7 @@ async def web_scraper_node(state: State) -> Command[Literal["supervisor"]]:
     )
 
 
-research_supervisor_node = make_supervisor_node(llm, ["search", "web_scraper"])
+research_supervisor_node = make_supervisor_node(supervisor_llm, ["search", "web_scraper"], "research_team")
 
 
 ### Document Writing Team ###
@@ -134,9 +152,9 @@ doc_writer_agent = create_react_agent(
 )
 
 
+@tracing.trace_node("writing_team")
 async def doc_writing_node(state: State) -> Command[Literal["supervisor"]]:
     # result = doc_writer_agent.invoke(state)
-    print("=== Call doc writer ===")
     result = await stream_react_agent("doc_writer", doc_writer_agent, state)
     return Command(
         update={
@@ -159,9 +177,9 @@ note_taking_agent = create_react_agent(
 )
 
 
+@tracing.trace_node("writing_team")
 async def note_taking_node(state: State) -> Command[Literal["supervisor"]]:
     # result = note_taking_agent.invoke(state)
-    print("=== Call note taker ===")
     result = await stream_react_agent("note_taker", note_taking_agent, state)
     return Command(
         update={
@@ -179,9 +197,9 @@ chart_generating_agent = create_react_agent(
 )
 
 
+@tracing.trace_node("writing_team")
 async def chart_generating_node(state: State) -> Command[Literal["supervisor"]]:
     # result = chart_generating_agent.invoke(state)
-    print("=== Call chart generator ===")
     result = await stream_react_agent("chart_generator", chart_generating_agent, state)
     return Command(
         update={
@@ -197,7 +215,7 @@ async def chart_generating_node(state: State) -> Command[Literal["supervisor"]]:
 
 
 doc_writing_supervisor_node = make_supervisor_node(
-    llm, ["doc_writer", "note_taker", "chart_generator"]
+    supervisor_llm, ["doc_writer", "note_taker", "chart_generator"], "writing_team"
 )
 
 
@@ -246,11 +264,10 @@ paper_writing_graph = build_paper_writing_graph()
 #     return response
 
 
+@tracing.trace_node("teams")
 async def call_research_team(state: State) -> Command[Literal["supervisor"]]:
     # response = await stream_graph(research_graph, state)
-    print("=== Call research team ===")
-    response = await research_graph.ainvoke({"messages": state["messages"][-1],
-                                             "stream_writer": state["stream_writer"]},
+    response = await research_graph.ainvoke({"messages": state["messages"][-1]},
                                             {"recursion_limit": 150})
     return Command(
         update={
@@ -264,11 +281,10 @@ async def call_research_team(state: State) -> Command[Literal["supervisor"]]:
     )
 
 
+@tracing.trace_node("teams")
 async def call_paper_writing_team(state: State) -> Command[Literal["supervisor"]]:
     # response = await stream_graph(paper_writing_graph, state)
-    print("=== Call document writing team ===")
-    response = await paper_writing_graph.ainvoke({"messages": state["messages"][-1],
-                                                  "stream_writer": state["stream_writer"]},
+    response = await paper_writing_graph.ainvoke({"messages": state["messages"][-1]},
                                                  {"recursion_limit": 150})
     return Command(
         update={
@@ -284,7 +300,7 @@ async def call_paper_writing_team(state: State) -> Command[Literal["supervisor"]
 
 general_qa_agent = create_react_agent(
     llm,
-    tools=[tools.tavily_tool],  # 可以添加适当的工具
+    tools=[tools.web_search, tools.read_document],  # 可以添加适当的工具
     prompt=(
         "You are a helpful assistant that can answer general questions about the system when there is no response yet,"
         " explain behaviors, and provide detailed responses to user inquiries."
@@ -294,8 +310,8 @@ general_qa_agent = create_react_agent(
 )
 
 
+@tracing.trace_node("teams")
 async def general_qa_node(state: State) -> Command[Literal["supervisor"]]:
-    print("=== Call general QA ===")
     result = await stream_react_agent("general_qa", general_qa_agent, state)
     return Command(
         update={
@@ -307,11 +323,11 @@ async def general_qa_node(state: State) -> Command[Literal["supervisor"]]:
     )
 
 
-teams_supervisor_node = make_supervisor_node(llm, ["research_team", "writing_team",  "general_qa"])
+teams_supervisor_node = make_supervisor_node(supervisor_llm, TEAM_MEMBERS, "teams")
 
 
 # Define the parent teams graph.
-def build_super_graph():
+def build_super_graph(checkpointer=None):
     super_builder = StateGraph(State)
     super_builder.add_node("supervisor", teams_supervisor_node)
     super_builder.add_node("research_team", call_research_team)
@@ -319,14 +335,45 @@ def build_super_graph():
     super_builder.add_node("general_qa", general_qa_node)
 
     super_builder.add_edge(START, "supervisor")
-    super_graph = super_builder.compile()
+    # the team sub graphs run inside the nodes and inherit the checkpointer
+    super_graph = super_builder.compile(checkpointer=checkpointer)
     return super_graph
 
 
 super_graph = build_super_graph()
+_checkpointed_super_graph = None
+
+
+async def get_checkpointed_super_graph():
+    global _checkpointed_super_graph
+    if _checkpointed_super_graph is None:
+        _checkpointed_super_graph = build_super_graph(await checkpoint.get_async_sqlite_saver("agent_teams"))
+    return _checkpointed_super_graph
+
+
+def _turns(messages: list) -> list:
+    """[question, last team report] message pairs, the report is None while the run has none"""
+    turns = []
+    for message in messages:
+        if message.type == "human" and not message.name:
+            turns.append([message, None])
+        elif turns and message.name in TEAM_MEMBERS and message.content:
+            # the last team report is the answer
+            turns[-1][1] = message
+    return turns
+
+
+async def load_conversation_history(user_id: str = None, conversation_id: str = None) -> list[dict]:
+    """question / answer pairs of a conversation, taken from its last checkpoint, which keeps the latest
+    turn and the TEAMS_HISTORY_TURNS before it"""
+    graph = await get_checkpointed_super_graph()
+    snapshot = await graph.aget_state(checkpoint.make_config(user_id, conversation_id))
+    return [{"question": question.content, "answer": report.content if report else ""}
+            for question, report in _turns(snapshot.values.get("messages", []) if snapshot else [])]
 
 
-async def answer(question: str, user_id: str = None) -> AsyncGenerator[str, None]:
+async def answer(question: str, user_id: str = None, conversation_id: str = None,
+                 resume: bool = False) -> AsyncGenerator[str, None]:
     user_id = user_id or 'default'
 
     # 使用队列收集流式数据
@@ -335,15 +382,28 @@ async def answer(question: str, user_id: str = None) -> AsyncGenerator[str, None
     def stream_writer(message):
         queue.put_nowait(message)
 
-    inputs = {
-        "user_id": user_id,
-        "messages": [("user", question)],
-        "stream_writer": stream_writer  # 传入 stream_writer
-    }
+    graph = await get_checkpointed_super_graph()
+    # thread_id selects the checkpoints, session_id isolates tool state, e.g. the workspace and python sandbox
+    config = checkpoint.make_config(user_id, conversation_id)
+    snapshot = await graph.aget_state(config)
+    if resume and snapshot.next:
+        # continue after the last completed node, finished team results are not recomputed
+        tracing.log_event(logger, "resume_from_checkpoint", thread_id=config["configurable"]["thread_id"])
+        inputs = None
+    else:
+        # the messages reducer accumulates over the runs of a thread, a new run replaces them by the
+        # recent turns and the question instead of carrying every earlier worker report
+        turns = _turns(snapshot.values.get("messages", [])) if TEAMS_HISTORY_TURNS > 0 else []
+        history = [m for turn in turns[-TEAMS_HISTORY_TURNS:] for m in turn if m is not None] if turns else []
+        inputs = {
+            "user_id": user_id,
+            "messages": [RemoveMessage(id=REMOVE_ALL_MESSAGES)] + history + [HumanMessage(content=question)],
+        }
 
     async def run_graph():
+        _stream_writer.set(stream_writer)
         try:
-            await super_graph.ainvoke(inputs)
+            await graph.ainvoke(inputs, config)
         finally:
             # 发送结束信号
             queue.put_nowait(None)
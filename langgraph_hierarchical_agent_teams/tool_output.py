@@ -0,0 +1,159 @@
+"""
+Token budget of the tool outputs fed back into the agents.
+
+Scraped pages and search results can be tens of thousands of tokens, all of them stay in the agent's
+message history for every later step. An output over the budget of its tool is stored in full in the
+session workspace, boilerplate lines (navigation, cookie banners, repeated lines) are dropped and the
+passages most similar to the query (by embedding) are returned within the budget, in document order and
+with their line numbers, so the agent can read more of the stored file with read_document.
+TOOL_OUTPUT_BUDGETS overrides the budgets per tool as JSON, e.g. {"scrape_webpages": 4000}.
+"""
+import hashlib
+import io
+import json
+import logging
+import os
+import re
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+from comm import llm_provider, metrics, tracing
+from comm.llm_provider import count_tokens
+from langgraph_hierarchical_agent_teams import workspace
+
+TOOL_OUTPUT_DEFAULT_TOKENS = int(os.environ.get("TOOL_OUTPUT_DEFAULT_TOKENS", 2000))
+TOOL_OUTPUT_BUDGETS = {"scrape_webpages": 3000, "web_search": 1500, "read_document": 4000,
+                       **json.loads(os.environ.get("TOOL_OUTPUT_BUDGETS", "{}"))}
+# lines are grouped into passages of about this many tokens, the unit of ranking
+TOOL_OUTPUT_PASSAGE_TOKENS = int(os.environ.get("TOOL_OUTPUT_PASSAGE_TOKENS", 120))
+TOOL_OUTPUT_DIRECTORY = "tool_outputs"
+
+_BOILERPLATE = re.compile(r"cookie|privacy policy|terms of (use|service)|all rights reserved|subscribe|sign (in|up)"
+                          r"|log ?in|newsletter|skip to (main )?content|share (on|this)|follow us|^menu$|^search$",
+                          re.I)
+
+logger = tracing.get_logger("tool_output")
+_tokens = metrics.histogram("tool_output_tokens", "Tokens of the tool outputs", ["tool", "stage"],
+                            buckets=(250, 500, 1000, 2000, 4000, 8000, 16000, 32000, 64000))
+
+
+def get_budget(tool_name: str) -> int:
+    return TOOL_OUTPUT_BUDGETS.get(tool_name, TOOL_OUTPUT_DEFAULT_TOKENS)
+
+
+def _is_boilerplate(line: str, counts: dict) -> bool:
+    words = line.split()
+    if not words:
+        return True
+    # menus and footers: short link-like lines, repeated lines, the usual banner phrases
+    if counts[line] > 1 and len(words) < 12:
+        return True
+    return len(words) < 8 and bool(_BOILERPLATE.search(line))
+
+
+def split_passages(lines: List[str]) -> List[Tuple[int, int, str]]:
+    """(first line, last line + 1, text) of the passages, boilerplate lines are left out"""
+    stripped = [line.strip() for line in lines]
+    counts = {}
+    for line in stripped:
+        counts[line] = counts.get(line, 0) + 1
+    passages = []
+    start, texts, tokens = None, [], 0
+    for i, line in enumerate(stripped):
+        if _is_boilerplate(line, counts):
+            # blank and boilerplate lines end a passage once it's large enough
+            if texts and (not line or tokens >= TOOL_OUTPUT_PASSAGE_TOKENS):
+                passages.append((start, i, "\n".join(texts)))
+                start, texts, tokens = None, [], 0
+            continue
+        if start is None:
+            start = i
+        texts.append(line)
+        tokens += count_tokens(line)
+        if tokens >= TOOL_OUTPUT_PASSAGE_TOKENS:
+            passages.append((start, i + 1, "\n".join(texts)))
+            start, texts, tokens = None, [], 0
+    if texts:
+        passages.append((start, len(stripped), "\n".join(texts)))
+    return passages
+
+
+def _rank(query: Optional[str], passages: List[Tuple[int, int, str]]) -> List[int]:
+    """passage indexes by similarity to the query, document order without query"""
+    if not query or len(passages) < 2:
+        return list(range(len(passages)))
+    embed_model = llm_provider.get_embedding_model()
+    vectors = np.asarray(embed_model.embed_documents([text for _, _, text in passages]), dtype=np.float32)
+    query_vector = np.asarray(embed_model.embed_query(query), dtype=np.float32)
+    vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+    query_vector /= max(float(np.linalg.norm(query_vector)), 1e-12)
+    return np.argsort(-(vectors @ query_vector), kind="stable").tolist()
+
+
+def process(tool_name: str, text: str, query: Optional[str], session_id: str) -> str:
+    """
+    Fit a tool output into the budget of the tool.
+
+    Args:
+        tool_name: the tool, selects the budget
+        text: the full output
+        query: what the agent is looking for, ranks the passages
+        session_id: session of the workspace the full output is stored in
+
+    Returns:
+        the output if within the budget, otherwise the most relevant passages with a reference to the
+        stored full output
+    """
+    budget = get_budget(tool_name)
+    tokens = count_tokens(text)
+    _tokens.labels(tool_name, "full").observe(tokens)
+    if tokens <= budget:
+        return text
+    ws = workspace.get_workspace(session_id)
+    file_name = f"{TOOL_OUTPUT_DIRECTORY}/{tool_name}_{hashlib.sha1(text.encode('utf-8')).hexdigest()[:12]}.txt"
+    ws.write_text(file_name, text)
+    # split like the workspace does, the line numbers are those of read_document
+    lines = [line.rstrip("\n") for line in io.StringIO(text, newline=None).readlines()]
+    passages = split_passages(lines)
+    header_tokens = 80
+    selected, used = [], 0
+    try:
+        ranked = _rank(query, passages)
+    except Exception as e:
+        # embedding failed, the head of the output is still better than nothing
+        tracing.log_event(logger, "rank_failed", logging.WARNING, tool=tool_name, error=repr(e))
+        ranked = list(range(len(passages)))
+    for i in ranked:
+        passage_tokens = count_tokens(passages[i][2]) + 8
+        if used + passage_tokens > budget - header_tokens:
+            continue
+        selected.append(i)
+        used += passage_tokens
+    parts = [f"[Output of {tool_name} shortened to {len(selected)} of {len(passages)} passages ({used} of "
+             f"{tokens} tokens){', the most relevant to: ' + query if query else ''}. The full output is "
+             f"{file_name} ({len(lines)} lines), read more of it with read_document(file_name, start, end).]"]
+    for i in sorted(selected):
+        start, end, passage = passages[i]
+        parts.append(f"[lines {start}:{end}]\n{passage}")
+    ret = "\n\n".join(parts)
+    _tokens.labels(tool_name, "returned").observe(count_tokens(ret))
+    tracing.log_event(logger, "tool_output_shortened", logging.DEBUG, tool=tool_name, tokens=tokens,
+                      passages=len(passages), selected=len(selected))
+    return ret
+
+
+def page_lines(tool_name: str, lines: List[str], start: Optional[int]) -> str:
+    """the lines within the budget of the tool, with where to continue if they don't all fit"""
+    budget = get_budget(tool_name)
+    kept, used = [], 0
+    for line in lines:
+        used += count_tokens(line) + 1
+        if used > budget and kept:
+            break
+        kept.append(line)
+    text = "\n".join(kept)
+    if len(kept) < len(lines):
+        next_start = (start or 0) + len(kept)
+        text += f"\n[... {len(lines) - len(kept)} more lines, continue with start={next_start}]"
+    return text
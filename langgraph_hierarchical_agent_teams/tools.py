@@ -1,12 +1,10 @@
 from typing import Annotated, List, Dict, Optional
-from pathlib import Path
-from tempfile import TemporaryDirectory
-from langchain_community.document_loaders import WebBaseLoader
-from langchain_community.tools import TavilySearchResults
+from langchain_core.runnables import RunnableConfig
 from langchain_core.tools import tool
 
-from langchain_experimental.utilities import PythonREPL
-tavily_tool = TavilySearchResults(max_results=5)
+from comm import llm_provider
+from langgraph_hierarchical_agent_teams import sandbox, tool_output, workspace
+tavily_tool = llm_provider.get_search_tool(max_results=5)
 
 
 def format_docs(docs):
@@ -19,55 +17,77 @@ def format_docs(docs):
     return "\n\n".join(ret)
 
 
+def _get_session_id(config: RunnableConfig) -> str:
+    return (config or {}).get("configurable", {}).get("session_id", "default")
+
+
 ### ResearchTeam tools ###
 @tool
-def scrape_webpages(urls: List[str]) -> str:
-    """Use requests and bs4 to scrape the provided web pages for detailed information."""
-    loader = WebBaseLoader(urls)
-    docs = loader.load()
-    return format_docs(docs)
+def web_search(
+    query: Annotated[str, "The search query."],
+    config: RunnableConfig,
+) -> str:
+    """A search engine optimized for comprehensive, accurate, and trusted results.
+    Long results are shortened to the passages most relevant to the query."""
+    results = tavily_tool.invoke({"query": query})
+    if isinstance(results, list):
+        results = "\n\n".join(f'<Result url="{r.get("url", "")}">\n{r.get("content", "")}\n</Result>'
+                                if isinstance(r, dict) else str(r) for r in results)
+    return tool_output.process("web_search", str(results), query, _get_session_id(config))
+
+
+@tool
+def scrape_webpages(
+    urls: List[str],
+    config: RunnableConfig,
+    query: Annotated[Optional[str], "What you are looking for on the pages, selects the passages returned."] = None,
+) -> str:
+    """Use requests and bs4 to scrape the provided web pages for detailed information.
+    Long pages are shortened to the passages most relevant to the query, the full text is saved
+    to a file that can be read with read_document."""
+    docs = llm_provider.load_web_pages(urls)
+    return tool_output.process("scrape_webpages", format_docs(docs), query, _get_session_id(config))
 
 
 ### Document writing team tools ###
-_TEMP_DIRECTORY = TemporaryDirectory()
-WORKING_DIRECTORY = Path(_TEMP_DIRECTORY.name)
+
+
+def _get_workspace(config: RunnableConfig) -> workspace.Workspace:
+    return workspace.get_workspace(_get_session_id(config))
 
 
 @tool
 def create_outline(
     points: Annotated[List[str], "List of main points or sections."],
     file_name: Annotated[str, "File path to save the outline."],
+    config: RunnableConfig,
 ) -> Annotated[str, "Path of the saved outline file."]:
     """Create and save an outline."""
-    with (WORKING_DIRECTORY/file_name).open("w") as file:
-        for i, point in enumerate(points):
-            file.write(f"{i + 1}. {point}\n")
-    return f"Outline saved to {WORKING_DIRECTORY}/{file_name}"
+    path = _get_workspace(config).write_lines(file_name, (f"{i + 1}. {point}\n" for i, point in enumerate(points)))
+    return f"Outline saved to {path}"
 
 
 @tool
 def read_document(
     file_name: Annotated[str, "File path to read the document from."],
+    config: RunnableConfig,
     start: Annotated[Optional[int], "The start line. Default is 0"] = None,
     end: Annotated[Optional[int], "The end line. Default is None"] = None,
 ) -> str:
-    """Read the specified document."""
-    with (WORKING_DIRECTORY/file_name).open("r") as file:
-        lines = file.readlines()
-    if start is None:
-        start = 0
-    return "\n".join(lines[start:end])
+    """Read the specified document. Long ranges are cut, the result tells where to continue."""
+    lines = _get_workspace(config).read_lines(file_name, start, end)
+    return tool_output.page_lines("read_document", lines, start)
 
 
 @tool
 def write_document(
     content: Annotated[str, "Text content to be written into the document."],
     file_name: Annotated[str, "File path to save the document."],
+    config: RunnableConfig,
 ) -> Annotated[str, "Path of the saved document file."]:
     """Create and save a text document."""
-    with (WORKING_DIRECTORY/file_name).open("w") as file:
-        file.write(content)
-    return f"Document saved to {WORKING_DIRECTORY}/{file_name}"
+    path = _get_workspace(config).write_text(file_name, content)
+    return f"Document saved to {path}"
 
 
 @tool
@@ -77,39 +97,28 @@ def edit_document(
         Dict[int, str],
         "Dictionary where key is the line number (1-indexed) and value is the text to be inserted at that line.",
     ],
+    config: RunnableConfig,
 ) -> Annotated[str, "Path of the edited document file."]:
     """Edit a document by inserting text at specific line numbers."""
-
-    with (WORKING_DIRECTORY/file_name).open("r") as file:
-        lines = file.readlines()
-
-    sorted_inserts = sorted(inserts.items())
-
-    for line_number, text in sorted_inserts:
-        if 1 <= line_number <= len(lines) + 1:
-            lines.insert(line_number - 1, text + "\n")
-        else:
-            return f"Error: Line number {line_number} is out of range."
-
-    with (WORKING_DIRECTORY/file_name).open("w") as file:
-        file.writelines(lines)
-
-    return f"Document edited and saved to {WORKING_DIRECTORY}/{file_name}"
-
-
-# Warning: This executes code locally, which can be unsafe when not sandboxed
-
-repl = PythonREPL()
+    ws = _get_workspace(config)
+    error = ws.insert_lines(file_name, inserts)
+    if error:
+        return error
+    return f"Document edited and saved to {ws.resolve(file_name)}"
 
 
+# Warning: This executes code in local worker processes, they are resource limited but not a security boundary
 @tool
 def python_repl_tool(
     code: Annotated[str, "The python code to execute to generate your chart."],
+    config: RunnableConfig,
 ):
     """Use this to execute python code. If you want to see the output of a value,
     you should print it out with `print(...)`. This is visible to the user."""
-    try:
-        result = repl.run(code)
-    except BaseException as e:
-        return f"Failed to execute. Error: {repr(e)}"
-    return f"Successfully executed:\n\`\`\`python\n{code}\n\`\`\`\nStdout: {result}"
+    result = sandbox.run(code, _get_session_id(config), str(_get_workspace(config).path))
+    if result.error:
+        return f"Failed to execute. Error: {result.error}\nStdout: {result.stdout}"
+    ret = f"Successfully executed:\n\`\`\`python\n{code}\n\`\`\`\nStdout: {result.stdout}"
+    if result.images:
+        ret += "\nSaved charts: " + ", ".join(result.images)
+    return ret
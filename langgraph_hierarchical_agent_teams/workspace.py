@@ -0,0 +1,175 @@
+"""
+Per-session workspaces for the document writing team.
+
+Each session (user / run) gets its own directory under WORKSPACE_ROOT, idle ones are removed by
+cleanup_idle_workspaces(). Reads seek straight to the requested line range through a cached
+line offset index, edits stream the file once and all writes are atomic (temp file + rename).
+"""
+import io
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+from array import array
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+
+WORKSPACE_ROOT = Path(os.environ["WORKSPACE_ROOT"]) if "WORKSPACE_ROOT" in os.environ \
+    else Path(tempfile.gettempdir()) / "agent_teams_workspaces"
+WORKSPACE_IDLE_TIMEOUT = int(os.environ.get("WORKSPACE_IDLE_TIMEOUT", 3600))
+_INDEX_BLOCK_SIZE = 1024 * 1024
+
+
+def _split_lines(text: str) -> List[str]:
+    # same line splitting as readlines() of a text mode file
+    return io.StringIO(text, newline=None).readlines()
+
+
+class Workspace:
+    def __init__(self, session_id: str, root: Path = WORKSPACE_ROOT):
+        self.session_id = session_id
+        self.path = (root / re.sub(r"[^A-Za-z0-9_.-]", "_", session_id)).resolve()
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.last_access = time.time()
+        self._lock = threading.Lock()
+        # file path -> (mtime_ns, size, line start offsets + file size)
+        self._line_index: Dict[Path, Tuple[int, int, array]] = {}
+
+    def resolve(self, file_name: str) -> Path:
+        self.last_access = time.time()
+        path = (self.path / file_name).resolve()
+        if path != self.path and self.path not in path.parents:
+            raise ValueError(f"File {file_name} is outside of the workspace.")
+        return path
+
+    def _get_line_offsets(self, path: Path) -> array:
+        stat = path.stat()
+        with self._lock:
+            cached = self._line_index.get(path)
+            if cached and cached[0] == stat.st_mtime_ns and cached[1] == stat.st_size:
+                return cached[2]
+        offsets = array("q", [0])
+        with path.open("rb") as f:
+            pos = 0
+            while True:
+                block = f.read(_INDEX_BLOCK_SIZE)
+                if not block:
+                    break
+                i = block.find(b"\n")
+                while i >= 0:
+                    offsets.append(pos + i + 1)
+                    i = block.find(b"\n", i + 1)
+                pos += len(block)
+        if offsets[-1] != pos:
+            # last line without a line break
+            offsets.append(pos)
+        with self._lock:
+            self._line_index[path] = (stat.st_mtime_ns, stat.st_size, offsets)
+        return offsets
+
+    def read_lines(self, file_name: str, start: Optional[int] = None, end: Optional[int] = None) -> List[str]:
+        """Read lines[start:end] of a file without loading the lines outside of the range."""
+        path = self.resolve(file_name)
+        offsets = self._get_line_offsets(path)
+        start, end, _ = slice(start, end).indices(len(offsets) - 1)
+        if start >= end:
+            return []
+        with path.open("rb") as f:
+            f.seek(offsets[start])
+            data = f.read(offsets[end] - offsets[start])
+        return _split_lines(data.decode("utf-8", errors="replace"))
+
+    def write_text(self, file_name: str, content: str) -> Path:
+        return self.write_lines(file_name, [content])
+
+    def write_lines(self, file_name: str, lines: Iterable[str]) -> Path:
+        """Atomically replace a file, readers see either the old or the new content."""
+        path = self.resolve(file_name)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                f.writelines(lines)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        with self._lock:
+            self._line_index.pop(path, None)
+        return path
+
+    def insert_lines(self, file_name: str, inserts: Dict[int, str]) -> Optional[str]:
+        """
+        Insert text at 1-indexed line numbers in one pass over the file.
+
+        The inserts are applied in line number order and each number refers to the document
+        with the previous inserts already applied, so the inserted text ends up exactly at the given line.
+
+        Returns:
+            An error message if a line number is out of range, the file is left untouched then.
+        """
+        path = self.resolve(file_name)
+        sorted_inserts = sorted((int(k), v) for k, v in inserts.items())
+        error = None
+
+        def merged_lines():
+            nonlocal error
+            with path.open("r", encoding="utf-8") as src:
+                written = 0
+                for line_number, text in sorted_inserts:
+                    if line_number < 1:
+                        error = f"Error: Line number {line_number} is out of range."
+                        raise ValueError(error)
+                    while written < line_number - 1:
+                        line = src.readline()
+                        if not line:
+                            error = f"Error: Line number {line_number} is out of range."
+                            raise ValueError(error)
+                        yield line
+                        written += 1
+                    yield text + "\n"
+                    written += 1
+                yield from src
+
+        try:
+            self.write_lines(file_name, merged_lines())
+        except ValueError:
+            if error:
+                return error
+            raise
+        return None
+
+    def cleanup(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+
+_workspaces: Dict[str, Workspace] = {}
+_workspaces_lock = threading.Lock()
+
+
+def get_workspace(session_id: str) -> Workspace:
+    with _workspaces_lock:
+        workspace = _workspaces.get(session_id)
+        if workspace is None:
+            workspace = Workspace(session_id)
+            _workspaces[session_id] = workspace
+    workspace.last_access = time.time()
+    return workspace
+
+
+def release_workspace(session_id: str):
+    with _workspaces_lock:
+        workspace = _workspaces.pop(session_id, None)
+    if workspace is not None:
+        workspace.cleanup()
+
+
+def cleanup_idle_workspaces(max_idle: int = WORKSPACE_IDLE_TIMEOUT):
+    expire_time = time.time() - max_idle
+    with _workspaces_lock:
+        expired = [s for s, w in _workspaces.items() if w.last_access < expire_time]
+        workspaces = [_workspaces.pop(s) for s in expired]
+    for workspace in workspaces:
+        workspace.cleanup()
@@ -1,3 +1,4 @@
+import asyncio
 import os
 import sys
 import threading
@@ -18,13 +19,18 @@ import traceback
 
 import test_sqlserver
 import mongodb_client
+from comm import checkpoint, http_client, metrics, persistence
+from comm.admin_router import admin_router
+from comm.middleware import MetricsMiddleware
 from auth.models import User
 from auth.security import cleanup_expired_cache, require_login, logout_user, login_user, get_current_user
 
 sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "langgraph_adaptive_rag"))
 from langgraph_adaptive_rag.api_router import router
+import chroma_db  # same module instance as the one graph.py imports
 sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "langgraph_hierarchical_agent_teams"))
 from langgraph_hierarchical_agent_teams.api_router import teams_router
+from langgraph_hierarchical_agent_teams import sandbox, workspace
 
 
 
@@ -37,15 +43,24 @@ async def lifespan(app: FastAPI):
         while True:
             try:
                 cleanup_expired_cache()
+                workspace.cleanup_idle_workspaces()
+                chroma_db.manager.evict_idle()
             except Exception as e:
                 print(f"Cache cleanup error: {e}")
             time.sleep(SESSION_CLEANUP_PERIOD)
 
     cleanup_thread = threading.Thread(target=periodic_cleanup, daemon=True)
     cleanup_thread.start()
+    # pre-fork the python sandbox workers, so the first chart doesn't pay for process start and imports
+    threading.Thread(target=sandbox.get_pool, daemon=True).start()
     # the code before yield will be executed during the app running
     yield
     # the code after yield will be executed during the app shutdown
+    sandbox.shutdown_pool()
+    # write the queued conversation histories before the process exits
+    await asyncio.to_thread(persistence.close_all)
+    await checkpoint.close_async_savers()
+    await http_client.close_http_clients()
 
 
 class ProtectedStaticFiles(StaticFiles):
@@ -82,9 +97,12 @@ app.add_middleware(
     allow_methods=["*"],  # 允许所有方法
     allow_headers=["*"],  # 允许所有头
 )
+# request latency / size / status per route, outermost so it times the whole request
+app.add_middleware(MetricsMiddleware)
 
 app.include_router(router, prefix='/ai', tags=['ai'])
 app.include_router(teams_router, prefix='/teams', tags=['teams'])
+app.include_router(admin_router, prefix='/admin', tags=['admin'])
 
 
 @app.get("/", response_class=HTMLResponse)
@@ -93,6 +111,11 @@ async def index(request: Request):
     return templates.TemplateResponse('index.html', {"request": request})
 
 
+@app.get("/metrics", include_in_schema=False)
+async def prometheus_metrics():
+    return Response(content=metrics.render(), media_type=metrics.CONTENT_TYPE)
+
+
 @app.get('/favicon.ico')
 async def favicon():
     file_name = 'favicon.ico'